@@ -7,6 +7,7 @@ import fabtools.disk
 import fabtools.files
 import fabtools.git
 import fabtools.group
+import fabtools.inventory
 import fabtools.mercurial
 import fabtools.mysql
 import fabtools.network
@@ -18,6 +19,7 @@ import fabtools.oracle_jdk
 import fabtools.pkg
 import fabtools.portage
 import fabtools.postgres
+import fabtools.probes
 import fabtools.python
 import fabtools.python_setuptools
 import fabtools.rpm
@@ -31,3 +33,5 @@ import fabtools.user
 
 import fabtools.require
 icanhaz = require
+
+from fabtools.probes import batch
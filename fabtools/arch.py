@@ -9,6 +9,7 @@ and repositories.
 
 from fabric.api import hide, run, settings
 
+from fabtools.inventory import Inventory
 from fabtools.utils import run_as_root
 
 
@@ -47,11 +48,24 @@ def upgrade():
     run_as_root("%(manager)s -Su" % locals(), pty=False)
 
 
+def _parse_pacman_inventory(output):
+    return set(line.split()[0] for line in output.splitlines() if line.strip())
+
+
+INVENTORY = Inventory('arch', 'pacman -Q', _parse_pacman_inventory)
+
+
 def is_installed(pkg_name):
     """
     Check if an Arch Linux package is installed.
+
+    The answer comes from the :py:class:`~fabtools.inventory.Inventory`
+    of the host, loaded once with ``pacman -Q``.
     """
+    return INVENTORY.is_installed(pkg_name, _is_installed)
+
 
+def _is_installed(pkg_name):
     with settings(
             hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
         res = run("pacman -Q %(pkg_name)s" % locals())
@@ -91,6 +105,7 @@ def install(packages, update=False, options=None):
     options = " ".join(options)
     cmd = '%(manager)s -S %(options)s %(packages)s' % locals()
     run_as_root(cmd, pty=False)
+    INVENTORY.add(packages)
 
 
 def uninstall(packages, options=None):
@@ -107,3 +122,4 @@ def uninstall(packages, options=None):
     options = " ".join(options)
     cmd = '%(manager)s -R %(options)s %(packages)s' % locals()
     run_as_root(cmd, pty=False)
+    INVENTORY.invalidate()
@@ -7,14 +7,21 @@ and repositories.
 
 """
 
+from pipes import quote
+import time
+
 from fabric.api import hide, run, settings
 
-from fabtools.utils import run_as_root
+from fabtools.utils import host_cache, run_as_root
 from fabtools.files import getmtime, is_file
+from fabtools.inventory import Inventory
+from fabtools.probes import probe
 
 
 MANAGER = 'DEBIAN_FRONTEND=noninteractive apt-get'
 
+UPDATE_STAMP = '/var/lib/apt/periodic/fabtools-update-success-stamp'
+
 
 def update_index(quiet=True):
     """
@@ -22,6 +29,7 @@ def update_index(quiet=True):
     """
     options = "--quiet --quiet" if quiet else ""
     run_as_root("%s %s update" % (MANAGER, options))
+    host_cache('deb.index')['updated'] = time.time()
 
 
 def upgrade(safe=True):
@@ -39,16 +47,92 @@ def upgrade(safe=True):
 def is_installed(pkg_name):
     """
     Check if a package is installed.
+
+    The answer comes from the :py:class:`~fabtools.inventory.Inventory`
+    of the host, loaded once with ``dpkg-query``.
     """
-    with settings(
-            hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
-        res = run("dpkg -s %(pkg_name)s" % locals())
-        for line in res.splitlines():
-            if line.startswith("Status: "):
-                status = line[8:]
-                if "installed" in status.split(' '):
-                    return True
-        return False
+    return INVENTORY.is_installed(pkg_name, _is_installed)
+
+
+def _is_installed(pkg_name):
+    return probe("dpkg -s %(pkg_name)s" % locals(), _parse_dpkg_status)
+
+
+def _parse_dpkg_status(output, return_code):
+    for line in output.splitlines():
+        if line.startswith("Status: "):
+            status = line[8:]
+            if "installed" in status.split(' '):
+                return True
+    return False
+
+
+def installed_status(pkg_names):
+    """
+    Get the status of several packages, with a single ``dpkg-query`` call.
+
+    Returns a dict with package name => (status, version), where *status*
+    is the ``dpkg`` state of the package (``installed``, ``config-files``,
+    ``not-installed``...), and *version* is ``None`` if the package is not
+    installed.
+
+    ::
+
+        import fabtools
+
+        status = fabtools.deb.installed_status(['curl', 'wget'])
+        if status['curl'][0] != 'installed':
+            ...
+
+    """
+    if isinstance(pkg_names, basestring):
+        pkg_names = [pkg_names]
+    pkg_names = list(pkg_names)
+    if not pkg_names:
+        return {}
+    return probe(
+        "echo native:$(dpkg --print-architecture); "
+        "dpkg-query -W -f='${binary:Package}\\t${Package}\\t${Architecture}\\t${Status}\\t${Version}\\n' %s" % (
+            ' '.join(quote(name) for name in pkg_names)),
+        lambda output, return_code: _parse_installed_status(output, pkg_names))
+
+
+def _parse_installed_status(output, pkg_names):
+    native = ''
+    known = {}
+    for line in output.splitlines():
+        line = line.strip('\r')
+        if line.startswith('native:'):
+            native = line[len('native:'):]
+            continue
+        fields = line.split('\t')
+        if len(fields) != 5:
+            continue  # "no packages found" message
+        binary_name, name, arch, status, version = fields
+        state = status.split(' ')[-1]
+        # Key each row on its full name, with and without the architecture
+        for key in set([binary_name, '%s:%s' % (name, arch)]):
+            if known.get(key, ('',))[0] != 'installed':
+                known[key] = (state, version if state == 'installed' else None)
+    status = {}
+    for name in pkg_names:
+        keys = [name] if ':' in name else [name, '%s:%s' % (name, native), '%s:all' % name]
+        status[name] = next((known[key] for key in keys if key in known),
+                            ('not-installed', None))
+    return status
+
+
+def _parse_dpkg_inventory(output):
+    installed = set()
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 4 and fields[3] == 'installed':
+            installed.add(fields[0])
+    return installed
+
+
+INVENTORY = Inventory('deb', "dpkg-query -W -f='${Package} ${Status}\\n'",
+                      _parse_dpkg_inventory)
 
 
 def install(packages, update=False, options=None, version=None):
@@ -60,6 +144,11 @@ def install(packages, update=False, options=None, version=None):
 
     Extra *options* may be passed to ``apt-get`` if necessary.
 
+    *packages* can be a dict of package name => version, to pin the
+    version of each package (``None`` means any version). They are all
+    installed or upgraded in a single ``apt-get`` transaction. The
+    *version* parameter cannot be used with a dict.
+
     Example::
 
         import fabtools
@@ -76,7 +165,16 @@ def install(packages, update=False, options=None, version=None):
         # Install a specific version
         fabtools.deb.install('emacs', version='23.3+1-1ubuntu9')
 
+        # Install specific versions of several packages at once
+        fabtools.deb.install({
+            'nginx': '1.10.3-0ubuntu0.16.04.2',
+            'nginx-common': '1.10.3-0ubuntu0.16.04.2',
+            'curl': None,
+        })
+
     """
+    if version and isinstance(packages, dict):
+        raise ValueError('version cannot be used with a dict of packages')
     manager = MANAGER
     if update:
         update_index()
@@ -86,13 +184,19 @@ def install(packages, update=False, options=None, version=None):
         version = ''
     if version and not isinstance(packages, list):
         version = '=' + version
-    if not isinstance(packages, basestring):
+    pkg_names = packages
+    if isinstance(packages, dict):
+        packages = " ".join(
+            '%s=%s' % (name, pkg_version) if pkg_version else name
+            for name, pkg_version in sorted(packages.items()))
+    elif not isinstance(packages, basestring):
         packages = " ".join(packages)
     options.append("--quiet")
     options.append("--assume-yes")
     options = " ".join(options)
     cmd = '%(manager)s install %(options)s %(packages)s%(version)s' % locals()
     run_as_root(cmd, pty=False)
+    INVENTORY.add(pkg_names)
 
 
 def uninstall(packages, purge=False, options=None):
@@ -114,6 +218,7 @@ def uninstall(packages, purge=False, options=None):
     options = " ".join(options)
     cmd = '%(manager)s %(command)s %(options)s %(packages)s' % locals()
     run_as_root(cmd, pty=False)
+    INVENTORY.invalidate()
 
 
 def preseed_package(pkg_name, preseed):
@@ -246,7 +351,6 @@ def last_update_time():
         # 1377603808.02
 
     """
-    STAMP = '/var/lib/apt/periodic/fabtools-update-success-stamp'
-    if not is_file(STAMP):
+    if not is_file(UPDATE_STAMP):
         return -1
-    return getmtime(STAMP)
+    return getmtime(UPDATE_STAMP)
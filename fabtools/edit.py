@@ -6,10 +6,18 @@ Tools for performing batch edits of files on the target system. Implemented usin
 """
 
 from pipes import quote
+from StringIO import StringIO
+from tempfile import mkstemp
+import hashlib
+import os
 import re
+import shutil
+import uuid
 from pathlib2 import Path
 from fabric.api import *
 
+from fabtools.files import write_atomic
+
 
 _IN_MEMORY = '1h;2,$H;$!d;g'  # sed magic to do in-memory processing for multi-line pattern search
 _END = 0
@@ -17,25 +25,27 @@ _DELIM_CHARS = {'@', '#', '/', '_', '~', '`'}  # chars for address pattern delim
 _REGEX_TYPE = type(re.compile('$'))
 
 
-def find(pat, files,  start=None, stop=None, multi_line=False, do_all=False, use_sudo=False):
+def find(pat, files,  start=None, stop=None, multi_line=False, do_all=False, per_file=False, use_sudo=False):
     """
     Locates line(s) that match the pattern. In multi-line mode the pattern may span lines with \n, but the
     value returned will always be the total number of lines in the file.
     :param pat: search pattern (line number, literal string or compiled regex)
-    :param files: files to search. Multiple files will be concatenated.
+    :param files: files to search. Multiple files will be concatenated, unless per_file is True.
     :param start: Limit processing to start at this pattern (line number, literal string or compiled regex)
     :param stop: Limit processing to stop at this pattern (line number, literal string or compiled regex)
     :param multi_line: treat entire file as one line so pattern may contain '\n'
     :param do_all: find all lines w/ pattern. No effect in multi_line mode.
+    :param per_file: search each file separately (still with a single remote command). Files may then contain
+    shell wildcards, e.g. '/etc/nginx/sites-enabled/*'
     :param use_sudo: True/False for use of sudo or specify run, sudo, or local from Fabric
-    :return: truthy list of line number(s) where pattern was found, falsey empty list if not found
+    :return: truthy list of line number(s) where pattern was found, falsey empty list if not found, or
+    a dict of such lists by file path if per_file is True
     """
-    op = '=' if do_all else '{=;q}'
-    cmd = '{sel}{op}'.format(
-        sel=_mk_selector(pat),
-        op=op)
-    lim_cmd = cmd if multi_line else _mk_limit_sed_cmd(cmd, start=start, stop=stop)
-    res = _run_func(use_sudo)(_mk_sed_call(lim_cmd, files, inmem=multi_line,  opts=['-n']))
+    if per_file:
+        outputs = _run_per_file(_find_call(pat, (), start=start, stop=stop, multi_line=multi_line, do_all=do_all),
+                                files, use_sudo)
+        return dict((path, [int(n) for n in res.split('\n')] if res else []) for path, res in outputs.items())
+    res = _run_func(use_sudo)(_find_call(pat, files, start=start, stop=stop, multi_line=multi_line, do_all=do_all))
     return [int(n) for n in res.split('\n')] if res else []
 
 
@@ -50,9 +60,10 @@ def append(text, files, pat=_END, start=None, stop=None, do_all=False, backup=No
     :param do_all: process all lines w/ pattern.
     :param backup: if specified then a backup file will be created with this suffix appended to the name
     :param use_sudo: True/False for use of sudo or specify run, sudo, or local from Fabric
+    :return: True if any of the files was modified
     """
-    _add_line('a', text, files, pat=(pat or _END), start=start, stop=stop, do_all=do_all, backup=backup,
-              use_sudo=use_sudo)
+    return _add_line('a', text, files, pat=(pat or _END), start=start, stop=stop, do_all=do_all, backup=backup,
+                     use_sudo=use_sudo)
 
 
 
@@ -68,8 +79,10 @@ def prepend(text, files, pat=1, start=None, stop=None, do_all=False, backup=None
     :param do_all: process all lines w/ pattern.
     :param backup: if specified then a backup file will be created with this suffix appended to the name
     :param use_sudo: True/False for use of sudo or specify run, sudo, or local from Fabric
+    :return: True if any of the files was modified
     """
-    _add_line('i', text, files, pat=(pat or 1), start=start, stop=stop, do_all=do_all, backup=backup, use_sudo=use_sudo)
+    return _add_line('i', text, files, pat=(pat or 1), start=start, stop=stop, do_all=do_all, backup=backup,
+                     use_sudo=use_sudo)
 
 
 def replace_line(pat, text, files, start=None, stop=None, do_all=False, backup=None, use_sudo=False):
@@ -80,11 +93,13 @@ def replace_line(pat, text, files, start=None, stop=None, do_all=False, backup=N
     :param files: files to search. Mulitple files will be processed separately.
     :param start: Limit processing to start at this pattern (line number, literal string or compiled regex)
     :param stop: Limit processing to stop at this pattern (line number, literal string or compiled regex)
-    :param do_all: process all lines w/ pattern.
+    :param do_all: no effect, every line w/ pattern is replaced.
     :param backup: if specified then a backup file will be created with this suffix appended to the name
     :param use_sudo: True/False for use of sudo or specify run, sudo, or local from Fabric
+    :return: True if any of the files was modified
     """
-    _add_line('c', text, files, pat=pat, start=start, stop=stop, do_all=do_all, backup=backup, use_sudo=use_sudo)
+    return _add_line('c', text, files, pat=pat, start=start, stop=stop, do_all=do_all, backup=backup,
+                     use_sudo=use_sudo)
 
 
 def delete(pat, files, start=None, stop=None, do_all=False, backup=None, use_sudo=False):
@@ -94,15 +109,13 @@ def delete(pat, files, start=None, stop=None, do_all=False, backup=None, use_sud
     :param files: files to process. Mulitple files will be processed separately.
     :param start: Limit processing to start at this pattern (line number, literal string or compiled regex)
     :param stop: Limit processing to stop at this pattern (line number, literal string or compiled regex)
-    :param do_all: process all lines w/ pattern.
+    :param do_all: no effect, every line w/ pattern is deleted.
     :param backup: if specified then a backup file will be created with this suffix appended to the name
     :param use_sudo: True/False for use of sudo or specify run, sudo, or local from Fabric
+    :return: True if any of the files was modified
     """
-    suffix = quote(backup) if backup else ''
-    cmd = "%sd" % (_mk_selector(pat),) if do_all else \
-           "%s{d; b L}; b; :L  {n; b L}" % (_mk_selector(pat),)
-    lim_cmd = _mk_limit_sed_cmd(cmd, start=start, stop=stop)
-    _run_func(use_sudo)(_mk_sed_call(lim_cmd, files, opts=['-i%s' % (suffix,)], do_all=do_all, use_sudo=use_sudo))
+    lim_cmd = _delete_cmd(pat, start=start, stop=stop, do_all=do_all)
+    return _edit_files(lim_cmd, files, backup=backup, use_sudo=use_sudo)
 
 
 def replace(pat, text, files, start=None, stop=None, do_all=False, backup=None, use_sudo=False):
@@ -118,42 +131,76 @@ def replace(pat, text, files, start=None, stop=None, do_all=False, backup=None,
     :param do_all: replace every occurrance of the pattern
     :param backup: if specified then a backup file will be created with this suffix appended to the name
     :param use_sudo: True/False for use of sudo or specify run, sudo, or local from Fabric
-    :return:
+    :return: True if any of the files was modified
     """
-    escaped_text = text.replace('\n', '\\n')
-    suffix = quote(backup) if backup else ''
+    lim_cmd = _replace_cmd(pat, text, start=start, stop=stop, do_all=do_all)
+    return _edit_files(lim_cmd, files, backup=backup, use_sudo=use_sudo)
 
-    if type(pat) is str:
-        sel = re.escape(pat)
-    elif type(pat) is _REGEX_TYPE:
-        sel = pat.pattern
-    else:
-        raise RuntimeError("Replace pattern must be string or regex, not %s" % str(pat))
 
-    cmd = "{addr}s{delim}{sel}{delim}{text}{delim}g".format(
-            addr=_mk_selector(pat), delim=_choose_delim(sel+text), sel=sel, text=escaped_text) if do_all \
-         else "{addr}{{s{delim}{sel}{delim}{text}{delim}; b L}}; b; :L  {{n; b L}}".format(
-            addr=_mk_selector(pat), delim=_choose_delim(sel + text), sel=sel, text=escaped_text)
-    lim_cmd = _mk_limit_sed_cmd(cmd, start=start, stop=stop)
-    _run_func(use_sudo)(_mk_sed_call(lim_cmd, files, opts=['-i%s' % (suffix,)],
-                                     do_all=do_all, use_sudo=use_sudo))
-
-
-def capture(pat, files, start=None, stop=None, multi_line=False, do_all=False, use_sudo=False):
+def insert_unless_found(text, path, unless=None, after=None, before=None, backup=None, lock=True,
+                        whole_lines=False, use_sudo=False):
+    """
+    Insert text in a file unless it is already there, or unless a pattern is matched, with a single remote
+    command. The text is searched for in the whole file, so it may span lines.
+    :param text: literal text to insert. May contain \n to insert multi-line block
+    :param path: file to process
+    :param unless: line number, literal string or compiled regex that if matched will prevent insertion
+    :param after: line number, literal string or compiled regex. The text is inserted after the first matching
+    line, or at end of file if not specified. Supersedes before.
+    :param before: line number, literal string or compiled regex. If after is not specified, the text is inserted
+    before the first matching line.
+    :param backup: if specified then a backup file will be created with this suffix appended to the name
+    :param lock: hold an flock(1) lock on the directory of the file (when available) between the checks and the
+    insertion, so that concurrent calls cannot insert the text twice
+    :param whole_lines: only consider the text already there if it fills whole lines, instead of being part of
+    a longer line
+    :param use_sudo: True/False for use of sudo or specify run, sudo, or local from Fabric
+    :return: True if the text was inserted
+    """
+    if after or not before:
+        insert_cmd = _add_line_cmd('a', text, pat=(after or _END), start=after, stop=before)
+    else:
+        insert_cmd = _add_line_cmd('i', text, pat=before, start=after, stop=before)
+
+    script = _target_script(path)
+    if lock:
+        # The file itself is replaced by a rename, so lock its directory
+        script += [
+            'exec 9<"$(dirname "$f")" || exit 1',
+            'if command -v flock >/dev/null 2>&1; then flock 9; fi',
+        ]
+    found = re.compile('(^|\\n)%s(\\n|$)' % re.escape(text)) if whole_lines else text
+    for pat in ([unless] if unless else []) + [found]:
+        script.append('if [ -n "$(%s)" ]; then echo found; exit 0; fi' % _find_call(pat, path, multi_line=True))
+    script += [
+        _MKTEMP,
+        # sed does not run its commands on an empty file, so write the text directly
+        'if [ -s "$f" ]; then %s "$f" > "$t"; else printf \'%%s\\n\' %s > "$t"; fi || { rm -f "$t"; exit 1; }'
+        % (_mk_sed_call(insert_cmd, ()), quote(text)),
+    ] + _write_back_script(backup) + ['echo inserted']
+    res = _run_func(use_sudo)('\n'.join(script))
+    return res.splitlines()[-1].strip() == 'inserted' if res else False
+
+
+def capture(pat, files, start=None, stop=None, multi_line=False, do_all=False, per_file=False, use_sudo=False):
     """
     Find and return the text selected by the pattern within start/stop limits
     :param pat: line number, literal string or compiled regex
-    :param files: files to process. Multiple files will be concatenated
+    :param files: files to process. Multiple files will be concatenated, unless per_file is True.
     :param start: Limit processing to start at this pattern (line number, literal string or compiled regex)
     :param stop: Limit processing to stop at this pattern (line number, literal string or compiled regex)
     :param multi_line: treat entire file as one line so pattern may contain '\n'
     :param do_all: find all lines w/ pattern. No effect in multi_line mode. [defaults to False, so only gets first]
+    :param per_file: process each file separately (still with a single remote command). Files may then contain
+    shell wildcards, e.g. '/etc/nginx/sites-enabled/*'
     :param use_sudo: True/False for use of sudo or specify run, sudo, or local from Fabric
-    :return: selected text
+    :return: selected text, or a dict of selected text by file path if per_file is True
     """
     op = 'p' if do_all else '{p;q}'
     cmd = '%s%s' % (_mk_selector(pat), op)
     lim_cmd = cmd if multi_line else _mk_limit_sed_cmd(cmd, start=start, stop=stop)
+    if per_file:
+        return _run_per_file(_mk_sed_call(lim_cmd, (), inmem=multi_line,  opts=['-n']), files, use_sudo)
     res = _run_func(use_sudo)(_mk_sed_call(lim_cmd, files, inmem=multi_line,  opts=['-n']))
     return res
 
@@ -172,20 +219,110 @@ def commented_out(pat, files, commented=True, comment_chars='#',
     :param use_sudo: True/False for use of sudo or specify run, sudo, or local from Fabric
     :param backup: If defined create backup file with value as filname extension
     :param use_sudo: Use sudo to process the file
+    :return: True if any of the files was modified
     """
-    assert isinstance(comment_chars, basestring) and len(comment_chars) > 0
-    suffix = quote(backup) if backup else ''
-    delim = _choose_delim(comment_chars)
-    if commented:
-        selector = re.sub(re.compile('^\\^+'), '', _mk_selector(pat))
-        sub_cmd = '{{\\{d}^[ \\t]*[^{cc}]+{d}s{d}^{d}{cc}{d}}}'.format (d=delim, cc=comment_chars)
-    else:
-        selector = _mk_selector(pat)
-        sub_cmd = '{{\\{d}^[ \\t]*[{cc}]+{d}s{d}^([ \\t]*)[{cc}]+{d}\\1{d}}}'.format(d=delim, cc=re.escape(comment_chars))
-    cmd = "%s%s" % (selector, sub_cmd) if do_all else \
-           "%s{%s; b L}; b; :L  {n; b L}" % (selector, sub_cmd)
-    lim_cmd = _mk_limit_sed_cmd(cmd, start=start, stop=stop)
-    _run_func(use_sudo)(_mk_sed_call(lim_cmd, files, opts=['-i%s' % suffix],  do_all=do_all, use_sudo=use_sudo))
+    lim_cmd = _commented_out_cmd(pat, commented=commented, comment_chars=comment_chars,
+                                 start=start, stop=stop, do_all=do_all)
+    return _edit_files(lim_cmd, files, backup=backup, use_sudo=use_sudo)
+
+
+class transaction(object):
+    """
+    Context manager to apply several edits to a file with a single remote command.
+
+    Edits are queued by calling the methods of the transaction object, which mirror the functions of this
+    module. They are applied in order when the block ends, as a pipeline of sed commands that reads the file
+    once. The file is only replaced (atomically, keeping its owner and mode) if its contents changed::
+
+        from fabtools import edit
+
+        with edit.transaction('/etc/ssh/sshd_config', use_sudo=True) as t:
+            t.replace_line(re.compile('^#?PasswordAuthentication '), 'PasswordAuthentication no')
+            t.commented_out('PermitRootLogin yes')
+
+        if t.changed:
+            ...
+
+    With ``engine='python'``, the file is instead downloaded once, edited in memory using Python regular
+    expressions (so patterns may span lines, and there are no sed portability issues), and written back
+    atomically if it changed (see :py:func:`fabtools.files.write_atomic`). The write is refused if the remote
+    file was modified in the meantime.
+
+    :param path: file to edit
+    :param backup: if specified then a backup file will be created with this suffix appended to the name
+    :param use_sudo: True/False for use of sudo or specify run, sudo, or local from Fabric
+    :param engine: 'sed' (default) or 'python'
+    """
+
+    def __init__(self, path, backup=None, use_sudo=False, engine='sed'):
+        if engine not in ('sed', 'python'):
+            raise ValueError('Unknown edit engine: %s' % engine)
+        self.path = path
+        self.backup = backup
+        self.use_sudo = use_sudo
+        self.engine = engine
+        self.operations = []
+        self.changed = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        if type is None:
+            self.commit()
+
+    def append(self, text, pat=_END, start=None, stop=None, do_all=False):
+        """
+        Queue an :py:func:`append` operation
+        """
+        self.operations.append(('a', text, pat or _END, start, stop, do_all))
+
+    def prepend(self, text, pat=1, start=None, stop=None, do_all=False):
+        """
+        Queue a :py:func:`prepend` operation
+        """
+        self.operations.append(('i', text, pat or 1, start, stop, do_all))
+
+    def replace_line(self, pat, text, start=None, stop=None, do_all=False):
+        """
+        Queue a :py:func:`replace_line` operation
+        """
+        self.operations.append(('c', text, pat, start, stop, do_all))
+
+    def delete(self, pat, start=None, stop=None, do_all=False):
+        """
+        Queue a :py:func:`delete` operation
+        """
+        self.operations.append(('d', None, pat, start, stop, do_all))
+
+    def replace(self, pat, text, start=None, stop=None, do_all=False):
+        """
+        Queue a :py:func:`replace` operation
+        """
+        self.operations.append(('s', text, pat, start, stop, do_all))
+
+    def commented_out(self, pat, commented=True, comment_chars='#', start=None, stop=None, do_all=False):
+        """
+        Queue a :py:func:`commented_out` operation
+        """
+        assert isinstance(comment_chars, basestring) and len(comment_chars) > 0
+        self.operations.append(('#' if commented else '!#', comment_chars, pat, start, stop, do_all))
+
+    def commit(self):
+        """
+        Apply the queued edits
+        :return: True if the file was modified
+        """
+        operations, self.operations = self.operations, []
+        if not operations:
+            self.changed = False
+        elif self.engine == 'python':
+            self.changed = _python_transaction(operations, self.path, self.backup, self.use_sudo)
+        else:
+            commands = [_sed_cmd(*operation) for operation in operations]
+            res = _run_func(self.use_sudo)(_mk_transaction_script(commands, self.path, self.backup))
+            self.changed = res.splitlines()[-1].strip() == 'changed' if res else False
+        return self.changed
 
 
 ####### Internal functions ###########
@@ -299,14 +436,319 @@ def _add_line(op, text, files, pat=_END, start=None, stop=None, do_all=False, ba
     :param bak: if not empty then a backup file will be created with this extension or per sed -i backup rules.
     :param do_all: prepend text before every occurrance of the pattern
     :param use_sudo: True/False for use of sudo or specify run, sudo, or local from Fabric
-    :return:
+    :return: True if any of the files was modified
+    """
+    lim_cmd = _add_line_cmd(op, text, pat=pat, start=start, stop=stop, do_all=do_all)
+    return _edit_files(lim_cmd, files, backup=backup, use_sudo=use_sudo)
+
+
+def _edit_files(cmd, files, backup=None, use_sudo=False):
+    """
+    Apply a sed command to each file separately, in a single remote command. A file is only rewritten (keeping
+    its owner and mode) if its contents changed, and the backup is only created in that case.
+    :param cmd: sed command
+    :param files: files to process, separately and in-place
+    :param backup: if specified then a backup file will be created with this suffix appended to the name
+    :param use_sudo: True/False for use of sudo or specify run, sudo, or local from Fabric
+    :return: True if any of the files was modified
+    """
+    files = (files,) if isinstance(files, basestring) or isinstance(files, Path) else files
+    script = ['rc=0'] + ['(%s) || rc=1' % _mk_transaction_script([cmd], path, backup) for path in files]
+    res = _run_func(use_sudo)('\n'.join(script + ['exit $rc']))
+    return 'changed' in [line.strip() for line in res.splitlines()]
+
+
+def _run_per_file(sed_call, files, use_sudo=False):
+    """
+    Run a sed call on each file separately, in a single remote command
+    :param sed_call: sed call without file arguments
+    :param files: files to process, which may contain shell wildcards. Aborts if a file without wildcards is missing.
+    :param use_sudo: True/False for use of sudo or specify run, sudo, or local from Fabric
+    :return: dict of sed output by file path
+    """
+    files = (files,) if isinstance(files, basestring) or isinstance(files, Path) else files
+    marker = 'fabtools-file-%s' % uuid.uuid4().hex
+    res = _run_func(use_sudo)(
+        'for f in %s; do if [ -f "$f" ]; then echo "%s $f"; %s "$f"; else echo "%s-missing $f"; fi; done' % (
+            ' '.join(_quote_glob(str(x)) for x in files), marker, sed_call, marker))
+    outputs = {}
+    missing = []
+    lines = None
+    for line in res.splitlines():
+        line = line.rstrip('\r')
+        if line.startswith(marker + ' '):
+            lines = outputs[line[len(marker) + 1:]] = []
+        elif line.startswith(marker + '-missing '):
+            lines = None
+            missing.append(line[len(marker) + 9:])
+        elif lines is not None:
+            lines.append(line)
+    # A wildcard that matches nothing is left as is by the shell, but a file that was named explicitly must exist
+    missing = [path for path in missing if not re.search(r'[*?\[]', path)]
+    if missing:
+        abort('No such file: %s' % ', '.join(missing))
+    return dict((path, '\n'.join(lines)) for path, lines in outputs.items())
+
+
+def _quote_glob(path):
+    """
+    Quote a path for the shell, leaving wildcard characters active
+    """
+    return re.sub(r'([^\w/.*?\[\]-])', r'\\\1', path)
+
+
+def _find_call(pat, files, start=None, stop=None, multi_line=False, do_all=False):
+    """
+    Create the sed call printing the line number(s) where the pattern is found
+    """
+    op = '=' if do_all else '{=;q}'
+    cmd = '{sel}{op}'.format(
+        sel=_mk_selector(pat),
+        op=op)
+    lim_cmd = cmd if multi_line else _mk_limit_sed_cmd(cmd, start=start, stop=stop)
+    return _mk_sed_call(lim_cmd, files, inmem=multi_line,  opts=['-n'])
+
+
+def _add_line_cmd(op, text, pat=_END, start=None, stop=None, do_all=False):
+    """
+    Make the sed command for a line-oriented edit operation (a, i, or c)
     """
     assert op in list('aic')
     escaped_text = text.replace('\n', '\\n')
-    suffix = quote(backup) if backup else ''
     cmd = "%s%s \\\n%s\n" % (_mk_selector(pat), op, escaped_text) if do_all else \
            "%s{%s \\\n%s\n; b L}; b; :L  {n; b L}" % (_mk_selector(pat), op, escaped_text)
-    lim_cmd = _mk_limit_sed_cmd(cmd, start=start, stop=stop)
-    _run_func(use_sudo)(_mk_sed_call(lim_cmd, files, opts=['-i%s' % suffix],  do_all=do_all, use_sudo=use_sudo))
+    return _mk_limit_sed_cmd(cmd, start=start, stop=stop)
+
+
+def _delete_cmd(pat, start=None, stop=None, do_all=False):
+    """
+    Make the sed command to delete lines that match the pattern
+    """
+    cmd = "%sd" % (_mk_selector(pat),) if do_all else \
+           "%s{d; b L}; b; :L  {n; b L}" % (_mk_selector(pat),)
+    return _mk_limit_sed_cmd(cmd, start=start, stop=stop)
+
+
+def _replace_cmd(pat, text, start=None, stop=None, do_all=False):
+    """
+    Make the sed command to replace the text matching the pattern
+    """
+    escaped_text = text.replace('\n', '\\n')
+
+    if type(pat) is str:
+        sel = re.escape(pat)
+    elif type(pat) is _REGEX_TYPE:
+        sel = pat.pattern
+    else:
+        raise RuntimeError("Replace pattern must be string or regex, not %s" % str(pat))
+
+    cmd = "{addr}s{delim}{sel}{delim}{text}{delim}g".format(
+            addr=_mk_selector(pat), delim=_choose_delim(sel+text), sel=sel, text=escaped_text) if do_all \
+         else "{addr}{{s{delim}{sel}{delim}{text}{delim}; b L}}; b; :L  {{n; b L}}".format(
+            addr=_mk_selector(pat), delim=_choose_delim(sel + text), sel=sel, text=escaped_text)
+    return _mk_limit_sed_cmd(cmd, start=start, stop=stop)
+
+
+def _commented_out_cmd(pat, commented=True, comment_chars='#', start=None, stop=None, do_all=False):
+    """
+    Make the sed command to comment out or uncomment lines
+    """
+    assert isinstance(comment_chars, basestring) and len(comment_chars) > 0
+    delim = _choose_delim(comment_chars)
+    if commented:
+        selector = re.sub(re.compile('^\\^+'), '', _mk_selector(pat))
+        sub_cmd = '{{\\{d}^[ \\t]*[^{cc}]+{d}s{d}^{d}{cc}{d}}}'.format (d=delim, cc=comment_chars)
+    else:
+        selector = _mk_selector(pat)
+        sub_cmd = '{{\\{d}^[ \\t]*[{cc}]+{d}s{d}^([ \\t]*)[{cc}]+{d}\\1{d}}}'.format(d=delim, cc=re.escape(comment_chars))
+    cmd = "%s%s" % (selector, sub_cmd) if do_all else \
+           "%s{%s; b L}; b; :L  {n; b L}" % (selector, sub_cmd)
+    return _mk_limit_sed_cmd(cmd, start=start, stop=stop)
+
+
+def _mk_transaction_script(commands, path, backup=None):
+    """
+    Create the shell script applying a list of sed commands to a file in a single pass. The commands are
+    chained in a pipeline, as the first-match-only commands cannot be merged in a single sed program. The
+    file is only rewritten if the result differs, and the script prints 'changed' or 'unchanged'.
+    :param commands: sed commands to apply, in order
+    :param path: target file path
+    :param backup: if specified then a backup file will be created with this suffix appended to the name
+    :return: shell script
+    """
+    # A failure of any sed process must not replace the file
+    stages = ['{ %s%s || touch "$t.failed"; }' % (_mk_sed_call(cmd, ()), ' "$f"' if i == 0 else '')
+              for i, cmd in enumerate(commands)]
+    return '\n'.join(_target_script(path) + [
+        _MKTEMP,
+        '%s > "$t"' % ' | '.join(stages),
+        'if [ -e "$t.failed" ]; then rm -f "$t" "$t.failed"; exit 1; fi',
+        'if cmp -s "$t" "$f"; then rm -f "$t"; echo unchanged; exit 0; fi',
+    ] + _write_back_script(backup) + ['echo changed'])
 
 
+# Temporary file next to the target, so that it can be renamed over it
+_MKTEMP = 't=$(mktemp "$(dirname "$f")/.fabtools-XXXXXX") || exit 1'
+
+
+def _target_script(path):
+    """
+    Shell lines setting $f to the file to edit, following symbolic links so that they are kept
+    """
+    return [
+        'f=%s' % quote(str(path)),
+        'if [ -L "$f" ]; then f=$(readlink -f "$f") || exit 1; fi',
+    ]
+
+
+def _write_back_script(backup=None):
+    """
+    Shell lines replacing $f with the temporary file $t atomically, with the owner and mode of $f, so that
+    readers never see a partly written file
+    :param backup: if specified then a backup file will be created with this suffix appended to the name
+    """
+    return (['cp -p "$f" "$f"%s || { rm -f "$t"; exit 1; }' % quote(backup)] if backup else []) + [
+        '{ chown --reference="$f" "$t" && chmod --reference="$f" "$t"; } 2>/dev/null ||'
+        ' { chown "$(stat -f %u:%g "$f")" "$t" && chmod "$(stat -f %Lp "$f")" "$t"; } ||'
+        ' { rm -f "$t"; exit 1; }',
+        'mv -f "$t" "$f" || { rm -f "$t"; exit 1; }',
+    ]
+
+
+def _sed_cmd(op, text, pat, start, stop, do_all):
+    """
+    Make the sed command for a queued transaction operation
+    """
+    if op in ('a', 'i', 'c'):
+        return _add_line_cmd(op, text, pat=pat, start=start, stop=stop, do_all=do_all)
+    elif op == 'd':
+        return _delete_cmd(pat, start=start, stop=stop, do_all=do_all)
+    elif op == 's':
+        return _replace_cmd(pat, text, start=start, stop=stop, do_all=do_all)
+    else:
+        return _commented_out_cmd(pat, commented=(op == '#'), comment_chars=text,
+                                  start=start, stop=stop, do_all=do_all)
+
+
+def _python_transaction(operations, path, backup=None, use_sudo=False):
+    """
+    Apply transaction operations to a file with the Python engine: fetch it, edit it in memory, and write it
+    back atomically if it changed.
+    :return: True if the file was modified
+    """
+    path = str(path)
+    if use_sudo is local:
+        with open(path) as f:
+            contents = f.read()
+    else:
+        buf = StringIO()
+        with settings(hide('running')):
+            get(path, buf, use_sudo=(use_sudo is True or use_sudo is sudo))
+        contents = buf.getvalue()
+
+    new_contents = _python_edit(contents, operations)
+    if new_contents == contents:
+        return False
+
+    if use_sudo is local:
+        if backup:
+            shutil.copy2(path, path + backup)
+        fd, tmp_path = mkstemp(dir=os.path.dirname(path) or '.')
+        with os.fdopen(fd, 'w') as f:
+            f.write(new_contents)
+        shutil.copymode(path, tmp_path)
+        os.rename(tmp_path, path)
+    else:
+        write_atomic(path, new_contents, digest=hashlib.md5(contents).hexdigest(), backup=backup,
+                     use_sudo=(use_sudo is True or use_sudo is sudo))
+    return True
+
+
+def _python_edit(contents, operations):
+    """
+    Apply transaction operations to the contents of a file, with the same semantics as the sed commands
+    :return: new contents
+    """
+    lines = contents.split('\n')
+    final_newline = lines[-1] == ''
+    if final_newline:
+        lines.pop()
+    for op, text, pat, start, stop, do_all in operations:
+        lines = _python_op(lines, op, text, pat, start, stop, do_all)
+    return '\n'.join(lines) + ('\n' if final_newline and lines else '')
+
+
+def _python_op(lines, op, text, pat, start, stop, do_all):
+    """
+    Apply a single operation to a list of lines. As with sed, where the 'c' and 'd' commands end the cycle
+    before the first-match-only branch, replace_line and delete always process every matching line.
+    :return: new list of lines
+    """
+    in_range = _python_range(lines, start, stop)
+    result = []
+    done = False
+    for n, line in enumerate(lines, 1):
+        if done or not in_range[n - 1] or not _python_match(pat, n, line, len(lines)):
+            result.append(line)
+            continue
+        done = not do_all and op not in ('c', 'd')
+        if op == 'a':
+            result.extend([line] + text.split('\n'))
+        elif op == 'i':
+            result.extend(text.split('\n') + [line])
+        elif op == 'c':
+            result.extend(text.split('\n'))
+        elif op == 'd':
+            pass
+        elif op == 's':
+            regex = pat.pattern if type(pat) is _REGEX_TYPE else re.escape(pat)
+            result.extend(re.sub(regex, _python_repl(text), line, count=0 if do_all else 1).split('\n'))
+        elif op == '#':
+            result.append(line if re.match('[ \t]*[%s]' % re.escape(text), line) or not line.strip()
+                          else text + line)
+        else:
+            result.append(re.sub('^([ \t]*)[%s]+' % re.escape(text), '\\1', line))
+    return result
+
+
+def _python_repl(text):
+    """
+    Convert a sed replacement to a Python one: '&' is the whole match, and '\&' a literal '&'
+    """
+    return re.sub(r'\\.|&', lambda m: {'&': r'\g<0>', '\\&': '&'}.get(m.group(), m.group()), text)
+
+
+def _python_range(lines, start=None, stop=None):
+    """
+    Emulate a sed 'start,stop' address range
+    :return: list of booleans telling whether each line is in the range
+    """
+    start = start or 1
+    in_range = []
+    active = False
+    for n, line in enumerate(lines, 1):
+        if active:
+            in_range.append(True)
+            active = not _python_match(stop or _END, n, line, len(lines))
+        elif _python_match(start, n, line, len(lines)):
+            in_range.append(True)
+            # A line number that is already reached ends the range at once
+            active = not (type(stop) is int and 0 < stop <= n) and \
+                not (stop in (None, _END) and n == len(lines))
+        else:
+            in_range.append(False)
+    return in_range
+
+
+def _python_match(pat, n, line, last):
+    """
+    Check whether a line matches a pattern (line number, literal string or compiled regex)
+    """
+    if type(pat) is int:
+        return n == pat if pat > 0 else n == last
+    elif type(pat) is _REGEX_TYPE:
+        return pat.search(line) is not None
+    elif isinstance(pat, basestring):
+        return pat in line
+    else:
+        raise TypeError('Illegal type for pattern %s' % str(type(pat)))
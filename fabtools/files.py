@@ -3,100 +3,388 @@ Files and directories
 =====================
 """
 
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 from pipes import quote
+from StringIO import StringIO
+from tempfile import mkstemp
+import atexit
+import hashlib
+import json
 import os
+import posixpath
+import re
+import threading
+import time as _time
+import uuid
+import zlib
 
 from fabric.api import (
     abort,
     env,
     hide,
+    put,
     run,
     settings,
     sudo,
     warn,
 )
-from fabric.contrib.files import upload_template as _upload_template
-from fabric.contrib.files import exists
+from fabric.state import connections
+from fabric.utils import apply_lcwd
 
-from fabtools.utils import run_as_root
+from fabtools.probes import batch, probe
+from fabtools.utils import host_cache, run_as_root
+
+
+BLOCKSIZE = 2 ** 20  # 1MB
+
+FileStat = namedtuple('FileStat', 'type is_link owner group mode mtime size inode')
+
+
+def stat_many(paths, use_sudo=False):
+    """
+    Get information about many files and directories at once.
+
+    A single remote command is used, whatever the number of *paths*.
+    Returns a dictionary mapping each path to a ``FileStat`` record
+    with the following fields:
+
+    - ``type``: ``'file'``, ``'dir'`` or ``'other'`` (symbolic links are
+      followed, ``None`` for a broken link)
+    - ``is_link``: ``True`` if the path is a symbolic link
+    - ``owner``, ``group``: owner and group names
+    - ``mode``: permissions, as an octal string such as ``'755'``
+    - ``mtime``: time of last modification (in seconds since the Epoch)
+    - ``size``: size in bytes
+    - ``inode``: inode number
+
+    The path maps to ``None`` if it does not exist.
+
+    Both GNU and BSD versions of ``stat`` are supported. The version
+    is detected once per host.
+
+    ::
+
+        from fabtools.files import stat_many
+
+        for path, st in stat_many(['/etc/hosts', '/etc/passwd']).items():
+            print(path, st.owner, st.mode)
+
+    """
+    return _stat_probe(paths, use_sudo, lambda records: records)
+
+
+_STAT_FORMATS = {
+    'gnu': "stat -c '%U %G %a %Y %s %i'",
+    'bsd': "stat -f '%Su %Sg %Lp %m %z %i'",
+}
+
+
+def _stat_probe(paths, use_sudo, transform):
+    """
+    Run ``stat`` on *paths*, and apply *transform* to the records
+    """
+    paths = list(paths)
+    if not paths:
+        return transform({})
+
+    flavor = host_cache('files.stat').get('flavor')
+    setup, body = _stat_script(paths, flavor)
+
+    def parse(output, return_code):
+        # Ignore any noise printed by the login shell
+        lines = output.splitlines()
+        head, lines = lines[:-len(paths)], lines[-len(paths):]
+        _parse_stat_flavor(head, flavor)
+        return transform(dict(zip(paths, map(_parse_stat, lines))))
+
+    return probe('\n'.join(setup + body), parse, use_sudo)
+
+
+def _stat_script(paths, flavor):
+    """
+    Shell script printing one line of information per path
+
+    Returns the setup and body parts of the script. If the ``stat``
+    flavor is not known yet, the setup part detects and prints it
+    (see :py:func:`_parse_stat_flavor`).
+    """
+    if flavor is None:
+        setup = [
+            'if stat -c %U / >/dev/null 2>&1; then',
+            '    echo gnu; st() { %s "$@"; }' % _STAT_FORMATS['gnu'],
+            'else',
+            '    echo bsd; st() { %s "$@"; }' % _STAT_FORMATS['bsd'],
+            'fi',
+        ]
+    else:
+        setup = ['st() { %s "$@"; }' % _STAT_FORMATS[flavor]]
+    body = [
+        'for p in %s; do' % ' '.join(quote(path) for path in paths),
+        '    if [ -L "$p" ]; then l=1; else l=0; fi',
+        '    if [ -d "$p" ]; then t=dir; elif [ -f "$p" ]; then t=file;'
+        ' elif [ -e "$p" ]; then t=other; else t=-; fi',
+        '    echo "$t $l $(st "$p" 2>/dev/null)"',
+        'done',
+    ]
+    return setup, body
+
+
+def _parse_stat_flavor(lines, flavor):
+    if flavor is None:
+        flavors = [line.strip() for line in lines if line.strip() in _STAT_FORMATS]
+        host_cache('files.stat')['flavor'] = flavors[-1]
+
+
+def _parse_stat(line):
+    fields = line.split()
+    type_, is_link, details = fields[0], fields[1] == '1', fields[2:]
+    if type_ == '-' and not is_link:
+        return None
+    if len(details) != 6:
+        details = [None] * 6
+    owner, group, mode, mtime, size, inode = details
+    return FileStat(
+        type=type_ if type_ != '-' else None,
+        is_link=is_link,
+        owner=owner,
+        group=group,
+        mode=mode,
+        mtime=int(mtime) if mtime is not None else None,
+        size=int(size) if size is not None else None,
+        inode=int(inode) if inode is not None else None,
+    )
+
+
+def _stat_field(path, field):
+    def transform(records):
+        record = records[path]
+        return getattr(record, field) if record is not None else None
+    return transform
+
+
+def _stat_test(path, test):
+    def transform(records):
+        record = records[path]
+        return record is not None and test(record)
+    return transform
 
 
 def is_file(path, use_sudo=False):
     """
     Check if a path exists, and is a file.
     """
-    func = use_sudo and run_as_root or run
-    with settings(hide('running', 'warnings'), warn_only=True):
-        return func('[ -f "%(path)s" ]' % locals()).succeeded
+    return _stat_probe([path], use_sudo, _stat_test(path, lambda st: st.type == 'file'))
 
 
 def is_dir(path, use_sudo=False):
     """
     Check if a path exists, and is a directory.
     """
-    func = use_sudo and run_as_root or run
-    with settings(hide('running', 'warnings'), warn_only=True):
-        return func('[ -d "%(path)s" ]' % locals()).succeeded
+    return _stat_probe([path], use_sudo, _stat_test(path, lambda st: st.type == 'dir'))
 
 
 def is_link(path, use_sudo=False):
     """
     Check if a path exists, and is a symbolic link.
     """
-    func = use_sudo and run_as_root or run
-    with settings(hide('running', 'warnings'), warn_only=True):
-        return func('[ -L "%(path)s" ]' % locals()).succeeded
+    return _stat_probe([path], use_sudo, _stat_test(path, lambda st: st.is_link))
 
 
 def owner(path, use_sudo=False):
     """
     Get the owner name of a file or directory.
     """
-    func = use_sudo and run_as_root or run
-    # I'd prefer to use quiet=True, but that's not supported with older
-    # versions of Fabric.
-    with settings(hide('running', 'stdout'), warn_only=True):
-        result = func('stat -c %%U "%(path)s"' % locals())
-        if result.failed and 'stat: illegal option' in result:
-            # Try the BSD version of stat
-            return func('stat -f %%Su "%(path)s"' % locals())
-        else:
-            return result
+    return _stat_probe([path], use_sudo, _stat_field(path, 'owner'))
 
 
 def group(path, use_sudo=False):
     """
     Get the group name of a file or directory.
     """
-    func = use_sudo and run_as_root or run
-    # I'd prefer to use quiet=True, but that's not supported with older
-    # versions of Fabric.
-    with settings(hide('running', 'stdout'), warn_only=True):
-        result = func('stat -c %%G "%(path)s"' % locals())
-        if result.failed and 'stat: illegal option' in result:
-            # Try the BSD version of stat
-            return func('stat -f %%Sg "%(path)s"' % locals())
-        else:
-            return result
+    return _stat_probe([path], use_sudo, _stat_field(path, 'group'))
 
 
 def mode(path, use_sudo=False):
     """
     Get the mode (permissions) of a file or directory.
 
-    Returns a string such as ``'0755'``, representing permissions as
+    Returns a string such as ``'755'``, representing permissions as
     an octal number.
     """
+    return _stat_probe([path], use_sudo, _stat_field(path, 'mode'))
+
+
+FileState = namedtuple('FileState', 'stat umask digest from_manifest')
+FileState.__new__.__defaults__ = (False,)
+
+
+def file_state(path, use_sudo=False, digest=True, algo='md5', manifest=False):
+    """
+    Get the state of a remote file in a single remote command.
+
+    Returns a ``FileState`` record with the following fields:
+
+    - ``stat``: the ``FileStat`` record for the path, as returned by
+      :py:func:`~fabtools.files.stat_many` (``None`` if it does not exist)
+    - ``umask``: the user's umask (root's umask if *use_sudo* is ``True``)
+    - ``digest``: the checksum of the file using *algo* (see
+      :py:func:`~fabtools.files.checksum`) if *digest* is ``True``
+      and the path is a file, else ``None``
+    - ``from_manifest``: ``True`` if the digest was read from the
+      remote manifest instead of being computed
+
+    If *manifest* is ``True``, the digest recorded in the remote manifest
+    (see :py:func:`~fabtools.files.manifest_record`) is trusted as long
+    as the size, modification time and inode of the file are unchanged,
+    so that the file is only read when it may have changed.
+
+    """
+    flavor = host_cache('files.stat').get('flavor')
+    tool = host_cache('files.checksum').get(algo)
+    stat_setup, stat_body = _stat_script([path], flavor)
+    if digest:
+        checksum_setup, checksum_body = _checksum_script([path], algo, tool)
+        if manifest:
+            checksum_body = _manifest_lookup(path, algo, use_sudo, checksum_body)
+    else:
+        checksum_setup, checksum_body = [], ['echo -']
+    script = stat_setup + checksum_setup + stat_body + ['umask'] + checksum_body
+
+    def parse(output, return_code):
+        # Ignore any noise printed by the login shell
+        lines = output.splitlines()
+        head, (stat, mask, checksum) = lines[:-3], lines[-3:]
+        _parse_stat_flavor(head, flavor)
+        if digest:
+            _parse_checksum_tool(head, algo, tool)
+        checksum = checksum.strip()
+        from_manifest = checksum.startswith('manifest:')
+        if from_manifest:
+            checksum = checksum[len('manifest:'):]
+        return FileState(
+            stat=_parse_stat(stat),
+            umask=mask.strip(),
+            digest=_parse_checksum(checksum),
+            from_manifest=from_manifest,
+        )
+
+    return probe('\n'.join(script), parse, use_sudo)
+
+
+# Remote manifest of file digests, one entry per file
+MANIFEST_DIRS = {
+    False: '$HOME/.fabtools/manifest',
+    True: '/var/lib/fabtools/manifest',
+}
+
+
+def _manifest_entry(path, algo, use_sudo):
+    """
+    Path of the remote manifest entry for a file (for use in double quotes)
+    """
+    directory = env.get('manifest_dir') or MANIFEST_DIRS[bool(use_sudo)]
+    full_path = os.path.join(env.cwd, path) if env.cwd else path
+    key = hashlib.md5('%s:%s' % (algo, full_path)).hexdigest()
+    return directory, '%s/%s' % (directory, key)
+
+
+def _manifest_lookup(path, algo, use_sudo, checksum_body):
+    """
+    Shell script printing the recorded digest of a file if its entry in
+    the manifest is still valid, else running *checksum_body*
+
+    The ``st`` function must be defined (see :py:func:`_stat_script`).
+    """
+    _, entry = _manifest_entry(path, algo, use_sudo)
+    return [
+        'p=%s' % quote(path),
+        'if [ -f "$p" ] && read md mt 2>/dev/null < "%s" &&'
+        ' [ "$mt" = "$(st "$p" 2>/dev/null | cut -d" " -f4-6)" ]; then' % entry,
+        '    echo "manifest:$md"',
+        'else',
+    ] + ['    ' + line for line in checksum_body] + ['fi']
+
+
+def manifest_record(path, digest, algo='md5', use_sudo=False):
+    """
+    Shell command recording the digest of a remote file in the manifest.
+
+    The entry holds the digest along with the current size, modification
+    time and inode of the file. It is used by
+    :py:func:`~fabtools.files.file_state` to skip hashing files that have
+    not changed since.
+
+    The manifest is stored in ``/var/lib/fabtools/manifest`` when
+    *use_sudo* is ``True``, and in ``~/.fabtools/manifest`` otherwise.
+    Use ``env.manifest_dir`` to choose another location.
+
+    .. note:: The manifest cannot detect a change that preserves the size,
+              modification time (to the second) and inode of a file.
+
+    """
+    flavor = host_cache('files.stat').get('flavor') or 'gnu'
+    directory, entry = _manifest_entry(path, algo, use_sudo)
+    return 'mkdir -p "%(directory)s" && echo "%(digest)s $(%(stat)s %(path)s | cut -d" " -f4-6)" > "%(entry)s"' % {
+        'directory': directory,
+        'digest': digest,
+        'stat': _STAT_FORMATS[flavor],
+        'path': quote(path),
+        'entry': entry,
+    }
+
+
+def write_atomic(path, contents, digest=None, algo='md5', backup=None,
+                 use_sudo=False, temp_dir='/tmp'):
+    """
+    Atomically replace the contents of an existing remote file.
+
+    The new *contents* are uploaded next to the file, given the same
+    owner, group and mode, then renamed over it.
+
+    If *digest* is given, the file is only replaced if its checksum
+    (using *algo*) still matches, so that a concurrent modification
+    of the file is not silently lost. Fabric's ``abort`` is called
+    otherwise.
+
+    If *backup* is given, a copy of the previous file is kept with
+    this suffix appended to its name.
+    """
     func = use_sudo and run_as_root or run
-    # I'd prefer to use quiet=True, but that's not supported with older
-    # versions of Fabric.
+    new_path = '%s.fabtools-%s' % (path, uuid.uuid4().hex[:8])
+    with settings(hide('running')):
+        put(StringIO(contents), new_path, use_sudo=use_sudo, temp_dir=temp_dir)
+
+    flavor = host_cache('files.stat').get('flavor')
+    tool = host_cache('files.checksum').get(algo)
+    stat_setup, _ = _stat_script([], flavor)
+    script = stat_setup + [
+        'f=%s' % quote(path),
+        'n=%s' % quote(new_path),
+        'trap \'rm -f "$n"\' EXIT',
+    ]
+    if digest:
+        checksum_setup, _ = _checksum_script([], algo, tool)
+        script += checksum_setup + [
+            '[ -n "$ht" ] || exit 4',
+            'h=$($ht "$f") && [ "${h%%%% *}" = %s ] || exit 3' % quote(digest),
+        ]
+    if backup:
+        script.append('cp -p "$f" "$f"%s || exit 1' % quote(backup))
+    script.append('set -- $(st "$f") && chown "$1:$2" "$n" && chmod "$3" "$n" && mv -f "$n" "$f"')
+
     with settings(hide('running', 'stdout'), warn_only=True):
-        result = func('stat -c %%a "%(path)s"' % locals())
-        if result.failed and 'stat: illegal option' in result:
-            # Try the BSD version of stat
-            return func('stat -f %%Op "%(path)s"|cut -c 4-6' % locals())
-        else:
-            return result
+        res = func('\n'.join(script))
+    if res.return_code == 3:
+        abort('%s was modified by someone else, not replacing it' % path)
+    elif res.return_code == 4:
+        abort('No %s utility was found on this system.' % algo.upper())
+    elif res.failed:
+        abort('Could not replace %s:\n%s' % (path, res))
+    lines = res.splitlines()
+    _parse_stat_flavor(lines, flavor)
+    if digest:
+        _parse_checksum_tool(lines, algo, tool)
 
 
 def umask(use_sudo=False):
@@ -115,84 +403,647 @@ def umask(use_sudo=False):
 def upload_template(filename, destination, context=None, use_jinja=False,
                     template_dir=None, use_sudo=False, backup=True,
                     mirror_local_mode=False, mode=None,
-                    mkdir=False, chown=False, user=None):
+                    mkdir=False, chown=False, user=None,
+                    skip_unchanged=False):
     """
     Upload a template file.
 
-    This is a wrapper around :func:`fabric.contrib.files.upload_template`
-    that adds some extra parameters.
+    This takes the same parameters as
+    :func:`fabric.contrib.files.upload_template`, and adds some extra ones.
+    Templates are rendered locally with :py:func:`render_template`, so
+    that they are only read and compiled once, whatever the number of
+    hosts.
 
     If ``mkdir`` is True, then the remote directory will be created, as
     the current user or as ``user`` if specified.
 
     If ``chown`` is True, then it will ensure that the current user (or
     ``user`` if specified) is the owner of the remote file.
-    """
 
-    if mkdir:
-        remote_dir = os.path.dirname(destination)
-        if use_sudo:
-            sudo('mkdir -p %s' % quote(remote_dir), user=user)
-        else:
-            run('mkdir -p %s' % quote(remote_dir))
-
-    _upload_template(
-        filename=filename,
-        destination=destination,
-        context=context,
-        use_jinja=use_jinja,
-        template_dir=template_dir,
-        use_sudo=use_sudo,
-        backup=backup,
-        mirror_local_mode=mirror_local_mode,
-        mode=mode,
-    )
+    If ``skip_unchanged`` is True, then the checksum of the rendered
+    template is compared to the remote file's in a single remote
+    command. The file is only backed up, uploaded and chowned if it has
+    changed.
+
+    Returns ``True`` if the file was uploaded, ``False`` otherwise.
+    """
+    return _upload_rendered_template(
+        filename, destination, context, use_jinja, template_dir,
+        use_sudo, backup, mirror_local_mode, mode, mkdir, chown, user,
+        skip_unchanged=skip_unchanged)
+
+
+def _upload_rendered_template(filename, destination, context, use_jinja,
+                              template_dir, use_sudo, backup,
+                              mirror_local_mode, mode, mkdir, chown, user,
+                              skip_unchanged):
+    text = render_template(filename, context, use_jinja=use_jinja,
+                           template_dir=template_dir)
+
+    # mkdir runs as root unless a user is given, chown defaults to env.user
+    owner = env.user if user is None else user
+    if mirror_local_mode and mode is None:
+        mode = os.stat(_template_path(filename, template_dir)).st_mode
+
+    with batch():
+        state = file_state(destination, use_sudo=use_sudo, digest=skip_unchanged)
+        group = chown and skip_unchanged and _login_group(owner, use_sudo)
+    if state.stat is not None and state.stat.type == 'dir':
+        destination = posixpath.join(destination, os.path.basename(filename))
+        state = file_state(destination, use_sudo=use_sudo, digest=skip_unchanged)
+
+    if skip_unchanged and state.digest == content_checksum(text):
+        # Fix any attribute drift of the unchanged file in a single command
+        commands = []
+        if chown and (state.stat.owner != owner or group and group != state.stat.group):
+            commands.append('chown %s: %s' % (owner, quote(destination)))
+        if mode is not None and int(state.stat.mode, 8) != mode & 07777:
+            commands.append('chmod %04o %s' % (mode & 07777, quote(destination)))
+        if commands:
+            run_as_root(' && '.join(commands))
+        return bool(commands)
+
+    if mkdir and state.stat is None:
+        _mkdir(os.path.dirname(destination), use_sudo, user)
+
+    func = use_sudo and sudo or run
+    if backup and state.stat is not None:
+        func('cp %s %s.bak' % (quote(destination), quote(destination)))
+
+    put(StringIO(text), destination, use_sudo=use_sudo, mode=mode)
 
     if chown:
-        if user is None:
-            user = env.user
-        run_as_root('chown %s: %s' % (user, quote(destination)))
+        run_as_root('chown %s: %s' % (owner, quote(destination)))
+    return True
 
 
-def md5sum(filename, use_sudo=False):
+def _login_group(user, use_sudo):
     """
-    Compute the MD5 sum of a file.
+    Get the name of the login group of *user*, which ``chown user:`` sets
     """
-    func = use_sudo and run_as_root or run
-    with settings(hide('running', 'stdout', 'stderr', 'warnings'),
-                  warn_only=True):
-        # Linux (LSB)
-        if exists(u'/usr/bin/md5sum'):
-            res = func(u'/usr/bin/md5sum %(filename)s' % locals())
-        # BSD / OS X
-        elif exists(u'/sbin/md5'):
-            res = func(u'/sbin/md5 -r %(filename)s' % locals())
-        # SmartOS Joyent build
-        elif exists(u'/opt/local/gnu/bin/md5sum'):
-            res = func(u'/opt/local/gnu/bin/md5sum %(filename)s' % locals())
-        # SmartOS Joyent build
-        # (the former doesn't exist, at least on joyent_20130222T000747Z)
-        elif exists(u'/opt/local/bin/md5sum'):
-            res = func(u'/opt/local/bin/md5sum %(filename)s' % locals())
-        # Try to find ``md5sum`` or ``md5`` on ``$PATH`` or abort
-        else:
-            md5sum = func(u'which md5sum')
-            md5 = func(u'which md5')
-            if exists(md5sum):
-                res = func('%(md5sum)s %(filename)s' % locals())
-            elif exists(md5):
-                res = func('%(md5)s %(filename)s' % locals())
-            else:
-                abort('No MD5 utility was found on this system.')
+    def parse(output, return_code):
+        lines = output.splitlines()
+        return lines[-1].strip() if return_code == 0 and lines else None
 
-    if res.succeeded:
-        parts = res.split()
-        _md5sum = len(parts) > 0 and parts[0] or None
+    return probe('id -gn %s' % quote(user), parse, use_sudo)
+
+
+def _mkdir(remote_dir, use_sudo, user):
+    if use_sudo:
+        sudo('mkdir -p %s' % quote(remote_dir), user=user)
     else:
-        warn(res)
-        _md5sum = None
+        run('mkdir -p %s' % quote(remote_dir))
+
+
+def _template_path(filename, template_dir):
+    if template_dir:
+        filename = os.path.join(template_dir, filename)
+    return os.path.expanduser(apply_lcwd(filename, env))
+
 
-    return _md5sum
+TEMPLATE_CACHE_SIZE = 100
+
+_TEMPLATE_CACHE = OrderedDict()
+
+_JINJA_ENVIRONMENTS = {}
+
+
+def render_template(filename, context=None, use_jinja=False, template_dir=None):
+    """
+    Render a template file locally.
+
+    The template is looked up and rendered the same way as with Fabric's
+    ``upload_template``: Jinja templates are found in *template_dir* (by
+    default, the current directory), and other templates are rendered
+    with Python string interpolation if a *context* is given.
+
+    Templates are kept in a process-wide cache (see
+    :py:func:`read_template`), so that a template used for many hosts is
+    only read and compiled once.
+    """
+    if use_jinja:
+        template_dir = apply_lcwd(template_dir or os.getcwd(), env)
+        path = os.path.join(template_dir, filename)
+        template = _cached_template(
+            path, lambda: _jinja_environment(template_dir).get_template(filename),
+            kind=('jinja', template_dir))
+        return template.render(**context or {}).encode('utf-8')
+
+    text = read_template(_template_path(filename, template_dir))
+    if context:
+        text = text % context
+    return text
+
+
+def read_template(filename):
+    """
+    Read a template file, through the process-wide template cache.
+
+    The cache is keyed on the absolute path and modification time of
+    the file (and kept apart from compiled Jinja templates), and holds at
+    most ``TEMPLATE_CACHE_SIZE`` templates (the least recently used ones
+    are evicted first).
+    """
+    def load():
+        with open(filename) as f:
+            return f.read()
+
+    return _cached_template(filename, load)
+
+
+def _cached_template(filename, load, kind='text'):
+    path = os.path.abspath(filename)
+    key = (kind, path, os.stat(path).st_mtime)
+    try:
+        template = _TEMPLATE_CACHE.pop(key)
+    except KeyError:
+        template = load()
+    _TEMPLATE_CACHE[key] = template
+    while len(_TEMPLATE_CACHE) > TEMPLATE_CACHE_SIZE:
+        _TEMPLATE_CACHE.popitem(last=False)
+    return template
+
+
+def _jinja_environment(template_dir):
+    if template_dir not in _JINJA_ENVIRONMENTS:
+        try:
+            from jinja2 import Environment, FileSystemLoader
+        except ImportError:
+            abort('Unable to import Jinja2.')
+        _JINJA_ENVIRONMENTS[template_dir] = Environment(
+            loader=FileSystemLoader(template_dir))
+    return _JINJA_ENVIRONMENTS[template_dir]
+
+
+# Remote commands used to decompress uploaded streams
+_DECOMPRESSORS = {
+    'gzip': 'gzip -dc',
+    'zstd': 'zstd -dcq',
+}
+
+
+def upload_compressed(source, path, use_sudo=False, compression='gzip'):
+    """
+    Upload a file as a compressed stream.
+
+    The *source* (a local filename or a file-like object) is compressed on
+    the fly and sent through an SSH channel to a remote pipeline that
+    decompresses it next to *path*, then renames it into place (keeping
+    the owner and mode of an existing file). There is no local temporary
+    file, no SFTP session and no intermediate remote copy, even when
+    *use_sudo* is ``True`` (which requires passwordless ``sudo``).
+
+    Supported *compression* methods are ``gzip`` and ``zstd``. The latter
+    requires the `zstandard`_ Python package locally and the ``zstd``
+    command on the remote host.
+
+    .. _zstandard: https://pypi.python.org/pypi/zstandard
+    """
+    # Start from a copy of an existing file, to keep its owner and mode
+    script = ' && '.join([
+        't=%(path)s.fabtools-$$',
+        'trap \'rm -f "$t"\' EXIT',
+        '{ [ ! -f %(path)s ] || cp -p %(path)s "$t"; }',
+        '%%(decompress)s > "$t"',
+        'mv -f "$t" %(path)s',
+    ]) % {'path': quote(path)}
+    if isinstance(source, basestring):
+        f = open(source, 'rb')
+    else:
+        f = source
+    try:
+        with compressed_stream(script, use_sudo=use_sudo,
+                               compression=compression) as stream:
+            while True:
+                data = f.read(BLOCKSIZE)
+                if not data:
+                    break
+                stream.write(data)
+    finally:
+        if f is not source:
+            f.close()
+
+
+@contextmanager
+def compressed_stream(script, use_sudo=False, compression='gzip'):
+    """
+    Context manager to send a compressed stream to a remote shell script.
+
+    Data written to the stream object is compressed on the fly, and sent
+    through an SSH channel to the standard input of *script*, which must
+    read it with the ``%(decompress)s`` command::
+
+        from fabtools.files import compressed_stream
+
+        with compressed_stream('%(decompress)s > /tmp/data') as stream:
+            stream.write(data)
+
+    The script is run from the current remote working directory, as root
+    if *use_sudo* is ``True`` (which requires passwordless ``sudo``).
+    See :py:func:`~fabtools.files.upload_compressed` for the supported
+    compression methods.
+    """
+    compressor = _compressor(compression)
+    script = script.replace('%(decompress)s', _DECOMPRESSORS[compression])
+    if env.cwd:
+        script = 'cd %s && %s' % (quote(env.cwd), script)
+    command = '/bin/sh -c %s' % quote(script)
+    if use_sudo and env.user != 'root':
+        command = 'sudo -n %s' % command
+
+    channel = connections[env.host_string].get_transport().open_session()
+    try:
+        channel.exec_command(command)
+        # Read the output while sending, so that the remote command never
+        # blocks on a full SSH window (and stops reading its input)
+        errors = []
+        readers = [
+            _start_thread(_read_channel, channel.recv, []),
+            _start_thread(_read_channel, channel.recv_stderr, errors),
+        ]
+        yield _CompressedStream(channel, compressor)
+        channel.sendall(compressor.flush())
+        channel.shutdown_write()
+        status = channel.recv_exit_status()
+        for reader in readers:
+            reader.join()
+    finally:
+        channel.close()
+
+    if status != 0:
+        abort('Remote command failed while receiving compressed data:\n%s' % ''.join(errors))
+
+
+def _start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _read_channel(recv, chunks):
+    while True:
+        data = recv(BLOCKSIZE)
+        if not data:
+            break
+        chunks.append(data)
+
+
+class _CompressedStream(object):
+
+    def __init__(self, channel, compressor):
+        self.channel = channel
+        self.compressor = compressor
+
+    def write(self, data):
+        self.channel.sendall(self.compressor.compress(data))
+
+
+def _compressor(compression):
+    if compression == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            abort('The zstandard package is required for zstd compression.')
+        return zstandard.ZstdCompressor().compressobj()
+    else:
+        raise ValueError('Unsupported compression method: %s' % compression)
+
+
+# Candidate tools for each checksum algorithm, in order of preference
+_CHECKSUM_TOOLS = {
+    'md5': [
+        '/usr/bin/md5sum',  # Linux (LSB)
+        '/sbin/md5 -r',  # BSD / OS X
+        '/opt/local/gnu/bin/md5sum',  # SmartOS Joyent build
+        '/opt/local/bin/md5sum',  # SmartOS Joyent build
+        'md5sum',
+        'md5 -r',
+    ],
+    'sha1': ['sha1sum', 'shasum -a 1', '/sbin/sha1 -r'],
+    'sha256': ['sha256sum', 'shasum -a 256', '/sbin/sha256 -r'],
+    'xxh64': ['xxh64sum', 'xxhsum -H1'],
+}
+
+
+def checksum(paths, algo='md5', use_sudo=False):
+    """
+    Compute the checksums of one or more files.
+
+    All files are hashed with a single remote command. Returns a
+    dictionary mapping each path to its checksum (as a hexadecimal string),
+    or to ``None`` if the file does not exist or could not be read.
+
+    Supported algorithms are ``md5``, ``sha1``, ``sha256`` and ``xxh64``.
+    The remote tool used for each algorithm is detected the first time,
+    then cached for the rest of the session.
+
+    ::
+
+        from fabtools.files import checksum
+
+        digests = checksum(['/etc/hosts', '/etc/passwd'], algo='sha256')
+
+    """
+    if isinstance(paths, basestring):
+        paths = [paths]
+    paths = list(paths)
+    if not paths:
+        return {}
+
+    tool = host_cache('files.checksum').get(algo)
+    setup, body = _checksum_script(paths, algo, tool)
+
+    def parse(output, return_code):
+        # Ignore any noise printed by the login shell
+        lines = output.splitlines()
+        head, lines = lines[:-len(paths)], lines[-len(paths):]
+        _parse_checksum_tool(head, algo, tool)
+        return dict(zip(paths, map(_parse_checksum, lines)))
+
+    return probe('\n'.join(setup + body), parse, use_sudo)
+
+
+def checksum_tree(path, algo='md5', use_sudo=False):
+    """
+    Compute the checksums of all files in a remote directory tree.
+
+    All files are hashed with a single remote command. Returns a
+    dictionary mapping the path of each file, relative to *path* and
+    using ``/`` as a separator, to its checksum. The dictionary is empty
+    if the directory does not exist.
+
+    See :py:func:`~fabtools.files.checksum` for the supported algorithms.
+    """
+    tool = host_cache('files.checksum').get(algo)
+    setup, _ = _checksum_script([], algo, tool)
+    # One hashing process for many files; $ht is empty if no tool was found
+    body = [
+        'if [ -n "$ht" ] && cd %s 2>/dev/null; then' % quote(path),
+        "    find . -type f -exec $ht {} + 2>/dev/null | sed 's/^/tree:/'",
+        'fi',
+    ]
+
+    def parse(output, return_code):
+        lines = output.splitlines()
+        _parse_checksum_tool(lines, algo, tool)
+        digests = {}
+        for line in lines:
+            if line.startswith('tree:'):
+                digest, name = _parse_checksum_line(line[len('tree:'):].rstrip('\r'))
+                digests[name[len('./'):]] = digest
+        return digests
+
+    return probe('\n'.join(setup + body), parse, use_sudo)
+
+
+def _parse_checksum_line(line):
+    """
+    Parse a ``<digest> <filename>`` line from a checksum tool
+
+    The digest and filename may be separated by one space (BSD), or two
+    spaces or `` *`` (GNU). GNU tools also escape backslashes and newlines
+    in the filename, and then start the line with a backslash.
+    """
+    escaped = line.startswith('\\')
+    if escaped:
+        line = line[1:]
+    digest, name = line.split(' ', 1)
+    if name[:1] in (' ', '*'):
+        name = name[1:]
+    if escaped:
+        name = re.sub(r'\\(.)', lambda m: _UNESCAPE.get(m.group(1), m.group(1)), name)
+    return digest, name
+
+
+_UNESCAPE = {'n': '\n', 'r': '\r'}
+
+
+def _checksum_script(paths, algo, tool):
+    """
+    Shell script printing one checksum per path (or ``-``)
+
+    Returns the setup and body parts of the script. If the tool for this
+    algorithm is not known yet, the setup part detects and prints it
+    (see :py:func:`_parse_checksum_tool`).
+    """
+    if algo not in _CHECKSUM_TOOLS:
+        raise ValueError('Unsupported checksum algorithm: %s' % algo)
+    if tool is None:
+        setup = [
+            'for ht in %s; do' % ' '.join(quote(t) for t in _CHECKSUM_TOOLS[algo]),
+            '    command -v ${ht%% *} >/dev/null 2>&1 && break; ht=',
+            'done',
+            'echo "checksum-tool:$ht"',
+        ]
+    else:
+        setup = ['ht=%s' % quote(tool)]
+    body = [
+        'for p in %s; do' % ' '.join(quote(path) for path in paths),
+        # $ht is empty if no tool was found: never run the file itself
+        '    if [ -n "$ht" ] && [ -f "$p" ] && h=$($ht "$p" 2>/dev/null); then echo "${h%% *}"; else echo -; fi',
+        'done',
+    ]
+    return setup, body
+
+
+def _parse_checksum_tool(lines, algo, tool):
+    if tool is None:
+        tools = [line.strip()[len('checksum-tool:'):] for line in lines
+                 if line.strip().startswith('checksum-tool:')]
+        if not tools or not tools[-1]:
+            abort('No %s utility was found on this system.' % algo.upper())
+        host_cache('files.checksum')[algo] = tools[-1]
+
+
+def _parse_checksum(line):
+    line = line.strip()
+    return line if line and line != '-' else None
+
+
+def local_checksum(filename, algo='md5', cache=True):
+    """
+    Compute the checksum of a local file.
+
+    Uses the same algorithms as :py:func:`fabtools.files.checksum`.
+    The ``xxh64`` algorithm requires the `xxhash`_ Python package.
+
+    Unless *cache* is ``False``, checksums are stored in a persistent
+    cache on the local machine, keyed on the absolute path, size,
+    modification time and inode number of the file, so that a given
+    version of a file is only read once, whatever the number of hosts
+    and runs. The cache location is ``env.digest_cache`` (by default
+    ``~/.cache/fabtools/digests.json``), or set it to ``None`` to disable
+    the cache. It is read once per process, and saved as soon as a new
+    checksum is computed, so that parallel workers (``fab -P``), which
+    exit without running ``atexit`` handlers, share their results. The
+    least recently used entries are evicted when the cache holds more
+    than ``env.digest_cache_size`` entries (by default
+    ``DIGEST_CACHE_SIZE``).
+
+    .. _xxhash: https://pypi.python.org/pypi/xxhash
+    """
+    cache_path = cache and env.get('digest_cache', DEFAULT_DIGEST_CACHE)
+    if not cache_path:
+        return _hash_file(filename, algo)
+
+    digest, missed = _cached_checksum(filename, algo, cache_path)
+    if missed:
+        _save_digest_cache(cache_path)
+    return digest
+
+
+def local_checksums(filenames, algo='md5', cache=True):
+    """
+    Compute the checksums of several local files.
+
+    Same as :py:func:`fabtools.files.local_checksum`, but the cache is
+    saved once at the end. Returns a dictionary mapping each filename
+    to its checksum.
+    """
+    cache_path = cache and env.get('digest_cache', DEFAULT_DIGEST_CACHE)
+    if not cache_path:
+        return dict((filename, _hash_file(filename, algo))
+                    for filename in filenames)
+
+    digests = {}
+    for filename in filenames:
+        digests[filename] = _cached_checksum(filename, algo, cache_path)[0]
+    if cache_path in _DIRTY_DIGEST_CACHES:
+        _save_digest_cache(cache_path)
+    return digests
+
+
+def content_checksum(contents, algo='md5'):
+    """
+    Compute the checksum of a string.
+
+    Uses the same algorithms as :py:func:`fabtools.files.checksum`.
+    """
+    digest = _hash_object(algo)
+    digest.update(contents)
+    return digest.hexdigest()
+
+
+DEFAULT_DIGEST_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', '~/.cache'), 'fabtools', 'digests.json')
+
+DIGEST_CACHE_SIZE = 100000
+
+_DIGEST_CACHES = {}
+
+_DIRTY_DIGEST_CACHES = set()
+
+
+def _digest_cache_key(filename, algo):
+    st = os.stat(filename)
+    mtime_ns = getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 1e9)
+    return '%s:%s:%d:%d:%d' % (algo, os.path.abspath(filename), st.st_size,
+                               mtime_ns, st.st_ino)
+
+
+def _cached_checksum(filename, algo, cache_path):
+    """
+    Return the checksum of a local file and whether it was computed
+    """
+    entries = _load_digest_cache(cache_path)
+    key = _digest_cache_key(filename, algo)
+    entry = entries.get(key)
+    missed = entry is None
+    if missed:
+        entry = entries[key] = {'digest': _hash_file(filename, algo)}
+    entry['used'] = _time.time()
+    _DIRTY_DIGEST_CACHES.add(cache_path)
+    return entry['digest'], missed
+
+
+def _load_digest_cache(path):
+    if path not in _DIGEST_CACHES:
+        _DIGEST_CACHES[path] = _read_digest_cache(path)
+    return _DIGEST_CACHES[path]
+
+
+def _read_digest_cache(path):
+    try:
+        with open(os.path.expanduser(path)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_digest_caches():
+    # Only cache hits are left to save: misses are saved right away
+    for path in list(_DIRTY_DIGEST_CACHES):
+        _save_digest_cache(path)
+
+atexit.register(_save_digest_caches)
+
+
+def _save_digest_cache(path):
+    _DIRTY_DIGEST_CACHES.discard(path)
+    entries = _DIGEST_CACHES[path]
+
+    # Merge entries saved by other processes in the meantime
+    for key, entry in _read_digest_cache(path).items():
+        if key not in entries or entries[key]['used'] < entry['used']:
+            entries[key] = entry
+
+    # Evict least recently used entries
+    size = env.get('digest_cache_size') or DIGEST_CACHE_SIZE
+    if len(entries) > size:
+        keys = sorted(entries, key=lambda key: entries[key]['used'])
+        for key in keys[:len(entries) - size]:
+            del entries[key]
+
+    # Write to a temporary file first, then rename it atomically
+    path = os.path.expanduser(path)
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fd, tmp_path = mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        warn('Could not save digest cache %s: %s' % (path, e))
+
+
+def _hash_file(filename, algo):
+    digest = _hash_object(algo)
+    # Avoid reading the whole file into memory at once
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(BLOCKSIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _hash_object(algo):
+    if algo == 'xxh64':
+        try:
+            import xxhash
+        except ImportError:
+            abort('The xxhash package is required for xxh64 checksums.')
+        return xxhash.xxh64()
+    elif algo in _CHECKSUM_TOOLS:
+        return hashlib.new(algo)
+    else:
+        raise ValueError('Unsupported checksum algorithm: %s' % algo)
+
+
+def md5sum(filename, use_sudo=False):
+    """
+    Compute the MD5 sum of a file.
+
+    Returns ``None`` if the file does not exist or could not be read.
+
+    .. seealso:: :py:func:`fabtools.files.checksum`
+    """
+    return checksum([filename], algo='md5', use_sudo=use_sudo)[filename]
 
 
 class watch(object):
@@ -237,32 +1088,95 @@ class watch(object):
             uncomment('/etc/daemon.conf', 'someoption')
             comment('/etc/daemon.conf', 'otheroption')
 
+    All the watched files are hashed with a single remote command when
+    entering the block, and another one when leaving it.
+
+    If *quick* is ``True``, the size, modification time and inode
+    number of the files are also recorded when entering the block.
+    When leaving it, only the files for which these have changed are
+    hashed again, so that files that were not touched are not read
+    twice, while a file rewritten with the same contents is still not
+    reported as changed.
+
     """
 
-    def __init__(self, filenames, callback=None, use_sudo=False):
+    def __init__(self, filenames, callback=None, use_sudo=False, quick=False):
         if isinstance(filenames, basestring):
             self.filenames = [filenames]
         else:
             self.filenames = filenames
         self.callback = callback
         self.use_sudo = use_sudo
+        self.quick = quick
         self.digest = dict()
+        self.stat = dict()
+        self.time = None
         self.changed = False
 
     def __enter__(self):
         with settings(hide('warnings')):
-            for filename in self.filenames:
-                self.digest[filename] = md5sum(filename, self.use_sudo)
+            if self.quick:
+                self.stat, self.digest, self.time = _watch_state(
+                    self.filenames, self.use_sudo)
+            else:
+                self.digest = checksum(self.filenames, use_sudo=self.use_sudo)
         return self
 
     def __exit__(self, type, value, tb):
-        for filename in self.filenames:
-            if md5sum(filename, self.use_sudo) != self.digest[filename]:
-                self.changed = True
-                break
+        filenames = self.filenames
+        if self.quick:
+            stat = stat_many(filenames, use_sudo=self.use_sudo)
+            filenames = [filename for filename in filenames
+                         if self._maybe_modified(self.stat[filename], stat[filename])]
+        if filenames:
+            digest = checksum(filenames, use_sudo=self.use_sudo)
+            for filename in filenames:
+                if digest[filename] != self.digest[filename]:
+                    self.changed = True
+                    break
         if self.changed and self.callback:
             self.callback()
 
+    def _maybe_modified(self, before, after):
+        if before is None or after is None:
+            return before != after
+        if (before.size, before.mtime, before.inode) != (after.size, after.mtime, after.inode):
+            return True
+        # The modification time has a resolution of one second, so a file
+        # modified during the second when it was first checked could have
+        # changed without any visible difference
+        return after.mtime >= self.time
+
+
+def _watch_state(paths, use_sudo):
+    """
+    Get the stat records and checksums of *paths*, and the current time
+    """
+    if not paths:
+        return {}, {}, None
+
+    flavor = host_cache('files.stat').get('flavor')
+    tool = host_cache('files.checksum').get('md5')
+    stat_setup, stat_body = _stat_script(paths, flavor)
+    checksum_setup, checksum_body = _checksum_script(paths, 'md5', tool)
+    script = stat_setup + checksum_setup + ['date +%s'] + stat_body + checksum_body
+
+    def parse(output, return_code):
+        # Ignore any noise printed by the login shell
+        count = len(paths)
+        lines = output.splitlines()
+        head, now = lines[:-2 * count - 1], lines[-2 * count - 1]
+        stats, checksums = lines[-2 * count:-count], lines[-count:]
+        _parse_stat_flavor(head, flavor)
+        _parse_checksum_tool(head, 'md5', tool)
+        return (
+            dict(zip(paths, map(_parse_stat, stats))),
+            dict(zip(paths, map(_parse_checksum, checksums))),
+            int(now),
+        )
+
+    return probe('\n'.join(script), parse, use_sudo)
+
 
 def uncommented_lines(filename, use_sudo=False):
     """
@@ -284,9 +1198,11 @@ def getmtime(path, use_sudo=False):
 
     Same as :py:func:`os.path.getmtime()`
     """
-    func = use_sudo and run_as_root or run
-    with settings(hide('running', 'stdout')):
-        return int(func('stat -c %%Y "%(path)s" ' % locals()).strip())
+    def transform(records):
+        if records[path] is None:
+            abort('%s: No such file or directory' % path)
+        return records[path].mtime
+    return _stat_probe([path], use_sudo, transform)
 
 
 def copy(source, destination, recursive=False, use_sudo=False):
@@ -337,7 +1253,8 @@ def remove(path, recursive=False, quiet=False, use_sudo=False):
 def atomic_replace(src, target, backup_ext=None, follow_symlink=False, use_sudo=False):
     """
     Replace target file with src file via an atomic rename operation. Works for files and symlinks, but not directories.
-    but if the
+    All checks and operations are done by a single remote shell script, and a partial failure leaves the target
+    untouched.
     :param src: src file or symlink
     :param target: target file or symlink which will be replaced
     :param backup_ext: create a backup of the original file with this value appended to the name [default no backup]
@@ -345,22 +1262,34 @@ def atomic_replace(src, target, backup_ext=None, follow_symlink=False, use_sudo=
     :param use_sudo: run using sudo
     :return: actual path that was replaced
     """
-    func = run_as_root if use_sudo else run
-    real_target = func("readlink -f '%s'" % target) if follow_symlink else target
-    assert not is_dir(src) and not is_dir(real_target), "Cannot atomically replace directories"
-    real_src = func("readlink -f '%s'" % src)
-    tmp_file = str(Path(real_target).parent / ('%s_fabtools_%s' % (str(Path(real_target).name), str(time()))))
+    func = use_sudo and run_as_root or run
+    script = [
+        'src=%s' % quote(src),
+        'target=%s' % quote(target),
+    ]
+    if follow_symlink:
+        script.append('target=$(readlink -f "$target") || exit 1')
+    script += [
+        'if [ -d "$src" ] || [ -d "$target" ]; then exit 2; fi',
+        'tmp="$target.fabtools-$$"',
+        'trap \'rm -f "$tmp"\' EXIT',
+    ]
     if backup_ext:
-        trg_path = Path(real_target)
-        hardlink(real_target, trg_path.with_name(trg_path.name.strip() + backup_ext.strip()), use_sudo=use_sudo)
-
-    if is_link(src, use_sudo=use_sudo):
-        symlink(real_src, tmp_file, use_sudo=use_sudo)
-    elif is_file(src, use_sudo=use_sudo):
-        copy(src, tmp_file, use_sudo=use_sudo)
-    else:
-        raise ValueError('%s is neither a file nor a link')
-
-    move(tmp_file, real_target, use_sudo=use_sudo)
-    remove(tmp_file, quiet=True, use_sudo=use_sudo)
-    return real_target
+        script.append('/bin/ln -f "$target" "$target"%s || exit 1' % quote(backup_ext.strip()))
+    script += [
+        'if [ -L "$src" ]; then /bin/ln -s "$(readlink -f "$src")" "$tmp" || exit 1',
+        'elif [ -f "$src" ]; then /bin/cp "$src" "$tmp" || exit 1',
+        'else exit 3; fi',
+        '/bin/mv -f "$tmp" "$target" || exit 1',
+        'echo "$target"',
+    ]
+
+    with settings(hide('stdout'), warn_only=True):
+        res = func('\n'.join(script))
+    if res.return_code == 2:
+        raise AssertionError('Cannot atomically replace directories')
+    elif res.return_code == 3:
+        raise ValueError('%s is neither a file nor a link' % src)
+    elif res.failed:
+        abort('Could not replace %s with %s:\n%s' % (target, src, res))
+    return res.splitlines()[-1].strip()
@@ -3,8 +3,7 @@ Groups
 ======
 """
 
-from fabric.api import hide, run, settings
-
+from fabtools.probes import probe
 from fabtools.utils import run_as_root
 
 
@@ -12,8 +11,8 @@ def exists(name):
     """
     Check if a group exists.
     """
-    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
-        return run('getent group %(name)s' % locals()).succeeded
+    return probe('getent group %(name)s' % locals(),
+                 lambda output, return_code: return_code == 0)
 
 
 def create(name, gid=None):
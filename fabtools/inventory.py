@@ -0,0 +1,114 @@
+"""
+Package inventory
+=================
+
+Checking whether a package is installed used to take one remote command
+per package. Each package backend (:py:mod:`fabtools.deb`,
+:py:mod:`fabtools.rpm`, :py:mod:`fabtools.arch`...) now keeps an
+:py:class:`Inventory` of the installed packages of each host instead: the
+full list is loaded with a single command the first time it is needed,
+and ``is_installed`` answers from memory afterwards.
+
+The inventory is kept up to date by the ``install`` and ``uninstall``
+functions of the backend. If packages are installed or removed by other
+means, call :py:meth:`Inventory.invalidate` (or
+:py:func:`fabtools.utils.clear_host_cache`) so that it is loaded again.
+
+"""
+
+import re
+
+from fabtools.probes import in_batch, probe
+from fabtools.utils import host_cache
+
+
+# Names that can be looked up in the inventory. Anything else (versions,
+# architectures, patterns, file names...) is checked on the remote host.
+_SIMPLE_NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9+._-]*(/[A-Za-z0-9][A-Za-z0-9+._-]*)?$')
+
+
+class Inventory(object):
+    """
+    The set of installed packages of each host, for a package backend.
+
+    *command* lists the installed packages, and *parse* turns its output
+    into a set of names.
+    """
+
+    def __init__(self, backend, command, parse):
+        self.backend = backend
+        self.command = command
+        self.parse = parse
+
+    def packages(self):
+        """
+        Get the set of installed packages of the current host.
+
+        Inside a :py:class:`~fabtools.probes.batch` block, this is a lazy
+        result, and the inventory is only kept once the batch is sent. If
+        the command fails, the inventory is kept empty and incomplete, so
+        that every package is checked on the remote host.
+        """
+        state = self._state()
+        if state.get('installed') is None:
+            def parse(output, return_code):
+                state['complete'] = return_code == 0
+                state['installed'] = self.parse(output) if return_code == 0 else set()
+                return state['installed']
+            return probe(self.command, parse)
+        return state['installed']
+
+    def is_installed(self, pkg_name, check):
+        """
+        Check if a package is installed.
+
+        Names that cannot be found in the inventory, or that may have been
+        installed as a dependency since it was loaded, are passed to the
+        *check* function, which runs the usual remote check. So are all
+        names inside a :py:class:`~fabtools.probes.batch` block if the
+        inventory is not loaded yet, so that the result stays lazy.
+        """
+        if not _SIMPLE_NAME.match(pkg_name):
+            return check(pkg_name)
+        if self._state().get('installed') is None and in_batch():
+            return check(pkg_name)
+        if pkg_name in self.packages():
+            return True
+        if self._state()['complete']:
+            return False
+        if check(pkg_name):
+            self.packages().add(pkg_name)
+            return True
+        return False
+
+    def add(self, packages):
+        """
+        Record newly installed packages.
+
+        Their dependencies are not known, so packages that are not in the
+        inventory will be checked on the remote host from now on.
+        """
+        state = self._state()
+        if state.get('installed') is None:
+            return
+        state['installed'].update(
+            name for name in _names(packages) if _SIMPLE_NAME.match(name))
+        state['complete'] = False
+
+    def invalidate(self):
+        """
+        Forget the inventory of the current host.
+
+        This is needed after packages are removed, as packages that depend
+        on them may have been removed too.
+        """
+        self._state().clear()
+
+    def _state(self):
+        return host_cache('packages.inventory').setdefault(self.backend, {})
+
+
+def _names(packages):
+    if isinstance(packages, basestring):
+        return packages.split()
+    return list(packages)
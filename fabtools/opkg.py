@@ -9,6 +9,7 @@ and repositories.
 
 from fabric.api import hide, run, settings
 
+from fabtools.inventory import Inventory
 from fabtools.utils import run_as_root
 
 
@@ -32,10 +33,24 @@ def upgrade():
     run_as_root("%(manager)s %(cmd)s" % locals(), pty=False)
 
 
+def _parse_opkg_inventory(output):
+    return set(line.split()[0] for line in output.splitlines() if line.strip())
+
+
+INVENTORY = Inventory('opkg', '%s list-installed' % MANAGER, _parse_opkg_inventory)
+
+
 def is_installed(pkg_name):
     """
     Check if a package is installed.
+
+    The answer comes from the :py:class:`~fabtools.inventory.Inventory`
+    of the host, loaded once with ``opkg list-installed``.
     """
+    return INVENTORY.is_installed(pkg_name, _is_installed)
+
+
+def _is_installed(pkg_name):
     manager = MANAGER
     with settings(
             hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
@@ -78,6 +93,7 @@ def install(packages, update=False, options=None):
     options = " ".join(options)
     cmd = '%(manager)s install %(options)s %(packages)s' % locals()
     run_as_root(cmd, pty=False)
+    INVENTORY.add(packages)
 
 
 def uninstall(packages, options=None):
@@ -95,3 +111,4 @@ def uninstall(packages, options=None):
     options = " ".join(options)
     cmd = '%(manager)s %(command)s %(options)s %(packages)s' % locals()
     run_as_root(cmd, pty=False)
+    INVENTORY.invalidate()
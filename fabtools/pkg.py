@@ -11,6 +11,7 @@ This module provides tools to manage `SmartOS`_ packages.
 from fabric.api import hide, quiet, run, settings
 
 from fabtools.files import is_file
+from fabtools.inventory import Inventory
 from fabtools.utils import run_as_root
 
 
@@ -41,10 +42,30 @@ def upgrade(full=False):
     run_as_root("%(manager)s -y %(cmd)s" % locals())
 
 
+def _parse_pkg_info_inventory(output):
+    installed = set()
+    for line in output.splitlines():
+        if line.strip():
+            # Packages are listed as name-version
+            full_name = line.split()[0]
+            installed.update([full_name, full_name.rsplit('-', 1)[0]])
+    return installed
+
+
+INVENTORY = Inventory('pkg', 'pkg_info', _parse_pkg_info_inventory)
+
+
 def is_installed(pkg_name):
     """
     Check if a package is installed.
+
+    The answer comes from the :py:class:`~fabtools.inventory.Inventory`
+    of the host, loaded once with ``pkg_info``.
     """
+    return INVENTORY.is_installed(pkg_name, _is_installed)
+
+
+def _is_installed(pkg_name):
     with settings(warn_only=True):
         res = run('pkg_info -e %s' % pkg_name)
         return res.succeeded is True
@@ -92,6 +113,7 @@ def install(packages, update=False, yes=None, options=None):
             % locals())
     else:
         run_as_root('%(manager)s %(options)s install %(packages)s' % locals())
+    INVENTORY.add(packages)
 
 
 def uninstall(packages, orphan=False, options=None):
@@ -115,6 +137,7 @@ def uninstall(packages, orphan=False, options=None):
     if orphan:
         run_as_root('%(manager)s -y autoremove' % locals())
     run_as_root('%(manager)s %(options)s remove %(packages)s' % locals())
+    INVENTORY.invalidate()
 
 
 def smartos_build():
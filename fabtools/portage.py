@@ -14,6 +14,7 @@ import re
 
 from fabric.api import hide, run, settings
 
+from fabtools.inventory import Inventory
 from fabtools.utils import run_as_root
 
 
@@ -34,10 +35,37 @@ def update_index(quiet=True):
         run_as_root("%(manager)s --sync" % locals())
 
 
+_VERSION = re.compile(r'-\d+(\.\d+)*[a-z]?(_(alpha|beta|pre|rc|p)\d*)*(-r\d+)?$')
+
+
+def _parse_portage_inventory(output):
+    installed = set()
+    for line in output.splitlines():
+        if '/' not in line:
+            continue
+        # Packages are listed as category/name-version
+        full_name = line.strip()
+        name = _VERSION.sub('', full_name)
+        installed.update([full_name, name,
+                          full_name.split('/', 1)[1], name.split('/', 1)[1]])
+    return installed
+
+
+INVENTORY = Inventory('portage', 'cd /var/db/pkg && ls -d */*',
+                      _parse_portage_inventory)
+
+
 def is_installed(pkg_name):
     """
     Check if a Portage package is installed.
+
+    The answer comes from the :py:class:`~fabtools.inventory.Inventory`
+    of the host, loaded once from the Portage database.
     """
+    return INVENTORY.is_installed(pkg_name, _is_installed)
+
+
+def _is_installed(pkg_name):
     manager = MANAGER
 
     with settings(hide("running", "stdout", "stderr", "warnings"),
@@ -97,6 +125,7 @@ def install(packages, update=False, options=None):
 
     cmd = '%(manager)s %(options)s %(packages)s' % locals()
     run_as_root(cmd, pty=False)
+    INVENTORY.add(packages)
 
 
 def uninstall(packages, options=None):
@@ -115,3 +144,4 @@ def uninstall(packages, options=None):
 
     cmd = '%(manager)s --unmerge %(options)s %(packages)s' % locals()
     run_as_root(cmd, pty=False)
+    INVENTORY.invalidate()
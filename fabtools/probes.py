@@ -0,0 +1,249 @@
+"""
+Probes
+======
+
+Most ``require`` functions start by running small read-only checks on
+the remote host (does this file exist? who owns it? is this package
+installed?). Each check is a separate round trip, which adds up quickly
+on slow links.
+
+Functions such as :py:func:`fabtools.files.is_file` are built on
+:py:func:`probe`. Inside a :py:class:`batch` block, probes do not run
+immediately: they return lazy results, and all pending probes are sent
+together as a single shell script the first time one of the results is
+used (or when the block ends).
+
+"""
+
+import re
+import uuid
+
+from fabric.api import abort, env, hide, run, settings
+
+from fabtools.utils import run_as_root
+
+
+_BATCHES = []
+
+
+def probe(command, parse, use_sudo=False):
+    """
+    Run a read-only check on the remote host.
+
+    The *command* output and return code are passed to the *parse*
+    function, whose return value is returned.
+
+    Inside a :py:class:`batch` block, the command is queued and a
+    :py:class:`LazyResult` is returned instead.
+    """
+    current = _current_batch()
+    if current is not None:
+        return current.add(command, parse, use_sudo)
+
+    func = use_sudo and run_as_root or run
+    with settings(hide('running', 'stdout', 'stderr', 'warnings'),
+                  warn_only=True):
+        res = func(command)
+    return parse(res, res.return_code)
+
+
+class batch(object):
+    """
+    Context manager to coalesce probes into a single remote command.
+
+    Probes issued inside the block (by :py:func:`fabtools.files.is_file`,
+    :py:func:`fabtools.files.owner`, :py:func:`fabtools.user.exists`,
+    :py:func:`fabtools.deb.is_installed`...) return lazy results.
+    Using any of these results sends all pending probes to the remote
+    host in one shell invocation (one per value of *use_sudo*).
+
+    ::
+
+        import fabtools
+
+        with fabtools.batch():
+            has_config = fabtools.files.is_file('/etc/foo.conf')
+            has_user = fabtools.user.exists('foo')
+            has_package = fabtools.deb.is_installed('foo')
+
+        if not has_package:
+            ...
+
+    .. note:: Queued probes are run from the working directory that was
+              current when they were issued, but with the other Fabric
+              settings (prefixes, environment variables...) that are
+              active when the batch is sent.
+
+    """
+
+    def __init__(self):
+        self.host_string = None
+        self.pending = []
+
+    def __enter__(self):
+        self.host_string = env.host_string
+        _BATCHES.append(self)
+        return self
+
+    def __exit__(self, type, value, tb):
+        _BATCHES.remove(self)
+        if type is None:
+            self.flush()
+
+    def add(self, command, parse, use_sudo=False):
+        """
+        Queue a probe, and return its lazy result.
+        """
+        result = LazyResult(self)
+        self.pending.append((env.cwd, command, parse, use_sudo, result))
+        return result
+
+    def flush(self):
+        """
+        Run all pending probes.
+        """
+        pending, self.pending = self.pending, []
+        for use_sudo in (False, True):
+            probes = [p for p in pending if p[3] == use_sudo]
+            if probes:
+                self._run(probes, use_sudo)
+
+    def _run(self, probes, use_sudo):
+        marker = 'fabtools-probe-%s' % uuid.uuid4().hex
+        script = []
+        for cwd, command, _, _, _ in probes:
+            if cwd:
+                command = 'cd %s >/dev/null && %s' % (cwd, command)
+            script.append('(%s) 2>&1; rc=$?; echo; echo "%s $rc"' % (
+                command, marker))
+        script = '\n'.join(script)
+
+        func = use_sudo and run_as_root or run
+        with settings(hide('running', 'stdout', 'stderr', 'warnings'),
+                      warn_only=True, cwd='', host_string=self.host_string):
+            res = func(script)
+
+        outputs = _split_output(res.replace('\r\n', '\n'), marker)
+        if len(outputs) != len(probes):
+            abort('Could not parse the output of batched probes:\n%s' % res)
+
+        for (_, _, parse, _, result), (output, rc) in zip(probes, outputs):
+            result.resolve(parse(output, rc))
+
+
+def in_batch():
+    """
+    Check whether probes are queued in a :py:class:`batch` for the
+    current host.
+    """
+    return _current_batch() is not None
+
+
+def _current_batch():
+    if _BATCHES and _BATCHES[-1].host_string == env.host_string:
+        return _BATCHES[-1]
+
+
+def _split_output(output, marker):
+    parts = re.split(r'\n?%s (\d+)(?:\n|$)' % re.escape(marker), output)
+    outputs = []
+    for i in range(0, len(parts) - 1, 2):
+        outputs.append((parts[i].strip(), int(parts[i + 1])))
+    return outputs
+
+
+class LazyResult(object):
+    """
+    The result of a probe queued in a :py:class:`batch`.
+
+    It behaves as the actual result for most purposes (truth value,
+    comparisons, string conversion, attribute access...). The batch is
+    sent to the remote host the first time the value is needed.
+    """
+
+    def __init__(self, batch):
+        self._batch = batch
+        self._resolved = False
+        self._value = None
+
+    def resolve(self, value):
+        self._value = value
+        self._resolved = True
+
+    @property
+    def value(self):
+        if not self._resolved:
+            self._batch.flush()
+        return self._value
+
+    def __nonzero__(self):
+        return bool(self.value)
+
+    __bool__ = __nonzero__
+
+    def __eq__(self, other):
+        return self.value == other
+
+    def __ne__(self, other):
+        return self.value != other
+
+    def __lt__(self, other):
+        return self.value < other
+
+    def __le__(self, other):
+        return self.value <= other
+
+    def __gt__(self, other):
+        return self.value > other
+
+    def __ge__(self, other):
+        return self.value >= other
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __str__(self):
+        return str(self.value)
+
+    def __unicode__(self):
+        return unicode(self.value)
+
+    def __repr__(self):
+        if self._resolved:
+            return repr(self._value)
+        return '<LazyResult (pending)>'
+
+    def __int__(self):
+        return int(self.value)
+
+    def __float__(self):
+        return float(self.value)
+
+    def __add__(self, other):
+        return self.value + other
+
+    def __radd__(self, other):
+        return other + self.value
+
+    def __sub__(self, other):
+        return self.value - other
+
+    def __rsub__(self, other):
+        return other - self.value
+
+    def __len__(self):
+        return len(self.value)
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __contains__(self, item):
+        return item in self.value
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.value, name)
@@ -15,6 +15,7 @@ import fabtools.require.nodejs
 import fabtools.require.openvz
 import fabtools.require.opkg
 import fabtools.require.oracle_jdk
+import fabtools.require.packaging
 import fabtools.require.pkg
 import fabtools.require.portage
 import fabtools.require.postfix
@@ -38,3 +39,7 @@ from fabtools.require.users import (
     sudoer,
 )
 from fabtools.require.groups import group
+from fabtools.require.packaging import (
+    nopackages,
+    packages,
+)
@@ -5,7 +5,6 @@ Curl
 This module provides high-level tools for using curl.
 
 """
-from fabtools.system import UnsupportedFamily, distrib_family
 
 
 def command():
@@ -22,17 +21,6 @@ def command():
 
     """
 
-    from fabtools.require.deb import package as require_deb_package
-    from fabtools.require.rpm import package as require_rpm_package
-    from fabtools.require.arch import package as require_arch_package
+    from fabtools.require import packages as require_packages
 
-    family = distrib_family()
-
-    if family == 'debian':
-        require_deb_package('curl')
-    elif family == 'redhat':
-        require_rpm_package('curl')
-    elif family == 'arch':
-        require_arch_package('curl')
-    else:
-        raise UnsupportedFamily(supported=['arch', 'debian', 'redhat'])
+    require_packages(['curl'])
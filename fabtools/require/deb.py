@@ -7,21 +7,38 @@ and repositories.
 
 """
 
+from pipes import quote
+import time
+
+from fabric.api import hide, settings
 from fabric.utils import puts
 
 from fabtools.deb import (
+    UPDATE_STAMP,
     add_apt_key,
     apt_key_exists,
     install,
+    installed_status,
     is_installed,
     uninstall,
     update_index,
-    last_update_time,
 )
 from fabtools.files import is_file, watch
 from fabtools.system import distrib_codename, distrib_release
-from fabtools.utils import run_as_root
-from fabtools import system
+from fabtools.utils import host_cache, run_as_root
+
+
+UPDATE_HOOK = '/etc/apt/apt.conf.d/15fabtools-update-stamp'
+
+UPDATE_HOOK_CONTENTS = (
+    'APT::Update::Post-Invoke-Success '
+    '{"touch %s 2>/dev/null || true";};' % UPDATE_STAMP)
+
+# Install the hook that touches the stamp file after each successful
+# update (unless it is already there), and print the age of the stamp
+_INDEX_AGE_SCRIPT = """\
+[ "$(cat %(hook)s 2>/dev/null)" = %(contents)s ] || echo %(contents)s > %(hook)s || exit 1
+if [ -f %(stamp)s ]; then echo $(( $(date +%%s) - $(stat -c %%Y %(stamp)s) )); else echo -1; fi"""
 
 
 def key(keyid, filename=None, url=None, keyserver='subkeys.pgp.net',
@@ -144,6 +161,12 @@ def packages(pkg_list, update=False, options=None):
     """
     Require several deb packages to be installed.
 
+    *pkg_list* can be a dict of package name => version (``None`` means
+    any version). Packages that are missing, or installed with another
+    version, are then installed or upgraded in a single ``apt-get`` call.
+    Versions must be given in full, including the epoch if the package
+    has one (``'1:2.4-1'``, not ``'2.4-1'``), as ``apt-get`` requires.
+
     Example::
 
         from fabtools import require
@@ -153,12 +176,34 @@ def packages(pkg_list, update=False, options=None):
             'bar',
             'baz',
         ])
+
+        # Require specific versions
+        require.deb.packages({
+            'foo': '1.2-1',
+            'bar': None,
+        })
     """
-    pkg_list = [pkg for pkg in pkg_list if not is_installed(pkg)]
+    status = installed_status(pkg_list)
+    if isinstance(pkg_list, dict):
+        pkg_list = dict(
+            (pkg, version) for pkg, version in pkg_list.items()
+            if status[pkg][0] != 'installed' or
+            (version and not _same_version(status[pkg][1], version)))
+    else:
+        pkg_list = [pkg for pkg in pkg_list if status[pkg][0] != 'installed']
     if pkg_list:
         install(pkg_list, update=update, options=options)
 
 
+def _same_version(installed, required):
+    """
+    A version without an epoch has epoch 0
+    """
+    def full(version):
+        return version if ':' in version else '0:' + version
+    return full(installed) == full(required)
+
+
 def nopackage(pkg_name):
     """
     Require a deb package to be uninstalled.
@@ -187,7 +232,8 @@ def nopackages(pkg_list):
             'ruby',
         ])
     """
-    pkg_list = [pkg for pkg in pkg_list if is_installed(pkg)]
+    status = installed_status(pkg_list)
+    pkg_list = [pkg for pkg in pkg_list if status[pkg][0] == 'installed']
     if pkg_list:
         uninstall(pkg_list)
 
@@ -232,6 +278,12 @@ def uptodate_index(quiet=True, max_age=86400):
     ``hours``, ``days``, ``weeks``, ``months``) and values are integers.
     The default value is 1 hour.
 
+    The APT hook recording the time of updates is installed, and the age
+    of the last update is checked, with a single remote command. The
+    result is remembered for the rest of the run, so that later calls only
+    need a remote command once *max_age* has passed (or never, if the
+    index is updated by :py:func:`fabtools.deb.update_index`).
+
     Examples: ::
 
         from fabtools import require
@@ -244,10 +296,22 @@ def uptodate_index(quiet=True, max_age=86400):
 
     """
 
-    from fabtools.require import file as require_file
-    require_file('/etc/apt/apt.conf.d/15fabtools-update-stamp', contents='''\
-APT::Update::Post-Invoke-Success {"touch /var/lib/apt/periodic/fabtools-update-success-stamp 2>/dev/null || true";};
-''', use_sudo=True)
+    max_age = _to_seconds(max_age)
+
+    # The time of the last update is remembered for the rest of the run
+    cache = host_cache('deb.index')
+    if 'updated' in cache and time.time() - cache['updated'] <= max_age:
+        return
 
-    if system.time() - last_update_time() > _to_seconds(max_age):
+    script = _INDEX_AGE_SCRIPT % {
+        'hook': quote(UPDATE_HOOK),
+        'contents': quote(UPDATE_HOOK_CONTENTS),
+        'stamp': quote(UPDATE_STAMP),
+    }
+    with settings(hide('running', 'stdout')):
+        age = int(run_as_root(script).splitlines()[-1])
+
+    if age < 0 or age > max_age:
         update_index(quiet=quiet)
+    else:
+        cache['updated'] = time.time() - age
@@ -7,29 +7,36 @@ directories.
 
 """
 
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+from fnmatch import fnmatch
 from pipes import quote
+from StringIO import StringIO
 from tempfile import mkstemp
 from urlparse import urlparse
-import hashlib
 import os
+import posixpath
+import tarfile
 from pathlib2 import Path
 
-from fabric.api import hide, put, run, settings
+from fabric.api import env, hide, put, run, settings, warn
+from fabric.contrib.project import rsync_project
 
 from fabtools.files import (
-    group as _group,
-    is_file,
-    is_dir,
-    md5sum,
-    mode as _mode,
-    owner as _owner,
-    umask,
+    checksum_tree,
+    compressed_stream,
+    content_checksum,
+    file_state,
+    local_checksum,
+    local_checksums,
+    manifest_record,
+    read_template,
+    stat_many,
+    upload_compressed,
 )
-from fabtools.utils import run_as_root
-from fabtools.edit import find, append, prepend
-
-
-BLOCKSIZE = 2 ** 20  # 1MB
+from fabtools.probes import probe
+from fabtools.utils import host_cache, run_as_root
+from fabtools.edit import insert_unless_found
 
 
 def directory(path, use_sudo=False, owner='', group='', mode=''):
@@ -46,25 +53,16 @@ def directory(path, use_sudo=False, owner='', group='', mode=''):
               ``fabtools.require`` module for convenience.
 
     """
-    func = use_sudo and run_as_root or run
-
-    if not is_dir(path):
-        func('mkdir -p "%(path)s"' % locals())
-
-    # Ensure correct owner
-    if (owner and _owner(path, use_sudo) != owner) or \
-       (group and _group(path, use_sudo) != group):
-        func('chown %(owner)s:%(group)s "%(path)s"' % locals())
-
-    # Ensure correct mode
-    if mode and _mode(path, use_sudo) != mode:
-        func('chmod %(mode)s "%(path)s"' % locals())
+    directories([path], use_sudo, owner, group, mode)
 
 
 def directories(path_list, use_sudo=False, owner='', group='', mode=''):
     """
     Require a list of directories to exist.
 
+    The current state of all directories is checked with a single remote
+    command, and any needed changes are applied with another one.
+
     ::
 
         from fabtools import require
@@ -78,13 +76,60 @@ def directories(path_list, use_sudo=False, owner='', group='', mode=''):
     .. note:: This function can be accessed directly from the
               ``fabtools.require`` module for convenience.
     """
-    for path in path_list:
-        directory(path, use_sudo, owner, group, mode)
+    func = use_sudo and run_as_root or run
+
+    path_list = list(path_list)
+    current = stat_many(path_list, use_sudo=use_sudo)
+
+    missing = [path for path in path_list
+               if current[path] is None or current[path].type != 'dir']
+
+    # Ensure correct owner
+    wrong_owner = [path for path in path_list
+                   if (owner and (current[path] is None or current[path].owner != owner)) or
+                   (group and (current[path] is None or current[path].group != group))]
+
+    # Ensure correct mode
+    wrong_mode = [path for path in path_list
+                  if mode and not _same_mode(current[path], mode)]
+
+    commands = []
+    if missing:
+        commands.append('mkdir -p %s' % _quote_all(missing))
+    if wrong_owner:
+        commands.append('chown %s:%s %s' % (owner, group, _quote_all(wrong_owner)))
+    if wrong_mode:
+        commands.append('chmod %s %s' % (_mode_arg(mode), _quote_all(wrong_mode)))
+    if commands:
+        func(' && '.join(commands))
+
+
+def _same_mode(record, mode):
+    return record is not None and record.mode is not None and \
+        int(record.mode, 8) == _mode_value(mode)
+
+
+def _mode_value(mode):
+    """
+    Modes can be given as integers (``0755``) or octal strings (``'755'``)
+    """
+    if isinstance(mode, (int, long)):
+        return mode
+    return int(mode, 8)
+
+
+def _mode_arg(mode):
+    return '%04o' % _mode_value(mode) if isinstance(mode, (int, long)) else mode
+
+
+def _quote_all(paths):
+    return ' '.join(quote(path) for path in paths)
 
 
 def file(path=None, contents=None, source=None, url=None, md5=None,
          use_sudo=False, owner=None, group='', mode=None, verify_remote=True,
-         temp_dir='/tmp'):
+         temp_dir='/tmp', algorithm='md5', manifest=False, delta=False,
+         compression=None):
     """
     Require a file to exist and have specific contents and properties.
 
@@ -116,6 +161,16 @@ def file(path=None, contents=None, source=None, url=None, md5=None,
     same if it is present. This is useful for very large files, where
     generating an MD5 sum may take a while.
 
+    The *algorithm* parameter can be used to compare checksums using
+    ``sha1``, ``sha256`` or ``xxh64`` instead of ``md5`` (see
+    :py:func:`fabtools.files.checksum`).
+
+    If *manifest* is ``True``, the checksum of the uploaded file is
+    recorded in a manifest on the remote host, along with its size,
+    modification time and inode. Later calls trust the recorded checksum
+    as long as these are unchanged, instead of reading the whole remote
+    file again (see :py:func:`fabtools.files.manifest_record`).
+
     When providing either the *contents* or the *source* parameter, Fabric's
     ``put`` function will be used to upload the file to the remote host.
     When ``use_sudo`` is ``True``, the file will first be uploaded to a temporary
@@ -124,87 +179,266 @@ def file(path=None, contents=None, source=None, url=None, md5=None,
     If *temp_dir* is an empty string, then the user's home directory will
     be used.
 
+    If *delta* is ``True`` and the remote file already exists, ``rsync`` will
+    be used instead, so that only the changed parts of the file are sent
+    (this requires ``rsync`` on both hosts, key-based SSH authentication
+    and, when *use_sudo* is ``True``, passwordless ``sudo``). Fabric's
+    ``put`` is used as a fallback when ``rsync`` is not available.
+
+    If *compression* is ``'gzip'`` or ``'zstd'``, the file is instead sent
+    as a compressed stream, straight into its final location (see
+    :py:func:`fabtools.files.upload_compressed`), so that no temporary
+    file is used, either locally or on the remote host.
+
     If `use_sudo` is `True`, then the remote file will be owned by root,
     and its mode will reflect root's default *umask*. The optional *owner*,
     *group* and *mode* parameters can be used to override these properties.
 
+    Returns ``True`` if the contents of the file were created or changed.
+
     .. note:: This function can be accessed directly from the
               ``fabtools.require`` module for convenience.
 
     """
     func = use_sudo and run_as_root or run
+    commands = []
+    uploaded = False
+    digest = None
 
     # 1) Only a path is given
     if path and not (contents or source or url):
         assert path
-        if not is_file(path):
-            func('touch "%(path)s"' % locals())
+        state = file_state(path, use_sudo=use_sudo, digest=False)
+        if not _is_file(state):
+            commands.append('touch %s' % quote(path))
 
     # 2) A URL is specified (path is optional)
     elif url:
         if not path:
             path = os.path.basename(urlparse(url).path)
 
-        if not is_file(path) or md5 and md5sum(path) != md5:
-            func('wget --progress=dot:mega "%(url)s" -O "%(path)s"' % locals())
+        state = file_state(path, use_sudo=use_sudo, digest=bool(md5))
+        if not _is_file(state) or md5 and state.digest != md5:
+            commands.append('wget --progress=dot:mega %s -O %s' % (quote(url), quote(path)))
 
     # 3) A local filename, or a content string, is specified
     else:
         if source:
             assert not contents
-            t = None
-        else:
-            fd, source = mkstemp()
-            t = os.fdopen(fd, 'w')
-            t.write(contents)
-            t.close()
-
-        if verify_remote:
-            # Avoid reading the whole file into memory at once
-            digest = hashlib.md5()
-            f = open(source, 'rb')
-            try:
-                while True:
-                    d = f.read(BLOCKSIZE)
-                    if not d:
-                        break
-                    digest.update(d)
-            finally:
-                f.close()
-        else:
+
+        if not verify_remote:
             digest = None
+        elif source:
+            digest = local_checksum(source, algo=algorithm)
+        else:
+            digest = content_checksum(contents, algo=algorithm)
 
-        if (not is_file(path, use_sudo=use_sudo) or
-                (verify_remote and
-                    md5sum(path, use_sudo=use_sudo) != digest.hexdigest())):
-            with settings(hide('running')):
-                put(source, path, use_sudo=use_sudo, temp_dir=temp_dir)
+        state = file_state(path, use_sudo=use_sudo, digest=verify_remote,
+                           algo=algorithm, manifest=manifest)
+        if (not _is_file(state) or
+                (verify_remote and state.digest != digest)):
+            _upload(path, source, contents, use_sudo, temp_dir,
+                    delta=delta and _is_file(state), compression=compression)
+            uploaded = True
+
+    changed = bool(commands) or uploaded
 
-        if t is not None:
-            os.unlink(source)
+    # Attributes of a new file are not known without another probe
+    current = None if changed else state.stat
 
     # Ensure correct owner
     if use_sudo and owner is None:
         owner = 'root'
-    if (owner and _owner(path, use_sudo) != owner) or \
-       (group and _group(path, use_sudo) != group):
-        func('chown %(owner)s:%(group)s "%(path)s"' % locals())
+    if (owner and (current is None or current.owner != owner)) or \
+       (group and (current is None or current.group != group)):
+        commands.append('chown %s:%s %s' % (owner, group, quote(path)))
 
     # Ensure correct mode
     if use_sudo and mode is None:
-        mode = oct(0666 & ~int(umask(use_sudo=True), base=8))
-    if mode and _mode(path, use_sudo) != mode:
-        func('chmod %(mode)s "%(path)s"' % locals())
+        mode = oct(0666 & ~int(state.umask, base=8))
+    if mode and not _same_mode(current, mode):
+        commands.append('chmod %s %s' % (_mode_arg(mode), quote(path)))
+
+    # Record the checksum of the file, unless it is already known
+    if manifest and digest and (uploaded or not state.from_manifest):
+        commands.append(manifest_record(path, digest, algo=algorithm,
+                                        use_sudo=use_sudo))
+
+    if commands:
+        func(' && '.join(commands))
+
+    return changed
+
+
+def _is_file(state):
+    return state.stat is not None and state.stat.type == 'file'
+
+
+def _upload(path, source, contents, use_sudo, temp_dir, delta, compression):
+    """
+    Upload a local file or a content string to the remote host
+    """
+    if delta:
+        with _local_file(source, contents) as filename:
+            if _delta_upload(filename, path, use_sudo):
+                return
+    if compression:
+        upload_compressed(source or StringIO(contents), path,
+                          use_sudo=use_sudo, compression=compression)
+    else:
+        with _local_file(source, contents) as filename:
+            with settings(hide('running')):
+                put(filename, path, use_sudo=use_sudo, temp_dir=temp_dir)
+
+
+@contextmanager
+def _local_file(source, contents):
+    """
+    Get the local filename of the source, or of a temporary file
+    holding the contents
+    """
+    if source:
+        yield source
+        return
+    fd, filename = mkstemp()
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        yield filename
+    finally:
+        os.unlink(filename)
+
+
+def _delta_upload(source, path, use_sudo):
+    """
+    Update a remote file using rsync's delta-transfer algorithm
+
+    Returns ``False`` if rsync is not available or fails, so that the
+    caller can fall back to a full upload.
+    """
+    if not find_executable('rsync') or not _has_rsync(use_sudo):
+        return False
+
+    if env.cwd and not posixpath.isabs(path):
+        path = posixpath.join(env.cwd, path)
+    if use_sudo and env.user != 'root':
+        extra_opts = '--rsync-path="sudo -n rsync"'
+    else:
+        extra_opts = ''
+
+    with settings(hide('running', 'stdout'), warn_only=True):
+        res = rsync_project(remote_dir=quote(path), local_dir=quote(source),
+                            default_opts='-z', extra_opts=extra_opts)
+    if res.failed:
+        warn('rsync failed, uploading the whole file')
+        return False
+    return True
+
+
+def _has_rsync(use_sudo):
+    cache = host_cache('files.tools')
+    if 'rsync' not in cache:
+        cache['rsync'] = probe('command -v rsync',
+                               lambda output, return_code: return_code == 0,
+                               use_sudo=use_sudo)
+    return cache['rsync']
+
+
+def tree(local_dir, remote_dir, use_sudo=False, owner='', group='',
+         delete=False, exclude=None, algorithm='md5', compression='gzip'):
+    """
+    Require a remote directory tree to contain the files of a local one.
+
+    The checksums of the local files (see
+    :py:func:`fabtools.files.local_checksum`) are compared to those of
+    the remote files, which are computed with a single remote command
+    (see :py:func:`fabtools.files.checksum_tree`). Files that are missing
+    or different on the remote host are then sent together, as a single
+    compressed ``tar`` stream (see :py:func:`fabtools.files.compressed_stream`).
+
+    If *delete* is ``True``, remote files that do not exist in the local
+    tree are removed. Files whose relative path matches one of the glob
+    patterns in *exclude* are ignored on both sides.
+
+    Symbolic links in the local tree are sent as the files they point to.
+
+    The optional *owner* and *group* are applied to the uploaded files,
+    and to the directories that contain them.
+
+    ::
+
+        from fabtools import require
+
+        require.files.tree('static', '/srv/www/static', use_sudo=True,
+                           owner='www-data', delete=True)
+
+    """
+    func = use_sudo and run_as_root or run
+    exclude = exclude or []
+
+    def included(name):
+        return not any(fnmatch(name, pattern) for pattern in exclude)
+
+    local_files = {}
+    for dirpath, dirnames, filenames in os.walk(local_dir):
+        for filename in filenames:
+            full_path = os.path.join(dirpath, filename)
+            name = os.path.relpath(full_path, local_dir).replace(os.sep, '/')
+            # Skip broken symbolic links
+            if included(name) and os.path.isfile(full_path):
+                local_files[name] = full_path
+
+    remote_digests = checksum_tree(remote_dir, algo=algorithm, use_sudo=use_sudo)
+    remote_files = set(name for name in remote_digests if included(name))
+
+    local_digests = local_checksums(local_files.values(), algo=algorithm)
+    changed = sorted(
+        name for name, full_path in local_files.items()
+        if remote_digests.get(name) != local_digests[full_path]
+    )
+    extra = sorted(remote_files - set(local_files)) if delete else []
+
+    commands = []
+    if extra:
+        commands.append('rm -f -- %s' % _quote_all(
+            posixpath.join(remote_dir, name) for name in extra))
+    if changed and (owner or group):
+        # Also the directories that mkdir and tar may have created
+        dirs = set()
+        for name in changed:
+            while '/' in name:
+                name = posixpath.dirname(name)
+                dirs.add(name)
+        commands.append('chown %s:%s %s' % (owner, group, _quote_all(
+            [remote_dir] + [posixpath.join(remote_dir, name)
+                            for name in sorted(dirs) + changed])))
+
+    if changed:
+        script = ' && '.join([
+            'mkdir -p %s' % quote(remote_dir),
+            '%%(decompress)s | tar -xf - --no-same-owner -C %s' % quote(remote_dir),
+        ] + commands)
+        with compressed_stream(script, use_sudo=use_sudo,
+                               compression=compression) as stream:
+            archive = tarfile.open(fileobj=stream, mode='w|', dereference=True)
+            for name in changed:
+                archive.add(local_files[name], arcname=name, recursive=False)
+            archive.close()
+    elif commands:
+        func(' && '.join(commands))
 
 
 def template_file(path=None, template_contents=None, template_source=None,
                   context=None, **kwargs):
     """
     Require a file whose contents is defined by a template.
+
+    The *template_source* file is read through a process-wide cache
+    (see :py:func:`fabtools.files.read_template`), so that it is only
+    read once when converging many hosts.
     """
     if template_contents is None:
-        with open(template_source) as template_file:
-            template_contents = template_file.read()
+        template_contents = read_template(template_source)
 
     if context is None:
         context = {}
@@ -267,6 +501,8 @@ def file_contains(text, path, unless=None, after=None, before=None, backup=None,
     """
     Ensure that a file exists and contains the supplied text unless a pattern is matched. Conditions can be set
     on how the text is positioned. A backup file will be created if naming info is specified.
+    The checks and the insertion are done by a single remote command, holding a lock on the file when flock(1)
+    is available (see :py:func:`fabtools.edit.insert_unless_found`).
     :param text: Literal text that will be found or inserted in the file if 'unless' pattern not matched
     :param path: The file to process as Path or string
     :param unless: Line number, string or compiled regex that if matched will prevent insertion of the text
@@ -277,17 +513,7 @@ def file_contains(text, path, unless=None, after=None, before=None, backup=None,
     :param backup: Extension (or sed style name string) for making a backup of the file before processing.
     :param use_sudo:
     """
-    func = use_sudo and run_as_root or run
     path = Path(path)
     assert isinstance(text, basestring), "Text must be a string"
 
-    if unless and find(unless, path, start=after, stop=before, multi_line=True, use_sudo=use_sudo):
-        return
-
-    if not find(text, path,  start=after, stop=before, multi_line=True, use_sudo=use_sudo):
-        if after or not before:
-            append(text, path, pat=after, start=after, stop=before, backup=backup, use_sudo=use_sudo)
-        else:
-            prepend(text, path, pat=before, start=after, stop=before, backup=backup, use_sudo=use_sudo)
-
-
+    insert_unless_found(text, path, unless=unless, after=after, before=before, backup=backup, use_sudo=use_sudo)
@@ -0,0 +1,128 @@
+"""
+Packages on any distribution
+============================
+
+This module provides high-level tools for managing packages without
+having to know the package manager of the remote host.
+
+The package backend (:py:mod:`fabtools.deb`, :py:mod:`fabtools.rpm`...)
+is chosen from the distribution family, which is part of the cached
+:py:func:`system facts <fabtools.system.facts>`, and all the packages of
+a call are checked and installed together.
+
+"""
+
+from fabtools import arch, deb, pkg, portage, rpm
+from fabtools.system import UnsupportedFamily, distrib_family
+
+
+BACKENDS = {
+    'arch': arch,
+    'debian': deb,
+    'gentoo': portage,
+    'redhat': rpm,
+    'sun': pkg,
+}
+
+
+def packages(spec, options=None):
+    """
+    Require several packages to be installed, with the package manager of
+    the remote host.
+
+    *spec* is a list of package names. When a package is not named the same
+    on all distributions, use a dict with the names for each distribution
+    family (``debian``, ``redhat``, ``arch``, ``gentoo``, ``sun``), and
+    optionally a ``default`` entry. Each name can be a single package, a
+    list of packages, or ``None`` if nothing is needed for this family.
+
+    The installed packages are checked with a single remote command (see
+    :py:class:`fabtools.inventory.Inventory`), and the missing ones are
+    installed with a single call to the package manager.
+
+    Extra *options* may be passed to the package manager if necessary.
+
+    Example::
+
+        from fabtools import require
+
+        require.packages([
+            'curl',
+            {'debian': 'build-essential', 'redhat': ['gcc', 'make']},
+            {'redhat': 'supervisord', 'default': 'supervisor'},
+        ])
+
+    Raises :py:class:`~fabtools.system.UnsupportedFamily` if the package
+    manager of the remote host is not supported, or if a dict in *spec*
+    has no entry for its distribution family.
+
+    .. note:: This function can be accessed directly from the
+              ``fabtools.require`` module for convenience.
+
+    """
+    family = distrib_family()
+    pkg_list = _names(spec, family)
+    if not pkg_list:
+        return
+    backend = _backend(family)
+    pkg_list = [name for name in pkg_list if not backend.is_installed(name)]
+    if pkg_list:
+        backend.install(pkg_list, options=options)
+
+
+def nopackages(spec, options=None):
+    """
+    Require several packages to be uninstalled, with the package manager
+    of the remote host.
+
+    *spec* has the same format as for :py:func:`packages`.
+
+    ::
+
+        from fabtools import require
+
+        require.nopackages([
+            {'debian': 'apache2', 'redhat': 'httpd'},
+        ])
+
+    .. note:: This function can be accessed directly from the
+              ``fabtools.require`` module for convenience.
+
+    """
+    family = distrib_family()
+    pkg_list = _names(spec, family)
+    if not pkg_list:
+        return
+    backend = _backend(family)
+    pkg_list = [name for name in pkg_list if backend.is_installed(name)]
+    if pkg_list:
+        backend.uninstall(pkg_list, options=options)
+
+
+def _backend(family):
+    if family not in BACKENDS:
+        raise UnsupportedFamily(supported=sorted(BACKENDS))
+    return BACKENDS[family]
+
+
+def _names(spec, family):
+    if isinstance(spec, (basestring, dict)):
+        spec = [spec]
+    names = []
+    for item in spec:
+        if isinstance(item, dict):
+            if family in item:
+                item = item[family]
+            elif 'default' in item:
+                item = item['default']
+            else:
+                raise UnsupportedFamily(
+                    supported=sorted(k for k in item if k != 'default'))
+        if item is None:
+            continue
+        if isinstance(item, basestring):
+            item = [item]
+        for name in item:
+            if name not in names:
+                names.append(name)
+    return names
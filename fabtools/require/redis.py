@@ -11,7 +11,6 @@ This module provides high-level tools for managing `Redis`_ instances.
 from fabric.api import cd, run, settings
 
 from fabtools.files import is_file, watch
-from fabtools.system import distrib_family
 from fabtools.utils import run_as_root
 import fabtools.supervisor
 
@@ -36,22 +35,12 @@ def installed_from_source(version=VERSION):
     """
     from fabtools.require import directory as require_directory
     from fabtools.require import file as require_file
+    from fabtools.require import packages as require_packages
     from fabtools.require import user as require_user
-    from fabtools.require.deb import packages as require_deb_packages
-    from fabtools.require.rpm import packages as require_rpm_packages
 
-    family = distrib_family()
-
-    if family == 'debian':
-        require_deb_packages([
-            'build-essential',
-        ])
-
-    elif family == 'redhat':
-        require_rpm_packages([
-            'gcc',
-            'make',
-        ])
+    require_packages([
+        {'debian': 'build-essential', 'redhat': ['gcc', 'make'], 'default': None},
+    ])
 
     require_user('redis', home='/var/lib/redis', system=True)
     require_directory('/var/lib/redis', owner='redis', use_sudo=True)
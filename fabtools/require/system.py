@@ -39,11 +39,10 @@ def sysctl(key, value, persist=True):
         from fabtools.require import file as require_file
 
         filename = '/etc/sysctl.d/60-%s.conf' % key
-        with watch(filename, use_sudo=True) as config:
-            require_file(filename,
-                         contents='%(key)s = %(value)s\n' % locals(),
-                         use_sudo=True)
-        if config.changed:
+        changed = require_file(filename,
+                               contents='%(key)s = %(value)s\n' % locals(),
+                               use_sudo=True)
+        if changed:
             if distrib_family() == 'debian':
                 with settings(warn_only=True):
                     run_as_root('service procps start')
@@ -9,6 +9,7 @@ and repositories.
 
 from fabric.api import hide, run, settings
 
+from fabtools.inventory import Inventory
 from fabtools.utils import run_as_root
 
 
@@ -64,10 +65,30 @@ def groupupdate(group, options=None):
     run_as_root('%(manager)s %(options)s groupupdate "%(group)s"' % locals())
 
 
+def _parse_rpm_inventory(output):
+    # Each package can be queried by name, name.arch, name-version...
+    return set(output.split())
+
+
+INVENTORY = Inventory(
+    'rpm',
+    "rpm --query --all --queryformat '%{NAME} %{NAME}.%{ARCH} "
+    "%{NAME}-%{VERSION} %{NAME}-%{VERSION}-%{RELEASE} "
+    "%{NAME}-%{VERSION}-%{RELEASE}.%{ARCH}\\n'",
+    _parse_rpm_inventory)
+
+
 def is_installed(pkg_name):
     """
     Check if an RPM package is installed.
+
+    The answer comes from the :py:class:`~fabtools.inventory.Inventory`
+    of the host, loaded once with ``rpm --query --all``.
     """
+    return INVENTORY.is_installed(pkg_name, _is_installed)
+
+
+def _is_installed(pkg_name):
     manager = MANAGER
     with settings(
             hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
@@ -117,6 +138,7 @@ def install(packages, repos=None, yes=None, options=None):
         run_as_root('yes %(yes)s | %(manager)s %(options)s install %(packages)s' % locals())
     else:
         run_as_root('%(manager)s %(options)s install %(packages)s' % locals())
+    INVENTORY.add(packages)
 
 
 def groupinstall(group, options=None):
@@ -145,6 +167,7 @@ def groupinstall(group, options=None):
     run_as_root(
         '%(manager)s %(options)s groupinstall "%(group)s"' % locals(),
         pty=False)
+    INVENTORY.invalidate()
 
 
 def uninstall(packages, options=None):
@@ -163,6 +186,7 @@ def uninstall(packages, options=None):
         packages = " ".join(packages)
     options = " ".join(options)
     run_as_root('%(manager)s %(options)s remove %(packages)s' % locals())
+    INVENTORY.invalidate()
 
 
 def groupuninstall(group, options=None):
@@ -179,6 +203,7 @@ def groupuninstall(group, options=None):
         options = [options]
     options = " ".join(options)
     run_as_root('%(manager)s %(options)s groupremove "%(group)s"' % locals())
+    INVENTORY.invalidate()
 
 
 def repolist(status='', media=None):
@@ -6,11 +6,10 @@ This module provides tools to manage OpenSSH server and client.
 
 """
 
-from fabric.api import hide, shell_env
-from fabric.contrib.files import append, sed
+import re
 
+from fabtools.edit import insert_unless_found, replace
 from fabtools.service import is_running, restart
-from fabtools.files import watch
 
 
 def harden(allow_root_login=False, allow_password_auth=False,
@@ -81,28 +80,15 @@ def _update_ssh_setting(sshd_config, name, value):
     Update a yes/no setting in the SSH config file
     """
 
-    with watch(sshd_config) as config_file:
+    setting = '%s %s' % (name, value)
 
-        with shell_env():
+    # First try to change existing setting
+    changed = replace(re.compile(r'^(\s*#\s*)?%s\s+(yes|no)' % name),
+                      setting, sshd_config, do_all=True, backup='.bak', use_sudo=True)
 
-            # First try to change existing setting
-            sed(sshd_config,
-                r'^(\s*#\s*)?%s\s+(yes|no)' % name,
-                '%s %s' % (name, value),
-                use_sudo=True)
+    # Then append setting if it's still missing
+    if insert_unless_found(setting, sshd_config, whole_lines=True, backup='.bak', use_sudo=True):
+        changed = True
 
-            # Then append setting if it's still missing
-            _append(sshd_config,
-                    '%s %s' % (name, value),
-                    use_sudo=True)
-
-    if config_file.changed and is_running('ssh'):
+    if changed and is_running('ssh'):
         restart('ssh')
-
-
-def _append(filename, regex, use_sudo):
-    """
-    Less verbose append
-    """
-    with hide('stdout', 'warnings'):
-        return append(filename, regex, use_sudo=use_sudo)
@@ -3,10 +3,17 @@ System settings
 ===============
 """
 
-from fabric.api import hide, run, settings
+import re
+import time as _time
 
-from fabtools.files import is_file
-from fabtools.utils import read_lines, run_as_root
+from fabric.api import env, hide, run, settings
+
+from fabtools.utils import (
+    clear_host_cache,
+    host_cache,
+    read_lines,
+    run_as_root,
+)
 
 
 class UnsupportedFamily(Exception):
@@ -35,6 +42,149 @@ class UnsupportedFamily(Exception):
         super(UnsupportedFamily, self).__init__(msg)
 
 
+# Gather everything we need to know about the OS in a single round trip
+_FACTS_SCRIPT = """\
+echo "kernel=$(uname -s)"
+echo "kernel_version=$(uname -v)"
+echo "arch=$(uname -m)"
+if [ -f /usr/bin/lsb_release ]; then
+    echo "lsb_id=$(lsb_release --id --short 2>/dev/null)"
+    echo "lsb_release=$(lsb_release --release --short 2>/dev/null)"
+    echo "lsb_codename=$(lsb_release --codename --short 2>/dev/null)"
+    echo "lsb_desc=$(lsb_release --desc --short 2>/dev/null)"
+fi
+for f in /etc/debian_version /etc/fedora-release /etc/arch-release /etc/redhat-release /etc/gentoo-release; do
+    [ -f $f ] && echo "release_file=$f"
+done
+[ -f /etc/redhat-release ] && echo "redhat_release=$(head -n 1 /etc/redhat-release)"
+echo "cpus=$(getconf _NPROCESSORS_ONLN 2>/dev/null || python -c 'import multiprocessing; print(multiprocessing.cpu_count())')"
+which systemctl >/dev/null 2>&1 && echo "systemd=yes"
+true
+"""
+
+
+def facts(max_age=None, refresh=False):
+    """
+    Get facts about the remote system.
+
+    All the facts are collected with a single remote command the first
+    time this function is called for a host, then cached for the rest of
+    the Python process. Returns a dictionary with the following keys:
+    ``kernel``, ``distrib_id``, ``distrib_release``, ``distrib_codename``,
+    ``distrib_desc``, ``arch``, ``cpus`` and ``using_systemd``.
+
+    The cached facts are collected again if they are older than *max_age*
+    seconds (defaults to ``env.facts_max_age``, or no limit if unset),
+    or if *refresh* is ``True``.
+
+    Example::
+
+        from fabtools.system import facts
+
+        if facts()['arch'] == 'x86_64':
+            print(u"Running on a 64-bit Intel/AMD system")
+
+    .. seealso:: :py:func:`fabtools.system.invalidate_facts`
+    """
+    cache = host_cache('system.facts')
+    if max_age is None:
+        max_age = env.get('facts_max_age')
+
+    if not refresh and 'facts' in cache:
+        if max_age is None or _time.time() - cache['timestamp'] <= max_age:
+            return cache['facts']
+
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        res = run(_FACTS_SCRIPT)
+
+    cache['facts'] = _parse_facts(res)
+    cache['timestamp'] = _time.time()
+    return cache['facts']
+
+
+def invalidate_facts(host_string=None):
+    """
+    Forget the cached facts about a host.
+
+    By default, the facts about the current host are forgotten,
+    and will be collected again on next use.
+    """
+    if host_string is None:
+        host_string = env.host_string
+    clear_host_cache('system.facts', host_string=host_string)
+
+
+def _parse_facts(output):
+    raw = {}
+    release_files = set()
+    for line in output.splitlines():
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            continue
+        if key == 'release_file':
+            release_files.add(value)
+        else:
+            raw[key] = value
+
+    kernel = raw.get('kernel')
+    distrib_id = _distrib_id(kernel, raw, release_files)
+
+    if kernel == 'SunOS':
+        release = raw.get('kernel_version')
+    elif raw.get('lsb_release'):
+        release = raw['lsb_release']
+    else:
+        match = re.search(r'release ([\d.]+)', raw.get('redhat_release', ''))
+        release = match.group(1) if match else None
+
+    try:
+        nb_cpus = int(raw.get('cpus'))
+    except (TypeError, ValueError):
+        nb_cpus = None
+
+    return {
+        'kernel': kernel,
+        'distrib_id': distrib_id,
+        'distrib_release': release,
+        'distrib_codename': raw.get('lsb_codename') or None,
+        'distrib_desc': raw.get('redhat_release') or raw.get('lsb_desc'),
+        'arch': raw.get('arch'),
+        'cpus': nb_cpus,
+        'using_systemd': raw.get('systemd') == 'yes',
+    }
+
+
+def _distrib_id(kernel, raw, release_files):
+    if kernel == 'Linux':
+        # lsb_release works on Ubuntu and Debian >= 6.0
+        # but is not always included in other distros
+        if raw.get('lsb_id'):
+            id_ = raw['lsb_id']
+            if id_ in ['arch', 'Archlinux']:  # old IDs used before lsb-release 1.4-14
+                id_ = 'Arch'
+            elif id_ in ['SUSE LINUX', 'openSUSE project']:
+                id_ = 'SUSE'
+            return id_
+        elif '/etc/debian_version' in release_files:
+            return "Debian"
+        elif '/etc/fedora-release' in release_files:
+            return "Fedora"
+        elif '/etc/arch-release' in release_files:
+            return "Arch"
+        elif '/etc/redhat-release' in release_files:
+            release = raw.get('redhat_release', '')
+            if release.startswith('Red Hat Enterprise Linux'):
+                return "RHEL"
+            elif release.startswith('CentOS'):
+                return "CentOS"
+            elif release.startswith('Scientific Linux'):
+                return "SLES"
+        elif '/etc/gentoo-release' in release_files:
+            return "Gentoo"
+    elif kernel == "SunOS":
+        return "SunOS"
+
+
 def distrib_id():
     """
     Get the OS distribution ID.
@@ -51,39 +201,7 @@ def distrib_id():
             abort(u"Distribution is not supported")
 
     """
-
-    with settings(hide('running', 'stdout')):
-        kernel = run('uname -s')
-
-        if kernel == 'Linux':
-            # lsb_release works on Ubuntu and Debian >= 6.0
-            # but is not always included in other distros
-            if is_file('/usr/bin/lsb_release'):
-                id_ = run('lsb_release --id --short')
-                if id in ['arch', 'Archlinux']:  # old IDs used before lsb-release 1.4-14
-                    id_ = 'Arch'
-                return id_
-                if id in ['SUSE LINUX', 'openSUSE project']:
-                    id_ = 'SUSE'
-            else:
-                if is_file('/etc/debian_version'):
-                    return "Debian"
-                elif is_file('/etc/fedora-release'):
-                    return "Fedora"
-                elif is_file('/etc/arch-release'):
-                    return "Arch"
-                elif is_file('/etc/redhat-release'):
-                    release = run('cat /etc/redhat-release')
-                    if release.startswith('Red Hat Enterprise Linux'):
-                        return "RHEL"
-                    elif release.startswith('CentOS'):
-                        return "CentOS"
-                    elif release.startswith('Scientific Linux'):
-                        return "SLES"
-                elif is_file('/etc/gentoo-release'):
-                    return "Gentoo"
-        elif kernel == "SunOS":
-            return "SunOS"
+    return facts()['distrib_id']
 
 
 def distrib_release():
@@ -98,16 +216,7 @@ def distrib_release():
             print(u"CentOS 6.2 has been released. Please upgrade.")
 
     """
-
-    with settings(hide('running', 'stdout')):
-
-        kernel = run('uname -s')
-
-        if kernel == 'Linux':
-            return run('lsb_release -r --short')
-
-        elif kernel == 'SunOS':
-            return run('uname -v')
+    return facts()['distrib_release']
 
 
 def distrib_codename():
@@ -122,8 +231,7 @@ def distrib_codename():
             print(u"Ubuntu 12.04 LTS detected")
 
     """
-    with settings(hide('running', 'stdout')):
-        return run('lsb_release --codename --short')
+    return facts()['distrib_codename']
 
 
 def distrib_desc():
@@ -132,10 +240,7 @@ def distrib_desc():
 
     For example: ``Debian GNU/Linux 6.0.7 (squeeze)``.
     """
-    with settings(hide('running', 'stdout')):
-        if not is_file('/etc/redhat-release'):
-            return run('lsb_release --desc --short')
-        return run('cat /etc/redhat-release')
+    return facts()['distrib_desc']
 
 
 def distrib_family():
@@ -177,6 +282,7 @@ def set_hostname(hostname, persist=True):
     run_as_root('hostname %s' % hostname)
     if persist:
         run_as_root('echo %s >/etc/hostname' % hostname)
+    invalidate_facts()
 
 
 def get_sysctl(key):
@@ -260,9 +366,7 @@ def get_arch():
             print(u"Running on a 64-bit Intel/AMD system")
 
     """
-    with settings(hide('running', 'stdout')):
-        arch = run('uname -m')
-        return arch
+    return facts()['arch']
 
 
 def cpus():
@@ -276,10 +380,7 @@ def cpus():
         nb_workers = 2 * cpus() + 1
 
     """
-    with settings(hide('running', 'stdout')):
-        res = run('python -c "import multiprocessing; '
-                  'print(multiprocessing.cpu_count())"')
-        return int(res)
+    return facts()['cpus']
 
 
 def using_systemd():
@@ -295,7 +396,7 @@ def using_systemd():
             pass
 
     """
-    return run('which systemctl', quiet=True).succeeded
+    return facts()['using_systemd']
 
 
 def time():
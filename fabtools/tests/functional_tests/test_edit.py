@@ -1,4 +1,5 @@
 from __future__ import absolute_import, print_function
+import os
 import unittest
 import re
 from pathlib2 import Path
@@ -227,6 +228,307 @@ class EditTestCase(unittest.TestCase):
         self.assertFalse(find('#', self.textfile, use_sudo=local))
 
 
+class InsertUnlessFoundTestCase(unittest.TestCase):
+    """
+    Tests for the single-command conditional insertion
+    """
+
+    def setUp(self):
+        with NamedTemporaryFile(delete=False) as dat:
+            self.textfile = Path(dat.name)
+            dat.write(_TEST_TEXT + '\n')
+
+    def tearDown(self):
+        self.textfile.unlink()
+
+    def test_insert_at_end(self):
+        from fabtools.edit import insert_unless_found
+        self.assertTrue(insert_unless_found('eight', self.textfile, use_sudo=local))
+        self.assertFalse(insert_unless_found('eight', self.textfile, use_sudo=local))
+        self.assertEqual(self.textfile.read_text().split(), _TEST_TEXT.split() + ['eight'])
+
+    def test_multi_line_text_already_there(self):
+        from fabtools.edit import insert_unless_found
+        self.assertFalse(insert_unless_found('two\nthree', self.textfile, use_sudo=local))
+        self.assertEqual(self.textfile.read_text(), _TEST_TEXT + '\n')
+
+    def test_unless(self):
+        from fabtools.edit import insert_unless_found
+        self.assertFalse(insert_unless_found('eight', self.textfile, unless=re.compile('s.x'), use_sudo=local))
+        self.assertEqual(self.textfile.read_text(), _TEST_TEXT + '\n')
+
+    def test_after_and_before(self):
+        from fabtools.edit import insert_unless_found
+        self.assertTrue(insert_unless_found('2.5', self.textfile, after='two', use_sudo=local))
+        self.assertTrue(insert_unless_found('4.5', self.textfile, before='five', use_sudo=local))
+        self.assertEqual(self.textfile.read_text().split(),
+                         ['one', 'two', '2.5', 'three', 'four', '4.5', 'five', 'six', 'seven'])
+
+    def test_whole_lines(self):
+        from fabtools.edit import insert_unless_found
+        self.assertFalse(insert_unless_found('ev', self.textfile, use_sudo=local))
+        self.assertTrue(insert_unless_found('ev', self.textfile, whole_lines=True, use_sudo=local))
+        self.assertFalse(insert_unless_found('ev', self.textfile, whole_lines=True, use_sudo=local))
+        self.assertFalse(insert_unless_found('one\ntwo', self.textfile, whole_lines=True, use_sudo=local))
+        self.assertFalse(insert_unless_found('seven', self.textfile, whole_lines=True, use_sudo=local))
+        self.assertEqual(self.textfile.read_text().split(), _TEST_TEXT.split() + ['ev'])
+
+    def test_empty_file(self):
+        from fabtools.edit import insert_unless_found
+        self.textfile.write_text(u'')
+        self.assertTrue(insert_unless_found('eight\nnine', self.textfile, use_sudo=local))
+        self.assertFalse(insert_unless_found('eight\nnine', self.textfile, use_sudo=local))
+        self.assertEqual(self.textfile.read_text(), 'eight\nnine\n')
+
+    def test_no_lock(self):
+        from fabtools.edit import insert_unless_found
+        self.assertTrue(insert_unless_found('eight', self.textfile, lock=False, use_sudo=local))
+        self.assertEqual(self.textfile.read_text().split(), _TEST_TEXT.split() + ['eight'])
+
+
+class WriteBackTestCase(unittest.TestCase):
+    """
+    Tests for the atomic replacement of edited files
+    """
+
+    def setUp(self):
+        import tempfile
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        self.textfile = self.tmp_dir / 'config'
+        self.textfile.write_bytes(_TEST_TEXT + '\n')
+        os.chmod(str(self.textfile), 0o640)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(str(self.tmp_dir))
+
+    def test_file_is_renamed_into_place(self):
+        from fabtools.edit import replace_line
+        inode = os.stat(str(self.textfile)).st_ino
+        self.assertTrue(replace_line('two', 'TWO', self.textfile, backup='.bak', use_sudo=local))
+        self.assertNotEqual(os.stat(str(self.textfile)).st_ino, inode)
+        self.assertEqual(os.stat(str(self.textfile)).st_mode & 0o777, 0o640)
+        self.assertEqual(sorted(os.listdir(str(self.tmp_dir))), ['config', 'config.bak'])
+
+    def test_symlink_is_kept(self):
+        from fabtools.edit import insert_unless_found
+        link = self.tmp_dir / 'link'
+        os.symlink('config', str(link))
+        self.assertTrue(insert_unless_found('eight', link, use_sudo=local))
+        self.assertTrue(os.path.islink(str(link)))
+        self.assertEqual(self.textfile.read_text().split(), _TEST_TEXT.split() + ['eight'])
+
+
+class TransactionTestCase(unittest.TestCase):
+    """
+    Tests for multi-operation edit transactions
+    """
+    engine = 'sed'
+
+    def setUp(self):
+        with NamedTemporaryFile(delete=False) as dat:
+            self.textfile = Path(dat.name)
+            dat.write(_TEST_TEXT)
+
+    def tearDown(self):
+        self.textfile.unlink()
+        backup = Path(str(self.textfile) + '.bak')
+        if backup.exists():
+            backup.unlink()
+
+    def test_transaction(self):
+        from fabtools.edit import transaction
+        with transaction(self.textfile, backup='.bak', use_sudo=local, engine=self.engine) as t:
+            t.replace_line('two', 'TWO')
+            t.prepend('zero')
+            t.append('eight')
+            t.delete(re.compile('^f'), do_all=True)
+            t.replace('six', 'SIX')
+            t.commented_out('seven')
+        self.assertTrue(t.changed)
+        self.assertEqual(self.textfile.read_text().split(), ['zero', 'one', 'TWO', 'three', 'SIX', '#seven', 'eight'])
+        self.assertEqual(Path(str(self.textfile) + '.bak').read_text(), _TEST_TEXT)
+
+    def test_transaction_unchanged(self):
+        from fabtools.edit import transaction
+        with transaction(self.textfile, use_sudo=local, engine=self.engine) as t:
+            t.replace_line('two', 'two')
+            t.delete('not in file')
+        self.assertFalse(t.changed)
+        self.assertEqual(self.textfile.read_text(), _TEST_TEXT)
+
+    def test_replace_line_and_delete_all_matches(self):
+        from fabtools.edit import transaction
+        with transaction(self.textfile, use_sudo=local, engine=self.engine) as t:
+            t.replace_line(re.compile('^t'), 'T')
+            t.delete(re.compile('^s'))
+        self.assertEqual(self.textfile.read_text().split(), ['one', 'T', 'T', 'four', 'five'])
+
+    def test_failed_transaction(self):
+        from fabtools.edit import transaction
+        missing = Path(str(self.textfile) + '.missing')
+        with self.assertRaises((SystemExit, IOError)):
+            with settings(hide('everything')):
+                with transaction(missing, use_sudo=local, engine=self.engine) as t:
+                    t.append('one')
+                    t.append('two')
+        self.assertFalse(missing.exists())
+
+
+class PythonTransactionTestCase(TransactionTestCase):
+    """
+    Tests for edit transactions using the Python engine
+    """
+    engine = 'python'
+
+    def test_limits(self):
+        from fabtools.edit import transaction
+        with transaction(self.textfile, use_sudo=local, engine=self.engine) as t:
+            t.append('hi', pat=re.compile('e$'), start=re.compile('f[ou]+r'), do_all=True)
+            t.prepend('hey', pat=re.compile('^t'), stop=2)
+        self.assertEqual(self.textfile.read_text().split(),
+                         ['one', 'hey', 'two', 'three', 'four', 'five', 'hi', 'six', 'seven'])
+
+
+class EngineParityTestCase(unittest.TestCase):
+    """
+    The sed and Python engines must give the same result for the same transaction
+    """
+
+    def _edit(self, engine, edits):
+        from fabtools.edit import transaction
+        with NamedTemporaryFile(delete=False) as dat:
+            textfile = Path(dat.name)
+            dat.write(_TEST_TEXT + '\nten ten\n')
+        try:
+            with transaction(textfile, use_sudo=local, engine=engine) as t:
+                edits(t)
+            return textfile.read_text()
+        finally:
+            textfile.unlink()
+
+    def test_parity(self):
+        def edits(t):
+            t.prepend('zero')
+            t.append('after t', pat=re.compile('^t'))
+            t.prepend('before f', pat=re.compile('^f'), do_all=True)
+            t.replace_line(re.compile('e$'), 'E')
+            t.delete('ix')
+            t.replace(re.compile('(te)n'), '<&|\\1\\&>')
+            t.replace(re.compile('o'), '0', do_all=True)
+            t.commented_out(re.compile('^se'), start=3)
+            t.commented_out('f0ur', commented=False)
+        sed_result = self._edit('sed', edits)
+        self.assertEqual(self._edit('python', edits), sed_result)
+        self.assertIn('<ten|te&> ten', sed_result)
+
+    def test_parity_delete_all_lines(self):
+        def edits(t):
+            t.delete(re.compile('.*'), do_all=True)
+        sed_result = self._edit('sed', edits)
+        self.assertEqual(self._edit('python', edits), sed_result)
+        self.assertEqual(sed_result, '')
+
+
+class PerFileTestCase(unittest.TestCase):
+    """
+    Tests for per file results of find and capture
+    """
+
+    def setUp(self):
+        self.textfiles = []
+        for text in (_TEST_TEXT, 'zero\none\ntwo'):
+            with NamedTemporaryFile(delete=False, suffix='.txt') as dat:
+                self.textfiles.append(Path(dat.name))
+                dat.write(text)
+
+    def tearDown(self):
+        for textfile in self.textfiles:
+            textfile.unlink()
+
+    def test_find(self):
+        from fabtools.edit import find
+        first, second = [str(f) for f in self.textfiles]
+        self.assertEqual(find(re.compile('^t'), self.textfiles, do_all=True, per_file=True, use_sudo=local),
+                         {first: [2, 3], second: [3]})
+        self.assertEqual(find('seven', self.textfiles, per_file=True, use_sudo=local),
+                         {first: [7], second: []})
+
+    def test_capture(self):
+        from fabtools.edit import capture
+        first, second = [str(f) for f in self.textfiles]
+        self.assertEqual(capture('one', self.textfiles, per_file=True, use_sudo=local),
+                         {first: 'one', second: 'one'})
+
+    def test_glob(self):
+        from fabtools.edit import find
+        pattern = str(self.textfiles[0].parent / '*.txt')
+        found = find('zero', pattern, per_file=True, use_sudo=local)
+        self.assertEqual(found[str(self.textfiles[1])], [1])
+        self.assertEqual(found[str(self.textfiles[0])], [])
+        self.assertEqual(find('zero', str(self.textfiles[0].parent / '*.nomatch'), per_file=True,
+                              use_sudo=local), {})
+
+    def test_missing_file(self):
+        from fabtools.edit import find
+        missing = str(self.textfiles[0]) + '.missing'
+        with self.assertRaises(SystemExit):
+            with settings(hide('everything')):
+                find('one', self.textfiles + [missing], per_file=True, use_sudo=local)
+
+
+class ChangedFlagTestCase(unittest.TestCase):
+    """
+    Tests for the changed flag returned by edit operations
+    """
+
+    def setUp(self):
+        self.textfiles = []
+        for i in range(2):
+            with NamedTemporaryFile(delete=False) as dat:
+                self.textfiles.append(Path(dat.name))
+                dat.write(_TEST_TEXT)
+
+    def tearDown(self):
+        for textfile in self.textfiles:
+            textfile.unlink()
+            backup = Path(str(textfile) + '.bak')
+            if backup.exists():
+                backup.unlink()
+
+    def test_changed(self):
+        from fabtools.edit import append, prepend, replace_line, delete, replace, commented_out
+        textfile = self.textfiles[0]
+        self.assertTrue(replace_line('two', 'TWO', textfile, use_sudo=local))
+        self.assertFalse(replace_line('TWO', 'TWO', textfile, use_sudo=local))
+        self.assertTrue(append('eight', textfile, use_sudo=local))
+        self.assertTrue(prepend('zero', textfile, use_sudo=local))
+        self.assertFalse(delete('not in file', textfile, use_sudo=local))
+        self.assertTrue(replace('six', 'SIX', textfile, use_sudo=local))
+        self.assertFalse(replace('six', 'SIX', textfile, use_sudo=local))
+        self.assertTrue(commented_out('seven', textfile, use_sudo=local))
+        self.assertFalse(commented_out('seven', textfile, use_sudo=local))
+        self.assertEqual(textfile.read_text().split(),
+                         ['zero', 'one', 'TWO', 'three', 'four', 'five', 'SIX', '#seven', 'eight'])
+
+    def test_backup_only_if_changed(self):
+        from fabtools.edit import replace
+        first, second = self.textfiles
+        second.write_text(u'other text')
+        self.assertTrue(replace('four', 'FOUR', self.textfiles, backup='.bak', use_sudo=local))
+        self.assertTrue(Path(str(first) + '.bak').exists())
+        self.assertFalse(Path(str(second) + '.bak').exists())
+        self.assertEqual(second.read_text(), 'other text')
+
+    def test_missing_file(self):
+        from fabtools.edit import delete
+        missing = Path(str(self.textfiles[0]) + '.missing')
+        with self.assertRaises(SystemExit):
+            with settings(hide('everything')):
+                delete('one', [missing, self.textfiles[0]], use_sudo=local)
+        self.assertFalse(self.textfiles[0].read_text().startswith('one'))
+
+
 class TopLimitedEditTestCase(TopLimitMixin, EditTestCase):
     pass
 
@@ -237,6 +539,11 @@ def suite():
     return unittest.TestSuite([
         unittest.TestLoader().loadTestsFromTestCase(UtilTestCase),
         unittest.TestLoader().loadTestsFromTestCase(EditTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(InsertUnlessFoundTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(TransactionTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(PythonTransactionTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(PerFileTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(ChangedFlagTestCase),
         unittest.TestLoader().loadTestsFromTestCase(TopLimitedEditTestCase),
         unittest.TestLoader().loadTestsFromTestCase(BottomLimitedEditTestCase),
     ])
@@ -0,0 +1,11 @@
+class FakeResult(str):
+    """
+    Fake result of a Fabric ``run`` call
+    """
+
+    def __new__(cls, output='', return_code=0):
+        res = str.__new__(cls, output)
+        res.return_code = return_code
+        res.succeeded = return_code == 0
+        res.failed = not res.succeeded
+        return res
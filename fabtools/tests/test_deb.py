@@ -2,6 +2,8 @@ import unittest
 
 from mock import patch
 
+from fabtools.tests.helpers import FakeResult
+
 
 class AptKeyTestCase(unittest.TestCase):
 
@@ -11,3 +13,136 @@ class AptKeyTestCase(unittest.TestCase):
         self.assertRaises(ValueError, _validate_apt_key, "ABC123")
         self.assertRaises(ValueError, _validate_apt_key, "ABCDE12345")
         self.assertEqual(_validate_apt_key("ABCD1234"), None)
+
+
+
+DPKG_QUERY_OUTPUT = FakeResult("""\
+native:amd64
+curl\tcurl\tamd64\tinstall ok installed\t7.35.0-1ubuntu2
+libc6:amd64\tlibc6\tamd64\tinstall ok installed\t2.19-0ubuntu6
+libc6:i386\tlibc6\ti386\tunknown ok not-installed\t
+tzdata\ttzdata\tall\tinstall ok installed\t2014b-1
+apache2\tapache2\tamd64\tdeinstall ok config-files\t2.4.7-1ubuntu4
+dpkg-query: no packages found matching nosuchpackage
+""", return_code=1)
+
+
+@patch('fabtools.probes.run')
+class InstalledStatusTestCase(unittest.TestCase):
+
+    def test_single_command(self, mock_run):
+        from fabtools.deb import installed_status
+        mock_run.return_value = DPKG_QUERY_OUTPUT
+        status = installed_status(['curl', 'curl:amd64', 'libc6', 'libc6:amd64', 'libc6:i386',
+                                   'tzdata', 'apache2', 'nosuchpackage'])
+        self.assertEqual(mock_run.call_count, 1)
+        self.assertIn('dpkg-query -W ', mock_run.call_args[0][0])
+        self.assertEqual(status, {
+            'curl': ('installed', '7.35.0-1ubuntu2'),
+            'curl:amd64': ('installed', '7.35.0-1ubuntu2'),
+            'libc6': ('installed', '2.19-0ubuntu6'),
+            'libc6:amd64': ('installed', '2.19-0ubuntu6'),
+            'libc6:i386': ('not-installed', None),
+            'tzdata': ('installed', '2014b-1'),
+            'apache2': ('config-files', None),
+            'nosuchpackage': ('not-installed', None),
+        })
+
+    def test_no_packages(self, mock_run):
+        from fabtools.deb import installed_status
+        self.assertEqual(installed_status([]), {})
+        self.assertFalse(mock_run.called)
+
+    @patch('fabtools.require.deb.uninstall')
+    @patch('fabtools.require.deb.install')
+    def test_require_packages(self, mock_install, mock_uninstall, mock_run):
+        from fabtools import require
+        mock_run.return_value = DPKG_QUERY_OUTPUT
+        require.deb.packages(['curl', 'apache2', 'nosuchpackage'])
+        mock_install.assert_called_once_with(['apache2', 'nosuchpackage'], update=False, options=None)
+        require.deb.nopackages(['curl', 'apache2'])
+        mock_uninstall.assert_called_once_with(['curl'])
+        self.assertEqual(mock_run.call_count, 2)
+
+
+@patch('fabtools.deb.run_as_root')
+class InstallVersionsTestCase(unittest.TestCase):
+
+    def test_install_versions(self, mock_run_as_root):
+        from fabtools.deb import install
+        install({'curl': '7.35.0-1ubuntu2', 'wget': None})
+        mock_run_as_root.assert_called_once_with(
+            'DEBIAN_FRONTEND=noninteractive apt-get install --quiet --assume-yes '
+            'curl=7.35.0-1ubuntu2 wget', pty=False)
+
+    def test_version_with_dict(self, mock_run_as_root):
+        from fabtools.deb import install
+        with self.assertRaises(ValueError):
+            install({'curl': None}, version='7.35.0-1ubuntu2')
+        self.assertFalse(mock_run_as_root.called)
+
+    @patch('fabtools.probes.run')
+    def test_require_versions_with_epoch(self, mock_run, mock_run_as_root):
+        from fabtools import require
+        mock_run.return_value = FakeResult(
+            'openssh-server\topenssh-server\tamd64\tinstall ok installed\t1:6.6p1-2ubuntu1\n'
+            'curl\tcurl\tamd64\tinstall ok installed\t7.35.0-1ubuntu2\n')
+        require.deb.packages({'openssh-server': '1:6.6p1-2ubuntu1', 'curl': '0:7.35.0-1ubuntu2'})
+        self.assertFalse(mock_run_as_root.called)
+        require.deb.packages({'openssh-server': '6.6p1-2ubuntu1'})
+        mock_run_as_root.assert_called_once_with(
+            'DEBIAN_FRONTEND=noninteractive apt-get install --quiet --assume-yes '
+            'openssh-server=6.6p1-2ubuntu1', pty=False)
+
+    @patch('fabtools.probes.run')
+    def test_require_versions(self, mock_run, mock_run_as_root):
+        from fabtools import require
+        mock_run.return_value = DPKG_QUERY_OUTPUT
+        require.deb.packages({
+            'curl': '7.35.0-1ubuntu2',
+            'libc6': '2.19-0ubuntu7',
+            'apache2': '2.4.7-1ubuntu4',
+            'nosuchpackage': None,
+        })
+        self.assertEqual(mock_run.call_count, 1)
+        mock_run_as_root.assert_called_once_with(
+            'DEBIAN_FRONTEND=noninteractive apt-get install --quiet --assume-yes '
+            'apache2=2.4.7-1ubuntu4 libc6=2.19-0ubuntu7 nosuchpackage', pty=False)
+
+
+@patch('fabtools.deb.run_as_root')
+@patch('fabtools.require.deb.run_as_root')
+class UptodateIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from fabtools.utils import clear_host_cache
+        clear_host_cache('deb.index')
+
+    def tearDown(self):
+        from fabtools.utils import clear_host_cache
+        clear_host_cache('deb.index')
+
+    def test_recent_update(self, mock_run_as_root, mock_update):
+        from fabtools.require.deb import uptodate_index
+        mock_run_as_root.return_value = '120'
+        uptodate_index(max_age=3600)
+        uptodate_index(max_age={'hour': 1})
+        self.assertEqual(mock_run_as_root.call_count, 1)
+        self.assertFalse(mock_update.called)
+
+    def test_smaller_max_age(self, mock_run_as_root, mock_update):
+        from fabtools.require.deb import uptodate_index
+        mock_run_as_root.return_value = '120'
+        uptodate_index(max_age=3600)
+        uptodate_index(max_age=60)
+        self.assertEqual(mock_run_as_root.call_count, 2)
+        self.assertEqual(mock_update.call_count, 1)
+
+    def test_never_updated(self, mock_run_as_root, mock_update):
+        from fabtools.require.deb import uptodate_index
+        mock_run_as_root.return_value = '-1'
+        uptodate_index()
+        uptodate_index()
+        self.assertEqual(mock_run_as_root.call_count, 1)
+        mock_update.assert_called_once_with(
+            'DEBIAN_FRONTEND=noninteractive apt-get --quiet --quiet update')
@@ -1,88 +1,418 @@
 import hashlib
+import os
 import unittest
 
 from mock import patch
 import pytest
 
+from fabtools.tests.helpers import FakeResult
 
-@patch('fabtools.require.files._mode')
-@patch('fabtools.require.files._owner')
-@patch('fabtools.require.files.umask')
+
+@patch.dict('fabric.api.env', {'digest_cache': None})
+@patch('fabtools.require.files.run_as_root')
 @patch('fabtools.require.files.put')
-@patch('fabtools.require.files.md5sum')
-@patch('fabtools.require.files.is_file')
+@patch('fabtools.require.files.file_state')
 class FilesTestCase(unittest.TestCase):
 
     def _file(self, *args, **kwargs):
         """ Proxy to ensure ImportErrors actually cause test failures rather
         than trashing the test run entirely """
         from fabtools import require
-        require.files.file(*args, **kwargs)
+        return require.files.file(*args, **kwargs)
+
+    def _state(self, contents=None, owner='root', mode='644'):
+        from fabtools.files import FileState, FileStat
+        if contents is None:
+            return FileState(stat=None, umask='0022', digest=None)
+        return FileState(
+            stat=FileStat('file', False, owner, owner, mode, 0, len(contents), 1),
+            umask='0022',
+            digest=hashlib.md5(contents).hexdigest(),
+        )
 
-    def test_verify_remote_false(self, is_file, md5sum, put, umask, owner, mode):
+    def test_verify_remote_false(self, file_state, put, run_as_root):
         """ If verify_remote is set to False, then we should find that
-        only is_file is used to check for the file's existence. Hashlib's
-        md5 should not have been called.
+        only the file's existence is checked, without a remote MD5 sum.
         """
-        is_file.return_value = True
+        file_state.return_value = self._state('Something else')
         self._file(contents='This is a test', verify_remote=False)
-        self.assertTrue(is_file.called)
-        self.assertFalse(md5sum.called)
+        self.assertFalse(file_state.call_args[1]['digest'])
+        self.assertFalse(put.called)
 
-    def test_verify_remote_true(self, is_file, md5sum, put, umask, owner, mode):
+    def test_verify_remote_true(self, file_state, put, run_as_root):
         """ If verify_remote is True, then we should find that an MD5 hash is
         used to work out whether the file is different.
         """
-        is_file.return_value = True
-        md5sum.return_value = hashlib.md5('This is a test').hexdigest()
+        file_state.return_value = self._state('This is a test')
         self._file(contents='This is a test', verify_remote=True)
-        self.assertTrue(is_file.called)
-        self.assertTrue(md5sum.called)
+        self.assertTrue(file_state.call_args[1]['digest'])
+        self.assertFalse(put.called)
+
+    def test_different_contents(self, file_state, put, run_as_root):
+        file_state.return_value = self._state('Something else')
+        self._file('/tmp/foo', contents='This is a test', verify_remote=True)
+        self.assertTrue(put.called)
+
+    def test_unchanged_file_uses_a_single_probe(self, file_state, put, run_as_root):
+        file_state.return_value = self._state('This is a test')
+        self._file('/tmp/foo', contents='This is a test', use_sudo=True)
+        self.assertEqual(file_state.call_count, 1)
+        self.assertFalse(put.called)
+        self.assertFalse(run_as_root.called)
+
+    def test_attributes_fixed_in_one_command(self, file_state, put, run_as_root):
+        file_state.return_value = self._state('This is a test', owner='alice', mode='600')
+        self._file('/tmp/foo', contents='This is a test', use_sudo=True)
+        run_as_root.assert_called_once_with('chown root: /tmp/foo && chmod 0644 /tmp/foo')
+
+    def test_changed_flag(self, file_state, put, run_as_root):
+        file_state.return_value = self._state('This is a test', owner='alice')
+        self.assertFalse(self._file('/tmp/foo', contents='This is a test', use_sudo=True))
+        file_state.return_value = self._state('Something else')
+        self.assertTrue(self._file('/tmp/foo', contents='This is a test', use_sudo=True))
+
+    def test_new_file_attributes(self, file_state, put, run_as_root):
+        file_state.return_value = self._state()
+        self._file('/tmp/foo', contents='This is a test', use_sudo=True, owner='alice', mode='600')
+        self.assertTrue(put.called)
+        run_as_root.assert_called_once_with('chown alice: /tmp/foo && chmod 600 /tmp/foo')
+
+    def test_algorithm(self, file_state, put, run_as_root):
+        state = self._state('This is a test')
+        file_state.return_value = state._replace(
+            digest=hashlib.sha256('This is a test').hexdigest())
+        self._file('/tmp/foo', contents='This is a test', algorithm='sha256')
+        self.assertEqual(file_state.call_args[1]['algo'], 'sha256')
+        self.assertFalse(put.called)
+
+    def test_manifest_hit(self, file_state, put, run_as_root):
+        state = self._state('This is a test')
+        file_state.return_value = state._replace(from_manifest=True)
+        self._file('/tmp/foo', contents='This is a test', use_sudo=True, manifest=True)
+        self.assertTrue(file_state.call_args[1]['manifest'])
+        self.assertFalse(put.called)
+        self.assertFalse(run_as_root.called)
 
-    def test_temp_dir(self, is_file, md5sum, put, umask, owner, mode):
-        owner.return_value = 'root'
-        umask.return_value = '0002'
-        mode.return_value = '0664'
+    def test_manifest_miss_records_digest(self, file_state, put, run_as_root):
+        file_state.return_value = self._state('This is a test')
+        self._file('/tmp/foo', contents='This is a test', use_sudo=True, manifest=True)
+        self.assertFalse(put.called)
+        command = run_as_root.call_args[0][0]
+        self.assertTrue(command.startswith('mkdir -p "/var/lib/fabtools/manifest" && echo "%s '
+                                           % hashlib.md5('This is a test').hexdigest()))
+
+    def test_manifest_updated_after_upload(self, file_state, put, run_as_root):
+        state = self._state('Something else')
+        file_state.return_value = state._replace(from_manifest=True)
+        self._file('/tmp/foo', contents='This is a test', use_sudo=True, manifest=True)
+        self.assertTrue(put.called)
+        command = run_as_root.call_args[0][0]
+        self.assertTrue(command.startswith('chown root: /tmp/foo && chmod 0644 /tmp/foo && mkdir -p '))
+        self.assertIn(hashlib.md5('This is a test').hexdigest(), command)
+
+    @patch.dict('fabric.api.env', {'user': 'alice'})
+    @patch('fabtools.require.files.find_executable', return_value='/usr/bin/rsync')
+    @patch('fabtools.require.files._has_rsync', return_value=True)
+    @patch('fabtools.require.files.rsync_project')
+    def test_delta_upload(self, rsync_project, has_rsync, find_executable,
+                          file_state, put, run_as_root):
+        rsync_project.return_value.failed = False
+        file_state.return_value = self._state('Something else')
+        self._file('/tmp/foo', source=__file__, use_sudo=True, delta=True)
+        self.assertFalse(put.called)
+        kwargs = rsync_project.call_args[1]
+        self.assertEqual(kwargs['remote_dir'], '/tmp/foo')
+        self.assertEqual(kwargs['extra_opts'], '--rsync-path="sudo -n rsync"')
+
+    @patch('fabtools.require.files.find_executable', return_value='/usr/bin/rsync')
+    @patch('fabtools.require.files._has_rsync', return_value=False)
+    @patch('fabtools.require.files.rsync_project')
+    def test_delta_upload_fallback(self, rsync_project, has_rsync, find_executable,
+                                   file_state, put, run_as_root):
+        file_state.return_value = self._state('Something else')
+        self._file('/tmp/foo', source=__file__, use_sudo=True, delta=True)
+        self.assertFalse(rsync_project.called)
+        self.assertTrue(put.called)
+
+    @patch('fabtools.require.files.rsync_project')
+    def test_delta_upload_new_file(self, rsync_project, file_state, put, run_as_root):
+        file_state.return_value = self._state()
+        self._file('/tmp/foo', source=__file__, delta=True)
+        self.assertFalse(rsync_project.called)
+        self.assertTrue(put.called)
+
+    @patch('fabtools.require.files.upload_compressed')
+    def test_compressed_contents(self, upload_compressed, file_state, put, run_as_root):
+        file_state.return_value = self._state()
+        self._file('/tmp/foo', contents='This is a test', use_sudo=True, compression='gzip')
+        self.assertFalse(put.called)
+        source, path = upload_compressed.call_args[0]
+        self.assertEqual(source.read(), 'This is a test')
+        self.assertEqual(path, '/tmp/foo')
+        self.assertEqual(upload_compressed.call_args[1], {'use_sudo': True, 'compression': 'gzip'})
+
+    @patch('fabtools.require.files.upload_compressed')
+    def test_compressed_source(self, upload_compressed, file_state, put, run_as_root):
+        file_state.return_value = self._state()
+        self._file('/tmp/foo', source=__file__, compression='zstd')
+        upload_compressed.assert_called_once_with(__file__, '/tmp/foo', use_sudo=False,
+                                                  compression='zstd')
+
+    def test_temp_dir(self, file_state, put, run_as_root):
+        file_state.return_value = self._state()
         from fabtools import require
         require.file('/var/tmp/foo', source=__file__, use_sudo=True, temp_dir='/somewhere')
         put.assert_called_with(__file__, '/var/tmp/foo', use_sudo=True, temp_dir='/somewhere')
 
-    def test_home_as_temp_dir(self, is_file, md5sum, put, umask, owner, mode):
-        owner.return_value = 'root'
-        umask.return_value = '0002'
-        mode.return_value = '0664'
+    def test_home_as_temp_dir(self, file_state, put, run_as_root):
+        file_state.return_value = self._state()
         from fabtools import require
         require.file('/var/tmp/foo', source=__file__, use_sudo=True, temp_dir='')
         put.assert_called_with(__file__, '/var/tmp/foo', use_sudo=True, temp_dir='')
 
-    def test_default_temp_dir(self, is_file, md5sum, put, umask, owner, mode):
-        owner.return_value = 'root'
-        umask.return_value = '0002'
-        mode.return_value = '0664'
+    def test_default_temp_dir(self, file_state, put, run_as_root):
+        file_state.return_value = self._state()
         from fabtools import require
         require.file('/var/tmp/foo', source=__file__, use_sudo=True)
         put.assert_called_with(__file__, '/var/tmp/foo', use_sudo=True, temp_dir='/tmp')
 
 
+@patch.dict('fabric.api.env', {'digest_cache': None})
+@patch('fabtools.require.files.run')
+@patch('fabtools.require.files.compressed_stream')
+@patch('fabtools.require.files.checksum_tree')
+class TreeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.local_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.local_dir, 'sub'))
+        for name, contents in [('foo', 'foo'), ('sub/bar', 'bar')]:
+            with open(os.path.join(self.local_dir, name), 'w') as f:
+                f.write(contents)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.local_dir)
+
+    def _sent(self, compressed_stream):
+        import tarfile
+        from StringIO import StringIO
+        data = ''.join(args[0] for args, kwargs in
+                       compressed_stream.return_value.__enter__.return_value.write.call_args_list)
+        return tarfile.open(fileobj=StringIO(data)).getnames()
+
+    def test_unchanged_tree(self, checksum_tree, compressed_stream, run):
+        from fabtools.require.files import tree
+        checksum_tree.return_value = {
+            'foo': hashlib.md5('foo').hexdigest(),
+            'sub/bar': hashlib.md5('bar').hexdigest(),
+            'extra': 'abc123',
+        }
+        tree(self.local_dir, '/srv/www')
+        self.assertFalse(compressed_stream.called)
+        self.assertFalse(run.called)
+
+    def test_changed_files_in_one_stream(self, checksum_tree, compressed_stream, run):
+        from fabtools.require.files import tree
+        checksum_tree.return_value = {
+            'foo': hashlib.md5('foo').hexdigest(),
+            'extra': 'abc123',
+            'extra.log': 'abc123',
+        }
+        tree(self.local_dir, '/srv/www', delete=True, exclude=['*.log'], owner='www')
+        self.assertEqual(self._sent(compressed_stream), ['sub/bar'])
+        script = compressed_stream.call_args[0][0]
+        self.assertEqual(script, ' && '.join([
+            'mkdir -p /srv/www',
+            '%(decompress)s | tar -xf - --no-same-owner -C /srv/www',
+            'rm -f -- /srv/www/extra',
+            'chown www: /srv/www /srv/www/sub /srv/www/sub/bar',
+        ]))
+        self.assertFalse(run.called)
+
+    def test_symlinks_are_sent_as_files(self, checksum_tree, compressed_stream, run):
+        import tarfile
+        from StringIO import StringIO
+        from fabtools.require.files import tree
+        os.symlink('foo', os.path.join(self.local_dir, 'link'))
+        os.symlink('missing', os.path.join(self.local_dir, 'broken'))
+        checksum_tree.return_value = {
+            'foo': hashlib.md5('foo').hexdigest(),
+            'sub/bar': hashlib.md5('bar').hexdigest(),
+        }
+        tree(self.local_dir, '/srv/www')
+        data = ''.join(args[0] for args, kwargs in
+                       compressed_stream.return_value.__enter__.return_value.write.call_args_list)
+        member, = tarfile.open(fileobj=StringIO(data)).getmembers()
+        self.assertEqual(member.name, 'link')
+        self.assertTrue(member.isfile())
+
+        # Once sent, the link is a regular file on the remote host
+        compressed_stream.reset_mock()
+        checksum_tree.return_value['link'] = hashlib.md5('foo').hexdigest()
+        tree(self.local_dir, '/srv/www')
+        self.assertFalse(compressed_stream.called)
+
+    def test_delete_only(self, checksum_tree, compressed_stream, run):
+        from fabtools.require.files import tree
+        checksum_tree.return_value = {
+            'foo': hashlib.md5('foo').hexdigest(),
+            'sub/bar': hashlib.md5('bar').hexdigest(),
+            'extra': 'abc123',
+        }
+        tree(self.local_dir, '/srv/www', delete=True)
+        self.assertFalse(compressed_stream.called)
+        run.assert_called_once_with('rm -f -- /srv/www/extra')
+
+
+@patch('fabtools.files.put')
+@patch('fabtools.files.run')
+class WriteAtomicTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from fabric.api import env
+        from fabtools.utils import clear_host_cache, host_cache
+        self.env = patch.dict(env, host_string='test')
+        self.env.start()
+        clear_host_cache()
+        host_cache('files.stat')['flavor'] = 'gnu'
+        host_cache('files.checksum')['md5'] = 'md5sum'
+
+    def tearDown(self):
+        from fabtools.utils import clear_host_cache
+        clear_host_cache()
+        self.env.stop()
+
+    def _result(self, return_code):
+        return FakeResult('', return_code)
+
+    def test_write_atomic(self, mock_run, mock_put):
+        from fabtools.files import write_atomic
+        mock_run.return_value = self._result(0)
+        write_atomic('/etc/foo', 'new contents', digest='abc123', backup='.bak')
+        args, kwargs = mock_put.call_args
+        self.assertEqual(args[0].getvalue(), 'new contents')
+        self.assertTrue(args[1].startswith('/etc/foo.fabtools-'))
+        script = mock_run.call_args[0][0]
+        self.assertIn('[ "${h%% *}" = abc123 ] || exit 3', script)
+        self.assertIn('cp -p "$f" "$f".bak', script)
+        self.assertTrue(script.endswith('mv -f "$n" "$f"'))
+
+    def test_concurrent_modification(self, mock_run, mock_put):
+        from fabtools.files import write_atomic
+        mock_run.return_value = self._result(3)
+        with self.assertRaises(SystemExit):
+            with patch('fabric.utils.sys.stderr'):
+                write_atomic('/etc/foo', 'new contents', digest='abc123')
+
+    def test_no_checksum_tool(self, mock_run, mock_put):
+        from fabtools.files import write_atomic
+        mock_run.return_value = self._result(4)
+        with self.assertRaises(SystemExit):
+            with patch('fabric.utils.sys.stderr'):
+                write_atomic('/etc/foo', 'new contents', digest='abc123')
+        self.assertIn('[ -n "$ht" ] || exit 4', mock_run.call_args[0][0])
+
+
+class UploadCompressedTestCase(unittest.TestCase):
+
+    def _upload(self, source, path, user='alice', cwd='', status=0, stderr='', **kwargs):
+        from fabtools.files import upload_compressed
+        with patch('fabtools.files.connections') as connections, \
+                patch.dict('fabric.api.env', {'user': user, 'cwd': cwd, 'host_string': 'x'}):
+            channel = connections['x'].get_transport.return_value.open_session.return_value
+            channel.recv.return_value = ''
+            channel.recv_stderr.side_effect = [stderr, ''] if stderr else ['']
+            channel.recv_exit_status.return_value = status
+            upload_compressed(source, path, **kwargs)
+        sent = ''.join(args[0] for args, kwargs in channel.sendall.call_args_list)
+        return channel.exec_command.call_args[0][0], sent
+
+    def test_gzip_from_file_object(self):
+        import gzip
+        from StringIO import StringIO
+        command, sent = self._upload(StringIO('This is a test'), '/tmp/foo')
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(sent)).read(), 'This is a test')
+        self.assertTrue(command.startswith('/bin/sh -c '))
+        self.assertIn('gzip -dc > "$t" && mv -f "$t" /tmp/foo', command)
+
+    def test_remote_failure(self):
+        from StringIO import StringIO
+        with patch('fabric.utils.sys.stderr') as stderr:
+            with self.assertRaises(SystemExit):
+                self._upload(StringIO('This is a test'), '/tmp/foo', status=1,
+                             stderr='gzip: stdin: unexpected end of file')
+        self.assertIn('unexpected end of file', ''.join(
+            args[0] for args, kwargs in stderr.write.call_args_list))
+
+    def test_existing_file_keeps_its_mode(self):
+        import shutil
+        import subprocess
+        import tempfile
+        from StringIO import StringIO
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'foo')
+            with open(path, 'w') as f:
+                f.write('old')
+            os.chmod(path, 0640)
+            command, sent = self._upload(StringIO('new'), path)
+            proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE)
+            proc.communicate(sent)
+            self.assertEqual(proc.returncode, 0)
+            with open(path) as f:
+                self.assertEqual(f.read(), 'new')
+            self.assertEqual(os.stat(path).st_mode & 0777, 0640)
+            self.assertEqual(os.listdir(tmp_dir), ['foo'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_sudo(self):
+        from StringIO import StringIO
+        command, sent = self._upload(StringIO('This is a test'), '/tmp/foo', use_sudo=True)
+        self.assertTrue(command.startswith('sudo -n /bin/sh -c '))
+        command, sent = self._upload(StringIO('This is a test'), '/tmp/foo', user='root',
+                                     use_sudo=True)
+        self.assertTrue(command.startswith('/bin/sh -c '))
+
+    def test_cwd(self):
+        from StringIO import StringIO
+        command, sent = self._upload(StringIO('This is a test'), 'foo', cwd='/tmp')
+        self.assertIn('cd /tmp && ', command)
+
+    def test_unsupported_compression(self):
+        from fabtools.files import upload_compressed
+        with self.assertRaises(ValueError):
+            upload_compressed(__file__, '/tmp/foo', compression='lzma')
+
+
+@patch('fabtools.files.put')
+@patch('fabtools.files.file_state')
+@patch('fabtools.files.render_template')
 class TestUploadTemplate(unittest.TestCase):
 
+    def setUp(self):
+        from fabtools.files import FileState
+        self.state = FileState(stat=None, umask='0022', digest=None)
+
     @patch('fabtools.files.run')
-    @patch('fabtools.files._upload_template')
-    def test_mkdir(self, mock_upload_template, mock_run):
+    def test_mkdir(self, mock_run, mock_render_template, mock_file_state, mock_put):
 
         from fabtools.files import upload_template
 
+        mock_file_state.return_value = self.state
         upload_template('filename', '/path/to/destination', mkdir=True)
 
         args, kwargs = mock_run.call_args
         self.assertEqual(args[0], 'mkdir -p /path/to')
 
     @patch('fabtools.files.sudo')
-    @patch('fabtools.files._upload_template')
-    def test_mkdir_sudo(self, mock_upload_template, mock_sudo):
+    def test_mkdir_sudo(self, mock_sudo, mock_render_template, mock_file_state, mock_put):
 
         from fabtools.files import upload_template
 
+        mock_file_state.return_value = self.state
         upload_template('filename', '/path/to/destination', mkdir=True, use_sudo=True)
 
         args, kwargs = mock_sudo.call_args
@@ -90,11 +420,11 @@ class TestUploadTemplate(unittest.TestCase):
         self.assertEqual(kwargs['user'], None)
 
     @patch('fabtools.files.sudo')
-    @patch('fabtools.files._upload_template')
-    def test_mkdir_sudo_user(self, mock_upload_template, mock_sudo):
+    def test_mkdir_sudo_user(self, mock_sudo, mock_render_template, mock_file_state, mock_put):
 
         from fabtools.files import upload_template
 
+        mock_file_state.return_value = self.state
         upload_template('filename', '/path/to/destination', mkdir=True, use_sudo=True, user='alice')
 
         args, kwargs = mock_sudo.call_args
@@ -102,48 +432,222 @@ class TestUploadTemplate(unittest.TestCase):
         self.assertEqual(kwargs['user'], 'alice')
 
     @patch('fabtools.files.run_as_root')
-    @patch('fabtools.files._upload_template')
-    def test_chown(self, mock_upload_template, mock_run_as_root):
+    def test_chown(self, mock_run_as_root, mock_render_template, mock_file_state, mock_put):
 
         from fabric.api import env
         from fabtools.files import upload_template
 
+        mock_file_state.return_value = self.state
         upload_template('filename', 'destination', chown=True)
 
         args, kwargs = mock_run_as_root.call_args
         self.assertEqual(args[0], 'chown %s: destination' % env.user)
 
     @patch('fabtools.files.run_as_root')
-    @patch('fabtools.files._upload_template')
-    def test_chown_user(self, mock_upload_template, mock_run_as_root):
+    def test_chown_user(self, mock_run_as_root, mock_render_template, mock_file_state, mock_put):
 
         from fabtools.files import upload_template
 
+        mock_file_state.return_value = self.state
         upload_template('filename', 'destination', chown=True, user='alice')
 
         args, kwargs = mock_run_as_root.call_args
         self.assertEqual(args[0], 'chown alice: destination')
 
-    @patch('fabtools.files._upload_template')
-    def test_use_jinja_true(self, mock_upload_template):
+    def test_use_jinja_true(self, mock_render_template, mock_file_state, mock_put):
 
         from fabtools.files import upload_template
 
+        mock_file_state.return_value = self.state
         upload_template('filename', 'destination', use_jinja=True)
 
-        args, kwargs = mock_upload_template.call_args
+        args, kwargs = mock_render_template.call_args
         self.assertEqual(kwargs['use_jinja'], True)
 
-    @patch('fabtools.files._upload_template')
-    def test_use_jinja_false(self, mock_upload_template):
+    def test_use_jinja_false(self, mock_render_template, mock_file_state, mock_put):
 
         from fabtools.files import upload_template
 
+        mock_file_state.return_value = self.state
         upload_template('filename', 'destination', use_jinja=False)
 
-        args, kwargs = mock_upload_template.call_args
+        args, kwargs = mock_render_template.call_args
         self.assertEqual(kwargs['use_jinja'], False)
 
+    def test_not_skip_unchanged(self, mock_render_template, mock_file_state, mock_put):
+
+        from fabtools.files import upload_template
+
+        mock_render_template.return_value = 'Hello'
+        mock_file_state.return_value = self.state
+        self.assertTrue(upload_template('filename', 'destination', backup=False))
+
+        args, kwargs = mock_file_state.call_args
+        self.assertEqual(kwargs['digest'], False)
+        self.assertTrue(mock_put.called)
+
+
+@patch('fabtools.files.run_as_root')
+@patch('fabtools.files.run')
+@patch('fabtools.files.put')
+@patch('fabtools.files.file_state')
+class TestUploadTemplateSkipUnchanged(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        fd, self.template = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('Hello, %(name)s')
+        self.login_group = patch('fabtools.files._login_group',
+                                 side_effect=lambda user, use_sudo: user)
+        self.login_group.start()
+
+    def tearDown(self):
+        self.login_group.stop()
+        os.unlink(self.template)
+
+    def _state(self, contents=None, owner='alice', group=None, mode='644'):
+        from fabtools.files import FileState, FileStat
+        if contents is None:
+            return FileState(stat=None, umask='0022', digest=None)
+        return FileState(
+            stat=FileStat('file', False, owner, group or owner, mode, 0, len(contents), 1),
+            umask='0022',
+            digest=hashlib.md5(contents).hexdigest(),
+        )
+
+    def _upload(self, **kwargs):
+        from fabtools.files import upload_template
+        return upload_template(self.template, '/etc/hello', context={'name': 'world'},
+                               skip_unchanged=True, **kwargs)
+
+    def test_unchanged(self, file_state, put, run, run_as_root):
+        file_state.return_value = self._state('Hello, world')
+        self.assertFalse(self._upload(mkdir=True, chown=True, user='alice'))
+        self.assertEqual(file_state.call_count, 1)
+        self.assertFalse(put.called)
+        self.assertFalse(run.called)
+        self.assertFalse(run_as_root.called)
+
+    def test_unchanged_wrong_owner(self, file_state, put, run, run_as_root):
+        file_state.return_value = self._state('Hello, world', owner='root')
+        self.assertTrue(self._upload(chown=True, user='alice'))
+        self.assertFalse(put.called)
+        run_as_root.assert_called_once_with('chown alice: /etc/hello')
+
+    def test_unchanged_wrong_group(self, file_state, put, run, run_as_root):
+        file_state.return_value = self._state('Hello, world', group='staff')
+        self.assertTrue(self._upload(chown=True, user='alice'))
+        self.assertFalse(put.called)
+        run_as_root.assert_called_once_with('chown alice: /etc/hello')
+
+    def test_unchanged_attributes_fixed_in_one_command(self, file_state, put, run, run_as_root):
+        file_state.return_value = self._state('Hello, world', owner='root')
+        self.assertTrue(self._upload(chown=True, user='alice', mode=0600))
+        self.assertFalse(put.called)
+        run_as_root.assert_called_once_with('chown alice: /etc/hello && chmod 0600 /etc/hello')
+
+    def test_unchanged_mirror_local_mode(self, file_state, put, run, run_as_root):
+        os.chmod(self.template, 0640)
+        file_state.return_value = self._state('Hello, world')
+        self.assertTrue(self._upload(mirror_local_mode=True))
+        run_as_root.assert_called_once_with('chmod 0640 /etc/hello')
+        file_state.return_value = self._state('Hello, world', mode='640')
+        run_as_root.reset_mock()
+        self.assertFalse(self._upload(mirror_local_mode=True))
+        self.assertFalse(run_as_root.called)
+
+    def test_changed(self, file_state, put, run, run_as_root):
+        file_state.return_value = self._state('Hello, you')
+        self.assertTrue(self._upload(chown=True, user='alice'))
+        run.assert_called_once_with('cp /etc/hello /etc/hello.bak')
+        args, kwargs = put.call_args
+        self.assertEqual(args[0].getvalue(), 'Hello, world')
+        self.assertEqual(args[1], '/etc/hello')
+        run_as_root.assert_called_once_with('chown alice: /etc/hello')
+
+    def test_new_file(self, file_state, put, run, run_as_root):
+        file_state.return_value = self._state()
+        self.assertTrue(self._upload(mkdir=True))
+        run.assert_called_once_with('mkdir -p /etc')
+        self.assertTrue(put.called)
+
+    @patch('fabtools.files.render_template')
+    def test_jinja(self, render_template, file_state, put, run, run_as_root):
+        render_template.return_value = 'Hello, world'
+        file_state.return_value = self._state('Hello, world')
+        self.assertFalse(self._upload(use_jinja=True))
+        self.assertEqual(render_template.call_args[1]['use_jinja'], True)
+
+    @patch('fabtools.files.sudo')
+    def test_new_file_sudo_mkdir_as_root(self, sudo, file_state, put, run, run_as_root):
+        from fabric.api import env
+        file_state.return_value = self._state()
+        with patch.dict(env, user='bob'):
+            self.assertTrue(self._upload(mkdir=True, chown=True, use_sudo=True))
+        sudo.assert_called_once_with('mkdir -p /etc', user=None)
+        run_as_root.assert_called_once_with('chown bob: /etc/hello')
+
+
+class TemplateCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from fabtools import files
+        files._TEMPLATE_CACHE.clear()
+        self.template_dir = tempfile.mkdtemp()
+        self.template = os.path.join(self.template_dir, 'hello.txt')
+        self._write('Hello, {{ name }}', mtime=1000)
+
+    def tearDown(self):
+        import shutil
+        from fabtools import files
+        files._TEMPLATE_CACHE.clear()
+        files._JINJA_ENVIRONMENTS.clear()
+        shutil.rmtree(self.template_dir)
+
+    def _write(self, contents, mtime):
+        with open(self.template, 'w') as f:
+            f.write(contents)
+        os.utime(self.template, (mtime, mtime))
+
+    def test_read_once(self):
+        from fabtools.files import read_template
+        self.assertEqual(read_template(self.template), 'Hello, {{ name }}')
+        self._write('Bye, {{ name }}', mtime=1000)
+        self.assertEqual(read_template(self.template), 'Hello, {{ name }}')
+
+    def test_modified_template(self):
+        from fabtools.files import read_template
+        read_template(self.template)
+        self._write('Bye, {{ name }}', mtime=2000)
+        self.assertEqual(read_template(self.template), 'Bye, {{ name }}')
+
+    def test_size_is_bounded(self):
+        from fabtools import files
+        with patch('fabtools.files.TEMPLATE_CACHE_SIZE', 1):
+            files.read_template(self.template)
+            files.read_template(__file__)
+        self.assertEqual(len(files._TEMPLATE_CACHE), 1)
+
+    def test_jinja_template_compiled_once(self):
+        pytest.importorskip('jinja2')
+        from fabtools.files import render_template
+        self.assertEqual(render_template('hello.txt', {'name': 'foo'}, use_jinja=True,
+                                         template_dir=self.template_dir), 'Hello, foo')
+        with patch('jinja2.Environment.get_template') as get_template:
+            self.assertEqual(render_template('hello.txt', {'name': 'bar'}, use_jinja=True,
+                                             template_dir=self.template_dir), 'Hello, bar')
+        self.assertFalse(get_template.called)
+
+    def test_jinja_and_text_are_cached_apart(self):
+        pytest.importorskip('jinja2')
+        from fabtools.files import read_template, render_template
+        self.assertEqual(read_template(self.template), 'Hello, {{ name }}')
+        self.assertEqual(render_template('hello.txt', {'name': 'foo'}, use_jinja=True,
+                                         template_dir=self.template_dir), 'Hello, foo')
+        self.assertEqual(read_template(self.template), 'Hello, {{ name }}')
+
 
 @pytest.yield_fixture(scope='module')
 def mock_run():
@@ -185,3 +689,393 @@ def test_remove_recursive(mock_run):
     from fabtools.files import remove
     remove('/tmp/src', recursive=True)
     mock_run.assert_called_with('/bin/rm -r /tmp/src')
+
+
+def test_atomic_replace_single_command(mock_run):
+    from fabtools.files import atomic_replace
+    mock_run.reset_mock()
+    mock_run.return_value = FakeResult('/srv/app/current\n', 0)
+    res = atomic_replace('/srv/app/releases/2', '/srv/app/current', backup_ext='.bak',
+                         follow_symlink=True)
+    assert res == '/srv/app/current'
+    assert mock_run.call_count == 1
+    script = mock_run.call_args[0][0]
+    assert 'target=$(readlink -f "$target")' in script
+    assert '/bin/ln -f "$target" "$target".bak' in script
+    assert script.endswith('/bin/mv -f "$tmp" "$target" || exit 1\necho "$target"')
+
+
+def test_atomic_replace_directory(mock_run):
+    from fabtools.files import atomic_replace
+    mock_run.return_value = FakeResult('', 2)
+    with pytest.raises(AssertionError):
+        atomic_replace('/srv/app/releases', '/srv/app/current')
+
+
+def test_atomic_replace_missing_source(mock_run):
+    from fabtools.files import atomic_replace
+    mock_run.return_value = FakeResult('', 3)
+    with pytest.raises(ValueError):
+        atomic_replace('/srv/app/missing', '/srv/app/current')
+
+
+class StatManyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from fabric.api import env
+        from fabtools.utils import clear_host_cache
+        self.env = patch.dict(env, host_string='test')
+        self.env.start()
+        clear_host_cache('files.stat')
+
+    def tearDown(self):
+        from fabtools.utils import clear_host_cache
+        clear_host_cache('files.stat')
+        self.env.stop()
+
+    @patch('fabtools.probes.run')
+    def test_stat_many(self, mock_run):
+        from fabtools.files import FileStat, stat_many
+        mock_run.return_value = FakeResult('\n'.join([
+            'gnu',
+            'file 0 root root 644 1400000000 12 42',
+            'dir 1 alice staff 755 1400000001 4096 43',
+            '- 1 root root 777 1400000002 9 44',
+            '- 0',
+        ]))
+        res = stat_many(['/etc/hosts', '/srv/www', '/tmp/broken', '/tmp/missing'])
+        self.assertEqual(mock_run.call_count, 1)
+        self.assertEqual(res['/etc/hosts'], FileStat('file', False, 'root', 'root', '644', 1400000000, 12, 42))
+        self.assertEqual(res['/srv/www'], FileStat('dir', True, 'alice', 'staff', '755', 1400000001, 4096, 43))
+        self.assertEqual(res['/tmp/broken'].type, None)
+        self.assertTrue(res['/tmp/broken'].is_link)
+        self.assertEqual(res['/tmp/missing'], None)
+
+    @patch('fabtools.probes.run')
+    def test_stat_flavor_is_detected_once(self, mock_run):
+        from fabtools.files import is_file, owner
+        mock_run.return_value = FakeResult('bsd\nfile 0 root wheel 644 1400000000 12 42')
+        self.assertTrue(is_file('/etc/hosts'))
+        self.assertIn('echo bsd', mock_run.call_args[0][0])
+        mock_run.return_value = FakeResult('file 0 root wheel 644 1400000000 12 42')
+        self.assertEqual(owner('/etc/hosts'), 'root')
+        self.assertNotIn('echo bsd', mock_run.call_args[0][0])
+        self.assertIn("stat -f", mock_run.call_args[0][0])
+
+
+class ChecksumTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from fabric.api import env
+        from fabtools.utils import clear_host_cache
+        self.env = patch.dict(env, host_string='test')
+        self.env.start()
+        clear_host_cache('files.checksum')
+
+    def tearDown(self):
+        from fabtools.utils import clear_host_cache
+        clear_host_cache('files.checksum')
+        self.env.stop()
+
+    @patch('fabtools.probes.run')
+    def test_checksum_many_files(self, mock_run):
+        from fabtools.files import checksum
+        mock_run.return_value = FakeResult('checksum-tool:sha256sum\nabc123\n-')
+        res = checksum(['/etc/hosts', '/etc/missing'], algo='sha256')
+        self.assertEqual(res, {'/etc/hosts': 'abc123', '/etc/missing': None})
+        self.assertEqual(mock_run.call_count, 1)
+
+    @patch('fabtools.probes.run')
+    def test_checksum_tool_is_detected_once(self, mock_run):
+        from fabtools.files import md5sum
+        mock_run.return_value = FakeResult('checksum-tool:/sbin/md5 -r\nabc123')
+        self.assertEqual(md5sum('/etc/hosts'), 'abc123')
+        mock_run.return_value = FakeResult('def456')
+        self.assertEqual(md5sum('/etc/passwd'), 'def456')
+        self.assertNotIn('command -v', mock_run.call_args[0][0])
+        self.assertIn("ht='/sbin/md5 -r'", mock_run.call_args[0][0])
+
+    @patch.dict('fabtools.files._CHECKSUM_TOOLS', md5=['/nonexistent/md5sum'])
+    @patch('fabtools.probes.run')
+    def test_no_checksum_tool(self, mock_run):
+        import subprocess
+        import tempfile
+        from fabtools.files import checksum
+
+        def sh(script, *args, **kwargs):
+            proc = subprocess.Popen(['/bin/sh', '-c', script],
+                                    stdout=subprocess.PIPE)
+            return FakeResult(proc.communicate()[0].strip())
+        mock_run.side_effect = sh
+
+        tmpdir = tempfile.mkdtemp()
+        target = os.path.join(tmpdir, 'script')
+        marker = os.path.join(tmpdir, 'executed')
+        with open(target, 'w') as f:
+            f.write('#!/bin/sh\ntouch %s\n' % marker)
+        os.chmod(target, 0755)
+
+        with self.assertRaises(SystemExit):
+            with patch('fabric.utils.sys.stderr'):
+                checksum([target], algo='md5')
+        self.assertFalse(os.path.exists(marker))
+
+    def test_unsupported_algorithm(self):
+        from fabtools.files import checksum
+        self.assertRaises(ValueError, checksum, ['/etc/hosts'], algo='crc32')
+
+    @patch('fabtools.probes.run')
+    def test_checksum_tree(self, mock_run):
+        from fabtools.files import checksum_tree
+        mock_run.return_value = FakeResult('\n'.join([
+            'checksum-tool:md5sum',
+            'tree:abc123  ./foo',
+            'tree:def456  ./bar/with space',
+            'tree:\\123abc  ./new\\nline',
+            'tree:456def *./binary',
+        ]))
+        res = checksum_tree('/srv/www')
+        self.assertEqual(res, {
+            'foo': 'abc123',
+            'bar/with space': 'def456',
+            'new\nline': '123abc',
+            'binary': '456def',
+        })
+        script = mock_run.call_args[0][0]
+        self.assertIn('if [ -n "$ht" ] && cd /srv/www', script)
+        self.assertIn('find . -type f -exec $ht {} +', script)
+
+    @patch('fabtools.probes.run')
+    def test_checksum_tree_bsd(self, mock_run):
+        from fabtools.files import checksum_tree
+        mock_run.return_value = FakeResult(
+            'checksum-tool:/sbin/md5 -r\ntree:abc123 ./foo bar')
+        self.assertEqual(checksum_tree('/srv/www'), {'foo bar': 'abc123'})
+
+
+class LocalChecksumTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from fabric.api import env
+        from fabtools import files
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmp_dir, 'cache', 'digests.json')
+        self.env = patch.dict(env, digest_cache=self.cache_path)
+        self.env.start()
+        files._DIGEST_CACHES.clear()
+        files._DIRTY_DIGEST_CACHES.clear()
+        self.filename = os.path.join(self.tmp_dir, 'foo')
+        with open(self.filename, 'w') as f:
+            f.write('This is a test')
+
+    def tearDown(self):
+        import shutil
+        from fabtools import files
+        files._DIGEST_CACHES.clear()
+        files._DIRTY_DIGEST_CACHES.clear()
+        self.env.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_checksum(self):
+        from fabtools.files import local_checksum
+        self.assertEqual(local_checksum(self.filename),
+                         hashlib.md5('This is a test').hexdigest())
+        self.assertEqual(local_checksum(self.filename, algo='sha1'),
+                         hashlib.sha1('This is a test').hexdigest())
+
+    def test_file_is_read_once(self):
+        from fabtools import files
+        files.local_checksum(self.filename)
+        files._save_digest_caches()  # at exit
+        files._DIGEST_CACHES.clear()  # reload from disk
+        with patch('fabtools.files._hash_object') as hash_object:
+            self.assertEqual(files.local_checksum(self.filename),
+                             hashlib.md5('This is a test').hexdigest())
+        self.assertFalse(hash_object.called)
+
+    def test_cache_is_saved_by_forked_worker(self):
+        import json
+        from fabtools import files
+        pid = os.fork()
+        if pid == 0:
+            # Parallel workers leave through os._exit, skipping atexit
+            try:
+                files.local_checksum(self.filename)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        with open(self.cache_path) as f:
+            entries = json.load(f)
+        self.assertEqual([entry['digest'] for entry in entries.values()],
+                         [hashlib.md5('This is a test').hexdigest()])
+
+    def test_modified_file_is_read_again(self):
+        from fabtools.files import local_checksum
+        local_checksum(self.filename)
+        with open(self.filename, 'w') as f:
+            f.write('This is another test')
+        self.assertEqual(local_checksum(self.filename),
+                         hashlib.md5('This is another test').hexdigest())
+
+    def test_cache_is_saved_once_per_batch(self):
+        from fabtools import files
+        filenames = [self.filename]
+        for name in ['bar', 'baz']:
+            filenames.append(os.path.join(self.tmp_dir, name))
+            with open(filenames[-1], 'w') as f:
+                f.write(name)
+        with patch('fabtools.files._read_digest_cache',
+                   return_value={}) as read_cache:
+            digests = files.local_checksums(filenames)
+        self.assertEqual(read_cache.call_count, 2)  # load, then merge
+        self.assertEqual(digests[self.filename],
+                         hashlib.md5('This is a test').hexdigest())
+        self.assertFalse(files._DIRTY_DIGEST_CACHES)
+        self.assertTrue(os.path.exists(self.cache_path))
+
+    def test_cache_hits_are_saved(self):
+        import json
+        from fabtools import files
+        files.local_checksums([self.filename])
+        with open(self.cache_path) as f:
+            used = json.load(f).values()[0]['used']
+        files._DIGEST_CACHES.clear()
+        with patch('fabtools.files._time.time', return_value=used + 60):
+            files.local_checksums([self.filename])
+        with open(self.cache_path) as f:
+            self.assertEqual(json.load(f).values()[0]['used'], used + 60)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        import json
+        from fabric.api import env
+        from fabtools.files import local_checksums
+        with patch.dict(env, digest_cache_size=1):
+            local_checksums([self.filename], algo='md5')
+            local_checksums([self.filename], algo='sha1')
+        with open(self.cache_path) as f:
+            entries = json.load(f)
+        self.assertEqual([key.split(':')[0] for key in entries], ['sha1'])
+
+
+class WatchTestCase(unittest.TestCase):
+
+    @patch('fabtools.files.checksum')
+    def test_single_checksum_call_on_enter_and_exit(self, checksum):
+        from fabtools.files import watch
+        checksum.side_effect = [
+            {'/etc/a': '1', '/etc/b': '2'},
+            {'/etc/a': '1', '/etc/b': '3'},
+        ]
+        with watch(['/etc/a', '/etc/b']) as w:
+            pass
+        self.assertEqual(checksum.call_count, 2)
+        self.assertTrue(w.changed)
+
+    @patch('fabtools.files.checksum')
+    @patch('fabtools.files.stat_many')
+    @patch('fabtools.files._watch_state')
+    def test_quick_skips_unmodified_files(self, watch_state, stat_many, checksum):
+        from fabtools.files import FileStat, watch
+        a = FileStat('file', False, 'root', 'root', '644', 1000, 10, 1)
+        b = FileStat('file', False, 'root', 'root', '644', 1000, 10, 2)
+        watch_state.return_value = ({'/etc/a': a, '/etc/b': b}, {'/etc/a': '1', '/etc/b': '2'}, 2000)
+        stat_many.return_value = {'/etc/a': a, '/etc/b': b._replace(mtime=2001)}
+        checksum.return_value = {'/etc/b': '3'}
+        with watch(['/etc/a', '/etc/b'], quick=True) as w:
+            pass
+        checksum.assert_called_once_with(['/etc/b'], use_sudo=False)
+        self.assertTrue(w.changed)
+
+    @patch('fabtools.files.checksum')
+    @patch('fabtools.files.stat_many')
+    @patch('fabtools.files._watch_state')
+    def test_quick_rewritten_with_same_contents(self, watch_state, stat_many, checksum):
+        from fabtools.files import FileStat, watch
+        a = FileStat('file', False, 'root', 'root', '644', 1000, 10, 1)
+        watch_state.return_value = ({'/etc/a': a}, {'/etc/a': '1'}, 2000)
+        stat_many.return_value = {'/etc/a': a._replace(mtime=2001, inode=2)}
+        checksum.return_value = {'/etc/a': '1'}
+        with watch('/etc/a', quick=True) as w:
+            pass
+        self.assertFalse(w.changed)
+
+    @patch('fabtools.files.checksum')
+    @patch('fabtools.files.stat_many')
+    @patch('fabtools.files._watch_state')
+    def test_quick_no_hashing_when_nothing_modified(self, watch_state, stat_many, checksum):
+        from fabtools.files import FileStat, watch
+        a = FileStat('file', False, 'root', 'root', '644', 1000, 10, 1)
+        watch_state.return_value = ({'/etc/a': a}, {'/etc/a': '1'}, 2000)
+        stat_many.return_value = {'/etc/a': a}
+        with watch('/etc/a', quick=True) as w:
+            pass
+        self.assertFalse(checksum.called)
+        self.assertFalse(w.changed)
+
+    @patch('fabtools.files.checksum')
+    @patch('fabtools.files.stat_many')
+    @patch('fabtools.files._watch_state')
+    def test_quick_same_second(self, watch_state, stat_many, checksum):
+        from fabtools.files import FileStat, watch
+        a = FileStat('file', False, 'root', 'root', '644', 2000, 10, 1)
+        watch_state.return_value = ({'/etc/a': a}, {'/etc/a': '1'}, 2000)
+        stat_many.return_value = {'/etc/a': a}
+        checksum.return_value = {'/etc/a': '2'}
+        with watch('/etc/a', quick=True) as w:
+            pass
+        checksum.assert_called_once_with(['/etc/a'], use_sudo=False)
+        self.assertTrue(w.changed)
+
+    @patch('fabtools.probes.run')
+    def test_watch_state_single_command(self, mock_run):
+        from fabtools.files import _watch_state
+        from fabtools.utils import clear_host_cache, host_cache
+        with patch.dict('fabric.api.env', host_string='test'):
+            clear_host_cache('files.stat')
+            clear_host_cache('files.checksum')
+            host_cache('files.stat')['flavor'] = 'gnu'
+            host_cache('files.checksum')['md5'] = 'md5sum'
+            mock_run.return_value = FakeResult('2000\n- 0\n-')
+            self.assertEqual(_watch_state(['/etc/a'], False),
+                             ({'/etc/a': None}, {'/etc/a': None}, 2000))
+            clear_host_cache('files.stat')
+            clear_host_cache('files.checksum')
+        self.assertEqual(mock_run.call_count, 1)
+
+
+@patch('fabtools.require.files.run')
+@patch('fabtools.require.files.stat_many')
+class RequireDirectoriesTestCase(unittest.TestCase):
+
+    def test_all_in_place(self, stat_many, mock_run):
+        from fabtools.files import FileStat
+        from fabtools.require.files import directories
+        stat_many.return_value = {
+            '/srv/a': FileStat('dir', False, 'alice', 'alice', '750', 0, 4096, 1),
+            '/srv/b': FileStat('dir', False, 'alice', 'alice', '750', 0, 4096, 2),
+        }
+        directories(['/srv/a', '/srv/b'], owner='alice', mode='0750')
+        self.assertFalse(mock_run.called)
+
+    def test_fixes_are_applied_in_one_command(self, stat_many, mock_run):
+        from fabtools.files import FileStat
+        from fabtools.require.files import directories
+        stat_many.return_value = {
+            '/srv/a': None,
+            '/srv/b': FileStat('dir', False, 'root', 'root', '755', 0, 4096, 2),
+            '/srv/c': FileStat('dir', False, 'alice', 'root', '750', 0, 4096, 3),
+        }
+        directories(['/srv/a', '/srv/b', '/srv/c'], owner='alice', mode='750')
+        mock_run.assert_called_once_with(
+            'mkdir -p /srv/a && chown alice: /srv/a /srv/b && chmod 750 /srv/a /srv/b')
+
+    def test_integer_mode(self, stat_many, mock_run):
+        from fabtools.files import FileStat
+        from fabtools.require.files import directories
+        stat_many.return_value = {
+            '/srv/a': FileStat('dir', False, 'alice', 'alice', '755', 0, 4096, 1),
+            '/srv/b': FileStat('dir', False, 'alice', 'alice', '700', 0, 4096, 2),
+        }
+        directories(['/srv/a', '/srv/b'], mode=0755)
+        mock_run.assert_called_once_with('chmod 0755 /srv/b')
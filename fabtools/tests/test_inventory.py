@@ -0,0 +1,139 @@
+from mock import patch
+import pytest
+
+from fabtools.tests.helpers import FakeResult
+
+
+DPKG_INVENTORY = FakeResult("""\
+curl install ok installed
+apache2 deinstall ok config-files
+nginx-common install ok installed
+""")
+
+
+@pytest.yield_fixture
+def mock_run():
+    from fabric.api import env
+    from fabtools.utils import clear_host_cache
+    with patch('fabtools.probes.run') as mock:
+        with patch.dict(env, host_string='test', cwd=''):
+            yield mock
+            clear_host_cache('packages.inventory')
+
+
+def test_inventory_loaded_once(mock_run):
+    from fabtools.deb import is_installed
+    mock_run.return_value = DPKG_INVENTORY
+    assert is_installed('nginx-common') is True
+    assert is_installed('curl') is True
+    assert is_installed('apache2') is False
+    assert is_installed('vim') is False
+    assert mock_run.call_count == 1
+    assert mock_run.call_args[0][0].startswith('dpkg-query -W ')
+
+
+def test_unusual_names_are_checked_remotely(mock_run):
+    from fabtools.deb import is_installed
+    mock_run.return_value = FakeResult('Status: install ok installed')
+    assert is_installed('libc6:amd64') is True
+    mock_run.assert_called_once_with('dpkg -s libc6:amd64')
+
+
+def test_install_adds_packages(mock_run):
+    from fabtools.deb import install, is_installed
+    mock_run.return_value = DPKG_INVENTORY
+    assert is_installed('vim') is False
+    with patch('fabtools.deb.run_as_root'):
+        install(['vim', 'git'])
+    assert is_installed('vim') is True
+    assert is_installed('git') is True
+    assert mock_run.call_count == 1
+
+    # Dependencies may have been installed too
+    mock_run.return_value = FakeResult('Status: install ok installed')
+    assert is_installed('vim-runtime') is True
+    mock_run.assert_called_with('dpkg -s vim-runtime')
+    assert is_installed('vim-runtime') is True
+    assert mock_run.call_count == 2
+
+
+def test_uninstall_invalidates_inventory(mock_run):
+    from fabtools.deb import is_installed, uninstall
+    mock_run.return_value = DPKG_INVENTORY
+    assert is_installed('curl') is True
+    with patch('fabtools.deb.run_as_root'):
+        uninstall('curl')
+    mock_run.return_value = FakeResult('nginx-common install ok installed')
+    assert is_installed('curl') is False
+    assert mock_run.call_count == 2
+
+
+def test_inventory_is_per_host(mock_run):
+    from fabric.api import env
+    from fabtools.deb import is_installed
+    mock_run.return_value = DPKG_INVENTORY
+    assert is_installed('curl') is True
+    with patch.dict(env, host_string='other'):
+        mock_run.return_value = FakeResult('')
+        assert is_installed('curl') is False
+    assert mock_run.call_count == 2
+
+
+def test_rpm_inventory(mock_run):
+    from fabtools.rpm import is_installed
+    mock_run.return_value = FakeResult(
+        'bash bash.x86_64 bash-4.2.46 bash-4.2.46-34.el7 bash-4.2.46-34.el7.x86_64\n')
+    assert is_installed('bash') is True
+    assert is_installed('bash-4.2.46') is True
+    assert is_installed('bash.x86_64') is True
+    assert is_installed('zsh') is False
+    assert mock_run.call_count == 1
+
+
+def test_lazy_in_batch(mock_run):
+    import re
+    from fabtools.deb import is_installed
+    from fabtools.probes import batch
+
+    def run(script):
+        marker = re.search(r'fabtools-probe-\w+', script).group()
+        return FakeResult('Status: install ok installed\n%s 0\n%s 1' % (marker, marker))
+    mock_run.side_effect = run
+
+    with batch():
+        curl = is_installed('curl')
+        vim = is_installed('vim')
+        assert not mock_run.called
+    assert curl
+    assert not vim
+    assert mock_run.call_count == 1
+    assert 'dpkg -s curl' in mock_run.call_args[0][0]
+    assert 'dpkg-query' not in mock_run.call_args[0][0]
+
+
+def test_failed_inventory_is_incomplete(mock_run):
+    from fabtools.deb import is_installed
+    mock_run.return_value = FakeResult('dpkg-query: error', return_code=1)
+    assert not is_installed('curl')
+    mock_run.return_value = FakeResult('Status: install ok installed')
+    assert is_installed('curl') is True
+    mock_run.assert_called_with('dpkg -s curl')
+    assert mock_run.call_count == 3
+
+
+def test_inventory_loaded_in_batch(mock_run):
+    import re
+    from fabtools.deb import INVENTORY, is_installed
+    from fabtools.probes import batch
+
+    def run(script):
+        marker = re.search(r'fabtools-probe-\w+', script).group()
+        return FakeResult('%s\n%s 0' % (DPKG_INVENTORY, marker))
+    mock_run.side_effect = run
+
+    with batch():
+        packages = INVENTORY.packages()
+    assert 'curl' in packages
+    assert isinstance(INVENTORY.packages(), set)
+    assert is_installed('vim') is False
+    assert mock_run.call_count == 1
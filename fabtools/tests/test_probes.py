@@ -0,0 +1,85 @@
+import re
+
+from mock import patch
+import pytest
+
+from fabtools.tests.helpers import FakeResult
+
+
+def fake_batch_run(outputs):
+    """
+    Build a fake ``run`` that answers a batch script with the given
+    (output, return code) pairs, in order.
+    """
+    def run(script):
+        marker = re.search(r'"(fabtools-probe-\w+) \$rc"', script).group(1)
+        return FakeResult('\n'.join(
+            '%s\n%s %d' % (output, marker, rc) for output, rc in outputs))
+    return run
+
+
+@pytest.yield_fixture
+def mock_run():
+    from fabric.api import env
+    from fabtools.utils import clear_host_cache, host_cache
+    with patch('fabtools.probes.run') as mock:
+        with patch.dict(env, host_string='test', cwd=''):
+            host_cache('files.stat')['flavor'] = 'gnu'
+            yield mock
+            clear_host_cache('files.stat')
+
+
+def test_probe_without_batch(mock_run):
+    from fabtools.group import exists
+    mock_run.return_value = FakeResult('')
+    assert exists('admin') is True
+    mock_run.assert_called_once_with('getent group admin')
+
+
+def test_batch_runs_probes_in_a_single_command(mock_run):
+    import fabtools
+    from fabtools.files import is_dir, is_file, owner
+    from fabtools.user import exists
+
+    mock_run.side_effect = fake_batch_run([
+        ('file 0 alice alice 644 1400000000 12 42', 0),
+        ('file 0 alice alice 644 1400000000 12 42', 0),
+        ('file 0 alice alice 644 1400000000 12 42', 0),
+        ('alice:x:1000:1000::/home/alice:/bin/bash', 0),
+    ])
+
+    with fabtools.batch():
+        has_file = is_file('/tmp/foo')
+        has_dir = is_dir('/tmp/foo')
+        file_owner = owner('/tmp/foo')
+        has_user = exists('alice')
+        assert not mock_run.called
+
+    assert mock_run.call_count == 1
+    assert has_file
+    assert not has_dir
+    assert file_owner == 'alice'
+    assert has_user
+
+
+def test_lazy_result_flushes_batch(mock_run):
+    import fabtools
+    from fabtools.files import is_file
+
+    mock_run.side_effect = fake_batch_run([
+        ('file 0 root root 644 1400000000 12 42', 0),
+        ('- 0', 0),
+    ])
+
+    with fabtools.batch():
+        first = is_file('/tmp/foo')
+        second = is_file('/tmp/bar')
+        assert first
+        assert not second
+        assert mock_run.call_count == 1
+
+
+def test_split_output_keeps_empty_outputs():
+    from fabtools.probes import _split_output
+    output = 'foo\n\nM 0\n\nM 1\nbar baz\nM 0'
+    assert _split_output(output, 'M') == [('foo', 0), ('', 1), ('bar baz', 0)]
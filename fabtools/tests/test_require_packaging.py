@@ -0,0 +1,62 @@
+from mock import Mock, patch
+import pytest
+
+
+@pytest.yield_fixture
+def family():
+    with patch('fabtools.require.packaging.distrib_family') as mock:
+        yield mock
+
+
+@pytest.yield_fixture
+def rpm():
+    mock = Mock()
+    mock.is_installed.side_effect = lambda name: name == 'curl'
+    with patch.dict('fabtools.require.packaging.BACKENDS', redhat=mock):
+        yield mock
+
+
+def test_single_install(family, rpm):
+    from fabtools.require import packages
+    family.return_value = 'redhat'
+    packages([
+        'curl',
+        {'debian': 'build-essential', 'redhat': ['gcc', 'make']},
+        {'redhat': 'supervisord', 'default': 'supervisor'},
+        {'debian': 'apt-utils', 'default': None},
+        'gcc',
+    ])
+    rpm.install.assert_called_once_with(['gcc', 'make', 'supervisord'], options=None)
+
+
+def test_nothing_to_install(family, rpm):
+    from fabtools.require import packages
+    family.return_value = 'redhat'
+    packages(['curl'])
+    assert not rpm.install.called
+
+
+def test_nopackages(family, rpm):
+    from fabtools.require import nopackages
+    family.return_value = 'redhat'
+    nopackages([{'debian': 'curl', 'redhat': ['curl', 'wget']}])
+    rpm.uninstall.assert_called_once_with(['curl'], options=None)
+
+
+def test_missing_family(family, rpm):
+    from fabtools.require import packages
+    from fabtools.system import UnsupportedFamily
+    family.return_value = 'redhat'
+    with patch('fabtools.system.distrib_id', return_value='CentOS'):
+        with pytest.raises(UnsupportedFamily):
+            packages([{'debian': 'build-essential'}])
+
+
+def test_unsupported_family(family):
+    from fabtools.require import packages
+    from fabtools.system import UnsupportedFamily
+    family.return_value = 'other'
+    with patch('fabtools.system.distrib_id', return_value='Foo'):
+        packages([{'debian': 'build-essential', 'default': None}])
+        with pytest.raises(UnsupportedFamily):
+            packages(['curl'])
@@ -16,3 +16,87 @@ def test_unsupported_system():
 
     exception_msg = str(excinfo.value)
     assert exception_msg == "Unsupported family other (foo). Supported families: debian, redhat"
+
+
+UBUNTU_FACTS = """\
+kernel=Linux
+kernel_version=#1 SMP
+arch=x86_64
+lsb_id=Ubuntu
+lsb_release=14.04
+lsb_codename=trusty
+lsb_desc=Ubuntu 14.04.5 LTS
+release_file=/etc/debian_version
+cpus=4
+systemd=yes"""
+
+
+CENTOS_FACTS = """\
+kernel=Linux
+kernel_version=#1 SMP
+arch=i686
+release_file=/etc/redhat-release
+redhat_release=CentOS release 6.5 (Final)
+cpus=2"""
+
+
+@pytest.yield_fixture
+def mock_run():
+    from fabric.api import env
+    from fabtools.utils import clear_host_cache
+    with patch('fabtools.system.run') as mock:
+        with patch.dict(env, host_string='test'):
+            clear_host_cache('system.facts')
+            yield mock
+            clear_host_cache('system.facts')
+
+
+def test_facts_ubuntu(mock_run):
+    from fabtools.system import facts
+    mock_run.return_value = UBUNTU_FACTS
+    assert facts() == {
+        'kernel': 'Linux',
+        'distrib_id': 'Ubuntu',
+        'distrib_release': '14.04',
+        'distrib_codename': 'trusty',
+        'distrib_desc': 'Ubuntu 14.04.5 LTS',
+        'arch': 'x86_64',
+        'cpus': 4,
+        'using_systemd': True,
+    }
+
+
+def test_facts_centos_without_lsb(mock_run):
+    from fabtools.system import distrib_family, distrib_id, distrib_release, using_systemd
+    mock_run.return_value = CENTOS_FACTS
+    assert distrib_id() == 'CentOS'
+    assert distrib_family() == 'redhat'
+    assert distrib_release() == '6.5'
+    assert not using_systemd()
+
+
+def test_facts_are_cached(mock_run):
+    from fabtools.system import cpus, distrib_family, distrib_id, get_arch
+    mock_run.return_value = UBUNTU_FACTS
+    distrib_id()
+    distrib_family()
+    get_arch()
+    cpus()
+    assert mock_run.call_count == 1
+
+
+def test_facts_invalidation(mock_run):
+    from fabtools.system import distrib_id, invalidate_facts
+    mock_run.return_value = UBUNTU_FACTS
+    distrib_id()
+    invalidate_facts()
+    distrib_id()
+    assert mock_run.call_count == 2
+
+
+def test_facts_max_age(mock_run):
+    from fabtools.system import facts
+    mock_run.return_value = UBUNTU_FACTS
+    facts()
+    facts(max_age=-1)
+    assert mock_run.call_count == 2
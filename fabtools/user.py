@@ -15,6 +15,7 @@ from fabtools.group import (
     create as _group_create,
 )
 from fabtools.files import uncommented_lines
+from fabtools.probes import probe
 from fabtools.utils import run_as_root
 
 
@@ -22,8 +23,8 @@ def exists(name):
     """
     Check if a user exists.
     """
-    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
-        return run('getent passwd %(name)s' % locals()).succeeded
+    return probe('getent passwd %(name)s' % locals(),
+                 lambda output, return_code: return_code == 0)
 
 
 _SALT_CHARS = string.ascii_letters + string.digits + './'
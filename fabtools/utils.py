@@ -10,6 +10,9 @@ import posixpath
 from fabric.api import env, hide, run, sudo
 
 
+_HOST_CACHES = {}
+
+
 def run_as_root(command, *args, **kwargs):
     """
     Run a remote command as the root user.
@@ -24,6 +27,35 @@ def run_as_root(command, *args, **kwargs):
     return func(command, *args, **kwargs)
 
 
+def host_cache(namespace):
+    """
+    Get a dictionary for caching data about the current host.
+
+    Each *namespace* gets its own dictionary per ``env.host_string``,
+    so that modules can remember what they learned about a host for the
+    rest of the Python process without having to probe it again.
+    """
+    return _HOST_CACHES.setdefault(namespace, {}).setdefault(env.host_string, {})
+
+
+def clear_host_cache(namespace=None, host_string=None):
+    """
+    Forget cached data about hosts.
+
+    By default, all namespaces are cleared for all hosts. You can restrict
+    this to a single *namespace* and/or a single *host_string*.
+    """
+    if namespace is None:
+        namespaces = list(_HOST_CACHES.values())
+    else:
+        namespaces = [_HOST_CACHES.get(namespace, {})]
+    for caches in namespaces:
+        if host_string is None:
+            caches.clear()
+        else:
+            caches.pop(host_string, None)
+
+
 def get_cwd(local=False):
 
     from fabric.api import local as local_run